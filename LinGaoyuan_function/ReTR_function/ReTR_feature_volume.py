@@ -3,8 +3,10 @@ import torch
 from torch import nn
 from einops import (rearrange, reduce, repeat)
 
-from LinGaoyuan_function.ReTR_function.ReTR_grid_sample import grid_sample_2d
+import torch.nn.functional as F
+from LinGaoyuan_function.ReTR_function.ReTR_grid_sample import grid_sample_2d, grid_sample_3d
 from LinGaoyuan_function.ReTR_function.ReTR_cnn3d import VolumeRegularization
+from LinGaoyuan_function.unbounded2bounded import contract_points
 
 
 class FeatureVolume(nn.Module):
@@ -34,64 +36,272 @@ class FeatureVolume(nn.Module):
             self.xyz.append(np.stack([self.x[::level, ::level, ::level], self.y[::level, ::level, ::level],
                                       self.z[::level, ::level, ::level]]))
 
+        '''
+        LinGaoyuan_operation_20261018: the homogeneous volume grid of every level is created once and moved to the
+        device of the features on first use (get_volume_xyz_homo) instead of being copied from numpy in every forward.
+        It is a plain attribute, not a buffer, so DDP does not broadcast it in every forward.
+        '''
+        self.volume_xyz_homo = []
+        for i in range(self.multlevel):
+            volume_xyz = torch.from_numpy(self.xyz[i]).float().reshape([3, -1])
+            self.volume_xyz_homo.append(torch.cat([volume_xyz, torch.ones_like(volume_xyz[0:1])], dim=0))  # [4,XYZ]
+
+    def get_volume_xyz_homo(self, level, like):
+        '''
+        :return: homogeneous volume grid of level [4,XYZ] on the device and with the dtype of like
+        '''
+        volume_xyz_homo = self.volume_xyz_homo[level]
+        if volume_xyz_homo.device != like.device:
+            volume_xyz_homo = volume_xyz_homo.to(like.device)
+            self.volume_xyz_homo[level] = volume_xyz_homo
+        return volume_xyz_homo.type_as(like)
+
+    def sample_views(self, feat, source_poses, volume_xyz_homo):
+        """
+        project volume points into the source views and sample their features
+        feat: [NV C H W]
+        source_poses: [B NV 4 4]
+        volume_xyz_homo: [4, P]
+        return: volume_feature [B NV C P], mask [B NV P]
+        """
+        B, NV, _, _ = source_poses.shape
+
+        # volume project into views, the grid is broadcast over B and NV by matmul
+        volume_xyz_pixel_homo = torch.matmul(source_poses, volume_xyz_homo)  # B NV 4 4 @ 4 P
+        volume_xyz_pixel_homo = volume_xyz_pixel_homo[:, :, :3]
+        mask_valid_depth = volume_xyz_pixel_homo[:, :, 2] > 0  # B NV P
+        mask_valid_depth = mask_valid_depth.float()
+        mask_valid_depth = rearrange(mask_valid_depth, "B NV P -> (B NV) P")
+
+        volume_xyz_pixel = volume_xyz_pixel_homo / volume_xyz_pixel_homo[:, :, 2:3]
+        volume_xyz_pixel = volume_xyz_pixel[:, :, :2]
+        volume_xyz_pixel = rearrange(volume_xyz_pixel, "B NV Dim2 P -> (B NV) P Dim2")
+        volume_xyz_pixel = volume_xyz_pixel.unsqueeze(2)
+
+        # projection: project all points to NV images and sample features
+        # grid sample 2D
+        volume_feature, mask = grid_sample_2d(rearrange(feat[None,...], "B NV C H W -> (B NV) C H W"),
+                                              volume_xyz_pixel)  # (B NV) C P 1, (B NV P 1)
+
+        volume_feature = volume_feature.squeeze(-1)
+        mask = mask.squeeze(-1)  # (B NV P)
+        mask = mask * mask_valid_depth
+        volume_feature = rearrange(volume_feature, "(B NV) C P -> B NV C P", B=B, NV=NV)
+        mask = rearrange(mask, "(B NV) P -> B NV P", B=B, NV=NV)
+        return volume_feature, mask
+
+    @staticmethod
+    def mean_var(volume_feature, mask):
+        """
+        volume_feature: [B NV C P], mask: [B NV P]
+        return: mean and var of the valid views, [B 2C P]
+        """
+        weight = mask / (torch.sum(mask, dim=1, keepdim=True) + 1e-8)
+        weight = weight.unsqueeze(2)  # B NV 1 P
+
+        # ---- step 3: mean, var ------------------------------------------------
+        mean = torch.sum(volume_feature * weight, dim=1, keepdim=True)  # B 1 C P
+        var = torch.sum(weight * (volume_feature - mean) ** 2, dim=1, keepdim=True)  # B 1 C P
+        return torch.cat([mean, var], dim=2).squeeze(1)
+
+    def source_poses(self, ray_batch):
+        source_poses = (ray_batch['src_cameras'].squeeze())[:, -16:].reshape(-1, 4, 4)
+        'LinGaoyuan_operation_20240917: add batch dim(1 by default in my code)'
+        return source_poses[None,...]
+
     def forward(self, feats, ray_batch):
         """
         feats: [B NV C H W], NV: number of views
         batch: to get the poses for homography
         """
-        source_poses = (ray_batch['src_cameras'].squeeze())[:, -16:].reshape(-1, 4, 4)
-        'LinGaoyuan_operation_20240917: add batch dim(1 by default in my code)'
-        source_poses = source_poses[None,...]
-        B, NV, _, _ = source_poses.shape
-        # import pdb
-        # pdb.set_trace()
+        source_poses = self.source_poses(ray_batch)
         volume_mean_var_all = []
         for i in range(len(feats)):
             # ---- step 1: projection -----------------------------------------------
-            volume_xyz_temp = torch.tensor(self.xyz[i]).type_as(source_poses)
-            volume_xyz = volume_xyz_temp.reshape([3, -1])
-            volume_xyz_homo = torch.cat([volume_xyz, torch.ones_like(volume_xyz[0:1])], axis=0)  # [4,XYZ]
-
-            volume_xyz_homo_NV = repeat(volume_xyz_homo, "Num4 XYZ -> B NV Num4 XYZ", B=B, NV=NV)
-
-            # volume project into views
-            volume_xyz_pixel_homo = source_poses @ volume_xyz_homo_NV  # B NV 4 4 @ B NV 4 XYZ
-            volume_xyz_pixel_homo = volume_xyz_pixel_homo[:, :, :3]
-            mask_valid_depth = volume_xyz_pixel_homo[:, :, 2] > 0  # B NV XYZ
-            mask_valid_depth = mask_valid_depth.float()
-            mask_valid_depth = rearrange(mask_valid_depth, "B NV XYZ -> (B NV) XYZ")
-
-            volume_xyz_pixel = volume_xyz_pixel_homo / volume_xyz_pixel_homo[:, :, 2:3]
-            volume_xyz_pixel = volume_xyz_pixel[:, :, :2]
-            volume_xyz_pixel = rearrange(volume_xyz_pixel, "B NV Dim2 XYZ -> (B NV) XYZ Dim2")
-            volume_xyz_pixel = volume_xyz_pixel.unsqueeze(2)
-
-            # projection: project all x * y * z points to NV images and sample features
-            # grid sample 2D
-            volume_feature, mask = grid_sample_2d(rearrange(feats[i][None,...], "B NV C H W -> (B NV) C H W"),
-                                                  volume_xyz_pixel)  # (B NV) C XYZ 1, (B NV XYZ 1)
-
-            volume_feature = volume_feature.squeeze(-1)
-            mask = mask.squeeze(-1)  # (B NV XYZ)
-            mask = mask * mask_valid_depth
-            volume_feature = rearrange(volume_feature, "(B NV) C (NumX NumY NumZ) -> B NV NumX NumY NumZ C", B=B, NV=NV,
-                                       NumX=self.xyz[i].shape[1], NumY=self.xyz[i].shape[2], NumZ=self.xyz[i].shape[3])
-            mask = rearrange(mask, "(B NV) (NumX NumY NumZ) -> B NV NumX NumY NumZ", B=B, NV=NV,
-                             NumX=self.xyz[i].shape[1], NumY=self.xyz[i].shape[2], NumZ=self.xyz[i].shape[3])
-
-            weight = mask / (torch.sum(mask, dim=1, keepdim=True) + 1e-8)
-            weight = weight.unsqueeze(-1)  # B NV X Y Z 1
-
-            # ---- step 3: mean, var ------------------------------------------------
-            mean = torch.sum(volume_feature * weight, dim=1, keepdim=True)  # B 1 X Y Z C
-            var = torch.sum(weight * (volume_feature - mean) ** 2, dim=1, keepdim=True)  # B 1 X Y Z C
-            mean = mean.squeeze(1)
-            var = var.squeeze(1)
-            # volume_pe = self.linear_pe[i](volume_xyz_temp.permute(3,2,1,0)).unsqueeze(0)
-            volume_mean_var = torch.cat([mean, var], axis=-1)  # [B X Y Z C]
-            volume_mean_var = volume_mean_var.permute(0, 4, 3, 2, 1)  # [B,C,Z,Y,X]
+            volume_xyz_homo = self.get_volume_xyz_homo(i, source_poses)  # [4,XYZ]
+            volume_feature, mask = self.sample_views(feats[i], source_poses, volume_xyz_homo)
+
+            volume_mean_var = self.mean_var(volume_feature, mask)  # [B C XYZ]
+            volume_mean_var = rearrange(volume_mean_var, "B C (NumX NumY NumZ) -> B C NumZ NumY NumX",
+                                        NumX=self.xyz[i].shape[1], NumY=self.xyz[i].shape[2], NumZ=self.xyz[i].shape[3])  # [B,C,Z,Y,X]
             volume_mean_var_all.append(volume_mean_var)
         # ---- step 4: 3D regularization ----------------------------------------
         volume_mean_var_reg = self.volume_regularization(volume_mean_var_all)
 
-        return volume_mean_var_reg
\ No newline at end of file
+        return volume_mean_var_reg
+
+
+class SparseVolume(object):
+    """
+    LinGaoyuan_operation_20261018: block-sparse feature volume, only the occupied blocks of the volume are stored,
+    every voxel outside of them is zero. grid_sample() gives the same result as grid_sample_3d() on the dense volume.
+    """
+
+    def __init__(self, blocks, block_table, volume_reso):
+        """
+        blocks: [M C S S S], features of the occupied blocks in the [C Z Y X] layout of the dense volume
+        block_table: [NBz NBy NBx], index into blocks, -1 for empty blocks
+        """
+        self.block_size = blocks.shape[-1]
+        self.num_channels = blocks.shape[1]
+        self.block_table = block_table
+        self.volume_reso = volume_reso
+        self.voxels = rearrange(blocks, "M C Z Y X -> (M Z Y X) C")
+
+    def __len__(self):
+        return int((self.block_table >= 0).sum())
+
+    def lookup(self, idx):
+        """
+        idx: [P 3] integer voxel coordinates (x, y, z)
+        return: [P C], zero for voxels outside the volume or in empty blocks
+        """
+        S = self.block_size
+        valid = ((idx >= 0) & (idx < self.volume_reso)).all(dim=-1)
+        idx = idx.clamp(0, self.volume_reso - 1)
+        block = idx // S
+        local = idx % S
+        slot = self.block_table[block[:, 2], block[:, 1], block[:, 0]]
+        valid = valid & (slot >= 0)
+        row = slot.clamp(min=0) * S ** 3 + local[:, 2] * S * S + local[:, 1] * S + local[:, 0]
+        return self.voxels[row] * valid[:, None].type_as(self.voxels)
+
+    def grid_sample(self, grid):
+        """
+        trilinear interpolation with align_corners=False and zero padding, like F.grid_sample
+        grid: B 1 RN SN 3, (x, y, z) in [-1, 1]
+        return: B C RN SN
+        """
+        B, _, RN, SN, _ = grid.shape
+        if self.voxels.shape[0] == 0:
+            return grid.new_zeros(B, self.num_channels, RN, SN)
+
+        coords = ((grid.reshape(-1, 3) + 1) * self.volume_reso - 1) / 2
+        coords0 = torch.floor(coords)
+        frac = (coords - coords0).type_as(self.voxels)
+        coords0 = coords0.long()
+
+        output = 0
+        for corner in range(8):
+            offset = torch.tensor([corner & 1, (corner >> 1) & 1, (corner >> 2) & 1], device=grid.device)
+            weight = torch.where(offset.bool(), frac, 1 - frac).prod(dim=-1, keepdim=True)
+            output = output + weight * self.lookup(coords0 + offset)
+        return rearrange(output, "(B RN SN) C -> B C RN SN", B=B, RN=RN, SN=SN)
+
+
+def sample_feature_volume(fea_volume, grid):
+    """
+    LinGaoyuan_operation_20261018: grid_sample_3d() for the dense volume of FeatureVolume and the SparseVolume of SparseFeatureVolume
+    """
+    if isinstance(fea_volume, SparseVolume):
+        return fea_volume.grid_sample(grid)
+    return grid_sample_3d(fea_volume, grid)
+
+
+class SparseFeatureVolume(FeatureVolume):
+    """
+    LinGaoyuan_operation_20261018: sparse variant of FeatureVolume. The volume is split into blocks of block_size^3
+    voxels, only the blocks seen by at least min_views source views (and, if the target rays have a depth prior,
+    containing or next to a prior surface point) are built. The projection, the mean / var and the 3D regularization
+    run on the batch of occupied blocks, every block is padded with a halo of 4 / 2 / 1 voxels (level 0 / 1 / 2) so
+    the convolutions see their neighbourhood. The weights are the same as in FeatureVolume, checkpoints are interchangeable.
+    """
+
+    def __init__(self, volume_reso=100, block_size=20, min_views=1, contraction_type=None, prior_dilation=1):
+        super().__init__(volume_reso)
+        assert volume_reso % block_size == 0 and block_size % 2 ** (self.multlevel - 1) == 0, \
+            "block_size has to divide volume_reso and be divisible by {}".format(2 ** (self.multlevel - 1))
+        self.block_size = block_size
+        self.num_blocks = volume_reso // block_size
+        self.min_views = min_views
+        self.contraction_type = contraction_type
+        self.prior_dilation = prior_dilation
+        # halo of the coarsest level, doubled at every finer level to keep the levels aligned
+        self.halo = 1
+
+    def level_coords(self, level, idx):
+        'coordinates of (possibly out of range) voxel indices of a level, same spacing as self.xyz[level]'
+        return idx * (2 ** level) * 2 / (self.volume_reso - 1) - 1
+
+    def occupied_blocks(self, feats, source_poses, ray_batch):
+        """
+        return: [NBx NBy NBz] bool
+        """
+        level = self.multlevel - 1
+        volume_xyz_homo = self.get_volume_xyz_homo(level, source_poses)
+        _, mask = self.sample_views(feats[level], source_poses, volume_xyz_homo)
+        num_views = mask.sum(dim=1)[0]  # [XYZ]
+
+        n = self.xyz[level].shape[1]
+        visible = (num_views >= self.min_views).float().reshape(1, 1, n, n, n)
+        occupied = F.max_pool3d(visible, kernel_size=self.block_size // 2 ** level)[0, 0] > 0
+
+        depth_value = ray_batch.get("depth_value")
+        if depth_value is not None and "ray_o" in ray_batch:
+            pts = ray_batch["ray_o"] + ray_batch["ray_d"] * depth_value.reshape(-1, 1)
+            pts = contract_points(pts.float(), self.contraction_type)
+            voxel = ((pts + 1) * self.volume_reso - 1) / 2
+            block = torch.floor(voxel / self.block_size).long()
+            inside = ((block >= 0) & (block < self.num_blocks)).all(dim=-1)
+            block = block[inside]
+            prior = torch.zeros_like(occupied, dtype=torch.float32)
+            prior[block[:, 0], block[:, 1], block[:, 2]] = 1
+            if self.prior_dilation > 0:
+                kernel = 2 * self.prior_dilation + 1
+                prior = F.max_pool3d(prior[None, None], kernel_size=kernel, stride=1, padding=self.prior_dilation)[0, 0]
+            occupied = occupied & (prior > 0)
+        return occupied
+
+    def forward(self, feats, ray_batch):
+        """
+        feats: [B NV C H W], NV: number of views
+        return: SparseVolume
+        """
+        source_poses = self.source_poses(ray_batch)
+        occupied = self.occupied_blocks(feats, source_poses, ray_batch)
+        block_xyz = occupied.nonzero()  # [M 3] block index (x, y, z)
+        M = block_xyz.shape[0]
+
+        block_table = torch.full((self.num_blocks,) * 3, -1, dtype=torch.long, device=source_poses.device)
+        block_table[block_xyz[:, 2], block_xyz[:, 1], block_xyz[:, 0]] = torch.arange(M, device=source_poses.device)
+        if M == 0:
+            blocks = source_poses.new_zeros(0, self.volume_regularization.last.out_channels, *(self.block_size,) * 3)
+            return SparseVolume(blocks, block_table, self.volume_reso)
+
+        volume_mean_var_all = []
+        for i in range(len(feats)):
+            S = self.block_size // 2 ** i
+            halo = self.halo * 2 ** (self.multlevel - 1 - i)
+            n = S + 2 * halo
+            reso = self.xyz[i].shape[1]
+
+            # voxel indices of the padded blocks, [M n n n 3] (x, y, z)
+            offsets = torch.stack(torch.meshgrid(*[torch.arange(n, device=source_poses.device)] * 3, indexing='ij'), dim=-1)
+            idx = (block_xyz * S - halo)[:, None, None, None, :] + offsets[None]
+            inside = ((idx >= 0) & (idx < reso)).all(dim=-1).reshape(1, 1, -1)
+
+            volume_xyz = self.level_coords(i, idx.reshape(-1, 3).t().type_as(source_poses))  # [3 P]
+            volume_xyz_homo = torch.cat([volume_xyz, torch.ones_like(volume_xyz[0:1])], dim=0)
+            volume_feature, mask = self.sample_views(feats[i], source_poses, volume_xyz_homo)
+
+            'the dense volume is zero-padded outside the cube, so are the halo voxels outside of it'
+            volume_mean_var = self.mean_var(volume_feature, mask) * inside.type_as(volume_feature)  # [1 C P]
+            volume_mean_var = rearrange(volume_mean_var, "1 C (M NumX NumY NumZ) -> M C NumZ NumY NumX",
+                                        M=M, NumX=n, NumY=n, NumZ=n)
+            volume_mean_var_all.append(volume_mean_var)
+
+        # ---- step 4: 3D regularization of the occupied blocks -----------------
+        volume_mean_var_reg = self.volume_regularization(volume_mean_var_all)
+        halo = self.halo * 2 ** (self.multlevel - 1)
+        blocks = volume_mean_var_reg[:, :, halo:halo + self.block_size, halo:halo + self.block_size, halo:halo + self.block_size]
+        return SparseVolume(blocks, block_table, self.volume_reso)
+
+
+def build_feature_volume(args, volume_reso=100):
+    """
+    LinGaoyuan_operation_20261018: FeatureVolume, or SparseFeatureVolume if args.sparse_feature_volume
+    """
+    if getattr(args, "sparse_feature_volume", False):
+        return SparseFeatureVolume(volume_reso=volume_reso, block_size=args.feature_volume_block_size,
+                                   min_views=args.feature_volume_min_views, contraction_type=args.contraction_type)
+    return FeatureVolume(volume_reso=volume_reso)
@@ -51,6 +51,8 @@ class FullAttention(Module):
         super().__init__()
         self.use_dropout = use_dropout
         self.dropout = Dropout(attention_dropout)
+        'LinGaoyuan_operation_20261018: the attention map is only kept in self.A if store_attn is set by the consumer'
+        self.store_attn = False
 
     def forward(self, queries, keys, values, q_mask=None, kv_mask=None):
         """ Multi-head scaled dot-product attention, a.k.a full attention.
@@ -72,22 +74,86 @@ class FullAttention(Module):
 
         # Compute the attention and the weighted average
         softmax_temp = 1. / queries.size(3)**.5  # sqrt(D)
-        self.A = torch.softmax(softmax_temp * QK, dim=2)
-        if self.use_dropout:
-            A = self.dropout(self.A)
+        A = torch.softmax(softmax_temp * QK, dim=2)
+        if self.store_attn:
+            self.A = A
 
-        queried_values = torch.einsum("nlsh,nshd->nlhd", self.A, values)
+        queried_values = torch.einsum("nlsh,nshd->nlhd", A, values)
 
         return queried_values.contiguous()
 
 
 
+def banded_attention(queries, keys, values, window_size, num_global=0):
+    """ LinGaoyuan_operation_20261018: windowed (banded) scaled dot-product attention along the sequence,
+    every position attends to the positions at most window_size away and to the first num_global positions
+    (global tokens), the global tokens themselves attend to all positions. The cost is O(L * (2 * window_size + 1 + num_global))
+    instead of O(L * L).
+    Args:
+        queries: [N, L, H, D]
+        keys: [N, L, H, D]
+        values: [N, L, H, D]
+    Returns:
+        queried_values: (N, L, H, D)
+    """
+    L = queries.size(1)
+    softmax_temp = 1. / queries.size(3)**.5
+
+    # [N, L, H, D, 2w+1], unfold returns a view of the padded keys / values
+    keys_win = torch.nn.functional.pad(keys, (0, 0, 0, 0, window_size, window_size)).unfold(1, 2 * window_size + 1, 1)
+    values_win = torch.nn.functional.pad(values, (0, 0, 0, 0, window_size, window_size)).unfold(1, 2 * window_size + 1, 1)
+
+    # padded positions and global tokens (they have their own column) are excluded from the window
+    positions = torch.arange(L, device=queries.device)[:, None] - window_size + torch.arange(2 * window_size + 1, device=queries.device)[None]
+    valid = (positions >= num_global) & (positions < L)
+
+    QK = torch.einsum("nlhd,nlhdw->nlhw", queries, keys_win) * softmax_temp
+    QK = QK.masked_fill(~valid[None, :, None, :], float('-inf'))
+    if num_global > 0:
+        QG = torch.einsum("nlhd,nghd->nlhg", queries, keys[:, :num_global]) * softmax_temp
+        QK = torch.cat([QG, QK], dim=-1)
+    A = torch.softmax(QK, dim=-1)
+
+    queried_values = torch.einsum("nlhw,nlhdw->nlhd", A[..., num_global:], values_win)
+    if num_global > 0:
+        queried_values = queried_values + torch.einsum("nlhg,nghd->nlhd", A[..., :num_global], values[:, :num_global])
+
+        A_global = torch.softmax(torch.einsum("nghd,nshd->ngsh", queries[:, :num_global], keys) * softmax_temp, dim=2)
+        global_values = torch.einsum("ngsh,nshd->nghd", A_global, values)
+        queried_values = torch.cat([global_values, queried_values[:, num_global:]], dim=1)
+
+    return queried_values.contiguous()
+
+
+class WindowAttention(Module):
+    def __init__(self, window_size=16, num_global=1):
+        """
+        :param window_size: number of neighbours on each side every position attends to
+        :param num_global: the first num_global positions are global tokens (e.g. the RadianceToken of ReTR)
+        """
+        super().__init__()
+        self.window_size = window_size
+        self.num_global = num_global
+
+    def forward(self, queries, keys, values, q_mask=None, kv_mask=None):
+        """ Multi-head windowed attention, only for self attention (queries and keys have the same length), the masks are ignored.
+        Args:
+            queries: [N, L, H, D]
+            keys: [N, L, H, D]
+            values: [N, L, H, D]
+        Returns:
+            queried_values: (N, L, H, D)
+        """
+        return banded_attention(queries, keys, values, self.window_size, min(self.num_global, queries.size(1)))
+
+
 class CosineAttention(Module):
     def __init__(self, use_dropout=False, attention_dropout=0.1):
         super().__init__()
         self.use_dropout = use_dropout
         self.dropout = Dropout(attention_dropout)
         self.temp_scale = torch.nn.Parameter(torch.ones(1))
+        self.store_attn = False
 
     def cosine_similarity(self,queries,keys):
         queries = queries/queries.norm(dim=-1,keepdim=True)#[N, L, H, D]
@@ -114,11 +180,11 @@ class CosineAttention(Module):
             QK.masked_fill_(~(q_mask[:, :, :, None].bool()), float('-inf'))
 
         # Compute the attention and the weighted average
-        self.A = torch.softmax( QK /self.temp_scale, dim=2)
-        if self.use_dropout:
-            A = self.dropout(self.A)
+        A = torch.softmax( QK /self.temp_scale, dim=2)
+        if self.store_attn:
+            self.A = A
 
-        queried_values = torch.einsum("nlsh,nshd->nlhd", self.A, values)
+        queried_values = torch.einsum("nlsh,nshd->nlhd", A, values)
 
         return queried_values.contiguous()
 
@@ -128,6 +194,7 @@ class LearnedAttention(Module):
         self.use_dropout = use_dropout
         self.dropout = Dropout(attention_dropout)
         self.weighted_vector = torch.nn.Linear(2*dim,1)
+        self.store_attn = False
 
     def forward(self, queries, keys, values, q_mask=None, kv_mask=None):
         """ Multi-head scaled dot-product attention, a.k.a full attention.
@@ -142,11 +209,11 @@ class LearnedAttention(Module):
         """
         # Compute the unnormalized attention and apply the masks
         QK = torch.cat((queries.repeat(1,keys.shape[1],1,1), keys),dim=-1).permute(0,2,1,3)
-        self.A = torch.softmax(self.weighted_vector(QK), dim=2)
+        A = torch.softmax(self.weighted_vector(QK), dim=2)
 #        self.A = F.relu(self.weighted_vector(QK))
-        if self.use_dropout:
-            A = self.dropout(self.A)
+        if self.store_attn:
+            self.A = A
 
-        queried_values = torch.einsum("nlsh,nshd->nlhd", self.A, values)
+        queried_values = torch.einsum("nlsh,nshd->nlhd", A, values)
 
         return queried_values.contiguous()
\ No newline at end of file
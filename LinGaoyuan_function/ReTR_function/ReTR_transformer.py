@@ -1,17 +1,20 @@
 import copy
 import torch
 import torch.nn as nn
-from LinGaoyuan_function.ReTR_function.ReTR_linear_attention import LinearAttention, FullAttention, LearnedAttention,CosineAttention
+from LinGaoyuan_function.ReTR_function.ReTR_linear_attention import LinearAttention, FullAttention, LearnedAttention,CosineAttention, WindowAttention
 import numpy as np
 
-from LinGaoyuan_function.aliasing import exercute_aliasing_filter
+from LinGaoyuan_function.aliasing import exercute_aliasing_filter, build_aliasing_module
+from LinGaoyuan_function.gradient_checkpoint import run_block
 
 #Ref: https://github.com/zju3dv/LoFTR/blob/master/src/loftr/loftr_module/transformer.py
 class LoFTREncoderLayer(nn.Module):
     def __init__(self,
                  d_model,
                  nhead,
-                 attention='linear'):
+                 attention='linear',
+                 aliasing_filter_type=None,
+                 window_size=16):
         super(LoFTREncoderLayer, self).__init__()
 
         self.dim = d_model // nhead
@@ -29,6 +32,9 @@ class LoFTREncoderLayer(nn.Module):
             self.attention = CosineAttention()
         elif attention == 'full':
             self.attention = FullAttention()
+        elif attention == 'window':
+            'LinGaoyuan_operation_20261018: banded self attention along the ray, the first token (RadianceToken) is global'
+            self.attention = WindowAttention(window_size, num_global=1)
         self.merge = nn.Linear(d_model, d_model, bias=False)
         # feed-forward network
         self.mlp = nn.Sequential(
@@ -41,6 +47,9 @@ class LoFTREncoderLayer(nn.Module):
         self.norm1 = nn.LayerNorm(d_model)
         self.norm2 = nn.LayerNorm(d_model)
 
+        'LinGaoyuan_operation_20261018: the anti-aliasing module (fixed kernel or trainable CNN) is built once here instead of in every forward'
+        self.aliasing = build_aliasing_module(aliasing_filter_type, d_model)
+
     def order_posenc(self, d_hid, n_samples):
         def get_position_angle_vec(position):
             return [position / np.power(10000, 2 * (hid_j // 2) / d_hid) for hid_j in range(d_hid)]
@@ -73,7 +82,10 @@ class LoFTREncoderLayer(nn.Module):
         'LinGaoyuan_operation_20241023: add arm to retr model'
         if aliasing_filter is True:
             # aliasing_filter_type = 'filter bank' # 'filter bank' or 'single filter'
-            message = exercute_aliasing_filter(message,aliasing_filter_type)
+            if self.aliasing is not None and self.aliasing.filter_type == aliasing_filter_type:
+                message = self.aliasing(message)
+            else:
+                message = exercute_aliasing_filter(message,aliasing_filter_type)
 
 
 
@@ -87,21 +99,37 @@ class LoFTREncoderLayer(nn.Module):
 class LocalFeatureTransformer(nn.Module):
     """A Local Feature Transformer (LoFTR) module."""
 
-    def __init__(self, d_model, nhead, layer_names, attention):
+    def __init__(self, d_model, nhead, layer_names, attention, aliasing_filter_type=None, window_size=16):
         super(LocalFeatureTransformer, self).__init__()
 
         self.d_model = d_model
         self.nhead = nhead
         self.layer_names = layer_names
-        encoder_layer = LoFTREncoderLayer(d_model, nhead, attention)
+        encoder_layer = LoFTREncoderLayer(d_model, nhead, attention, aliasing_filter_type, window_size)
         self.layers = nn.ModuleList([copy.deepcopy(encoder_layer) for _ in range(len(self.layer_names))])
         self._reset_parameters()
 
+        'LinGaoyuan_operation_20261018: only the attention map of the cross layer (ray density) is kept, see pop_atten_weight()'
+        for layer, name in zip(self.layers, self.layer_names):
+            layer.attention.store_attn = name == 'cross'
+        self.atten_weight = None
+
+        '''
+        LinGaoyuan_operation_20261018: recompute the activations of the 'self' layers in backward, the 'cross' layer is
+        never checkpointed, it only has one query token per ray and its attention map is read as atten_weight
+        '''
+        self.grad_checkpoint = False
+
     def _reset_parameters(self):
         for p in self.parameters():
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
+    def pop_atten_weight(self):
+        'return the attention map of the last cross layer and release it from this module'
+        atten_weight, self.atten_weight = self.atten_weight, None
+        return atten_weight
+
     def forward(self, feat0, feat1=None, mask0=None, mask1=None, aliasing_filter = False, aliasing_filter_type = 'filter bank'):
         """
         Args:
@@ -114,12 +142,14 @@ class LocalFeatureTransformer(nn.Module):
 
         for layer, name in zip(self.layers, self.layer_names):
             if name == 'self':
-                feat0 = layer(feat0, feat0, mask0, mask0, aliasing_filter = aliasing_filter, aliasing_filter_type = aliasing_filter_type)
+                feat0 = run_block(layer, feat0, feat0, mask0, mask0, aliasing_filter = aliasing_filter, aliasing_filter_type = aliasing_filter_type,
+                                  use_checkpoint = self.grad_checkpoint)
                 # if feat1 is not None:
                 #     feat1 = layer(feat1, feat1, mask1, mask1)
             elif name == 'cross':
                 feat0 = layer(feat0, feat1, mask0, mask1)
                 self.atten_weight = layer.attention.A
+                layer.attention.A = None
                 # feat1 = layer(feat1, feat0, mask1, mask0)
             else:
                 raise KeyError
@@ -209,11 +239,21 @@ class LocalFeatureTransformer_improved(nn.Module):
         self.layers = nn.ModuleList([copy.deepcopy(encoder_layer) for _ in range(len(self.layer_names))])
         self._reset_parameters()
 
+        'LinGaoyuan_operation_20261018: only the attention map of the cross layer (ray density) is kept, see pop_atten_weight()'
+        for layer, name in zip(self.layers, self.layer_names):
+            layer.attention.store_attn = name == 'cross'
+        self.atten_weight = None
+
     def _reset_parameters(self):
         for p in self.parameters():
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
+    def pop_atten_weight(self):
+        'return the attention map of the last cross layer and release it from this module'
+        atten_weight, self.atten_weight = self.atten_weight, None
+        return atten_weight
+
     def forward(self, feat0, feat1=None, feat2=None, mask0=None, mask1=None):
         """
         Args:
@@ -232,6 +272,7 @@ class LocalFeatureTransformer_improved(nn.Module):
             elif name == 'cross':
                 feat0 = layer(feat0, feat1, feat2, mask0, mask1)
                 self.atten_weight = layer.attention.A
+                layer.attention.A = None
                 # feat1 = layer(feat1, feat0, mask1, mask0)
             else:
                 raise KeyError
@@ -14,6 +14,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.functional import conv2d, grid_sample, interpolate, pad as torch_pad
 from typing import List, Optional, Tuple, Union
+from functools import lru_cache
 
 'create a simple gaussian filter, use the same origin funtion as same as gaussian_filter_pytorch()'
 def single_gaussian_filter(kernel_size = (5, 5), sigma=(1.0, 1.0), typical_gaussian_blur = False):
@@ -241,8 +242,51 @@ class Downsample_PASA_group_softmax(nn.Module):
         sigma = sigma.permute(2,0,1,3).reshape((p//(self.kernel_size*self.kernel_size), self.kernel_size*self.kernel_size,n,c2,q)).permute(2,0,3,1,4)
 
         x = torch.sum(x*sigma, dim=3).reshape(n,c1,h,w)
+        if self.stride == 1:
+            return x
         return x[:,:,torch.arange(h)%self.stride==0,:][:,:,:,torch.arange(w)%self.stride==0]
 
+
+class PASAAliasingFilter(nn.Module):
+    '''
+    LinGaoyuan_operation_20261018: trainable anti-aliasing module (PASA) owned by the transformer layer, so its weights
+    are optimized and saved with the model.
+    The tokens [N, L, C] are filtered along L independently for each of the N rows (a ray for the view transformer),
+    C is the channel dimension of the conv, so the layout does not depend on the number of rays or samples and
+    replicate padding works for any L.
+    '''
+    def __init__(self, dim, kernel_size = 5, group = None):
+        super(PASAAliasingFilter, self).__init__()
+        self.filter_type = 'CNN'
+        if group is None:
+            group = 2 if dim % 2 == 0 else 1
+        if dim % group != 0:
+            raise ValueError(f"dim ({dim}) must be divisible by group ({group})")
+        self.pasa = Downsample_PASA_group_softmax(in_channels=dim, kernel_size=kernel_size, stride=1,
+                                                  pad_type='repl', group=group)
+
+    def forward(self, x: Tensor) -> Tensor:
+        '''
+        :param x: [N, L, C]
+        :return: [N, L, C]
+        '''
+        x = x.permute(0, 2, 1).unsqueeze(-1)  # [N, C, L, 1]
+        x = self.pasa(x)
+        return x.squeeze(-1).permute(0, 2, 1)
+
+
+def build_aliasing_module(filter_type, dim, kernel_size = 5):
+    '''
+    :param filter_type: 'filter bank', 'single filter', 'CNN' or None
+    :param dim: channel dimension of the tokens, only used by the CNN
+    :return: the anti-aliasing module of the layer or None
+    '''
+    if filter_type in ['filter bank', 'single filter']:
+        return AliasingFilter(filter_type, kernel_size)
+    if filter_type == 'CNN':
+        return PASAAliasingFilter(dim, kernel_size)
+    return None
+
 def get_filter_bank(kernel_size = 5, mean = [0.,0.], cov = [[4.,0.],[0.,4.]], rotation_angle = 30, scale = 0.3, eliptical = 0.5, device = "cuda",
                     gaussian_filter = Gaussian_filter()):
     '''
@@ -313,6 +357,55 @@ def aliasing_filter(filter_type = 'filter bank',kernel_size=5):
 
     return filter
 
+@lru_cache(maxsize=None)
+def _aliasing_kernel(filter_type = 'filter bank', kernel_size = 5) -> Tensor:
+    '''
+    the kernel only depends on (filter_type, kernel_size), it is evaluated once on the cpu and shared by all modules
+    :return: [kernel_size, kernel_size]
+    '''
+    if filter_type == 'filter bank':
+        kernel = get_filter_bank(kernel_size=kernel_size, mean=[0., 0.], cov=[[4.,0.],[0.,4.]], rotation_angle=30,
+                                 scale=0.3, eliptical=0.5, device="cpu")
+    elif filter_type == 'single filter':
+        'same kernel as torchvision.transforms.GaussianBlur(kernel_size, sigma=(2.0, 2.0)) used by single_gaussian_filter()'
+        kernel = F_t._get_gaussian_kernel2d([kernel_size, kernel_size], [2.0, 2.0], dtype=torch.float32,
+                                            device=torch.device("cpu"))
+    else:
+        raise ValueError(f"no fixed kernel for aliasing filter type: {filter_type}")
+    return kernel.to(torch.float32)
+
+
+class AliasingFilter(nn.Module):
+    '''
+    LinGaoyuan_operation_20261018: the fixed anti-aliasing kernel ('filter bank' or 'single filter') is computed once
+    and kept as a buffer, so it follows the owning module across devices and is applied with a single grouped conv.
+    The input is filtered the same way as exercute_aliasing_filter(): a 3D input [C, H, W] is treated as one image
+    with C channels.
+    '''
+    def __init__(self, filter_type = 'filter bank', kernel_size = 5):
+        super(AliasingFilter, self).__init__()
+        self.filter_type = filter_type
+        self.kernel_size = kernel_size
+        'not persistent: the kernel is fixed, checkpoints stay compatible with models that do not own the filter'
+        self.register_buffer("kernel", _aliasing_kernel(filter_type, kernel_size).clone(), persistent=False)
+
+    def forward(self, img: Tensor) -> Tensor:
+        need_squeeze = img.ndim < 4
+        if need_squeeze:
+            img = img.unsqueeze(dim=0)
+
+        channels = img.shape[-3]
+        weight = self.kernel.to(dtype=img.dtype).expand(channels, 1, self.kernel_size, self.kernel_size)
+
+        # padding = (left, right, top, bottom)
+        padding = [self.kernel_size // 2] * 4
+        img = conv2d(torch_pad(img, padding, mode="reflect"), weight, groups=channels)
+
+        if need_squeeze:
+            img = img.squeeze(dim=0)
+        return img
+
+
 def exercute_aliasing_filter(img: Tensor, filter_type = 'filter bank', kernel_size = 5, device="cuda") -> Tensor:
     if not (isinstance(img, torch.Tensor)):
         raise TypeError(f"img should be Tensor. Got {type(img)}")
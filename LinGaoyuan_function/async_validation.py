@@ -0,0 +1,145 @@
+import copy
+import queue
+import threading
+import torch
+import torch.nn as nn
+
+
+'''
+LinGaoyuan_operation_20261018: the validation views of the train loop are rendered from a snapshot of the weights in a
+thread on a side cuda stream, the train loop only copies the weights (device to device) and continues.
+'''
+
+
+def unwrap(net):
+    if isinstance(net, torch.nn.parallel.DistributedDataParallel):
+        return net.module
+    return net
+
+
+def shadow_copy(obj, net_names):
+    '''
+    :return: copy of obj (Model, SkyModel, ...) whose networks net_names are deep copies without DDP, the other
+    attributes (args, optimizers, ...) are shared with obj
+    '''
+    shadow = copy.copy(obj)
+    if isinstance(obj, nn.Module):
+        'copy.copy shares the module dicts, replacing a network of shadow must not replace the network of obj'
+        shadow._modules = obj._modules.copy()
+        shadow._parameters = obj._parameters.copy()
+        shadow._buffers = obj._buffers.copy()
+    for name in net_names:
+        net = getattr(obj, name, None)
+        if net is None:
+            continue
+        net = copy.deepcopy(unwrap(net))
+        for p in net.parameters():
+            p.grad = None
+            p.requires_grad_(False)
+        setattr(shadow, name, net)
+    return shadow
+
+
+@torch.no_grad()
+def copy_weights(shadow, obj, net_names):
+    'device to device copy of the weights (and buffers) of the networks net_names of obj into shadow'
+    for name in net_names:
+        net = getattr(obj, name, None)
+        if net is None:
+            continue
+        shadow_state = getattr(shadow, name).state_dict()
+        for k, v in unwrap(net).state_dict().items():
+            shadow_state[k].copy_(v, non_blocking=True)
+
+
+class AsyncValidation(object):
+    """
+    submit(jobs) copies the current weights of model and sky_model into their shadow copies and returns, a thread runs
+    the jobs with model=shadow model and sky_model=shadow sky model on its own cuda stream. While the jobs of the last
+    submit() are still running, submit() skips the new jobs instead of waiting, so the train loop never blocks.
+
+    The shadow copies need as much device memory as the weights of the trained networks.
+    """
+
+    def __init__(self, model, sky_model, scene_nets, sky_nets):
+        self.model = model
+        self.sky_model = sky_model
+        self.scene_nets = scene_nets
+        self.sky_nets = sky_nets
+        self.shadow_model = shadow_copy(model, scene_nets)
+        self.shadow_sky_model = shadow_copy(sky_model, sky_nets)
+
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self.busy = threading.Event()
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="async_validation", daemon=True)
+        self.thread.start()
+
+    def submit(self, jobs, step=None):
+        '''
+        :param jobs: callables job(model=..., sky_model=...), e.g. functools.partial of log_view. Their tensor
+        arguments must not be changed in place by the train loop afterwards (pass clones).
+        :return: False if the jobs are skipped because the last validation is still running
+        '''
+        self._raise_error()
+        if self.busy.is_set():
+            print("validation of step {} skipped, the last validation is still running".format(step))
+            return False
+        self.busy.set()
+
+        copy_weights(self.shadow_model, self.model, self.scene_nets)
+        copy_weights(self.shadow_sky_model, self.sky_model, self.sky_nets)
+        if hasattr(self.shadow_sky_model, "sky_texture"):
+            'the baked sky texture is from the previous weights'
+            self.shadow_sky_model.sky_texture = None
+
+        event = None
+        if self.stream is not None:
+            'the side stream starts after the weight copy and the inputs of the jobs are ready'
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((event, jobs))
+        return True
+
+    def wait(self):
+        'block until the submitted jobs are finished'
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("the asynchronous validation failed") from error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                event, jobs = item
+                if self.stream is not None:
+                    self.stream.wait_event(event)
+                    with torch.cuda.stream(self.stream):
+                        self._run_jobs(jobs)
+                    'the inputs of the jobs are released after the side stream is done with them'
+                    self.stream.synchronize()
+                else:
+                    self._run_jobs(jobs)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.busy.clear()
+                self.queue.task_done()
+
+    def _run_jobs(self, jobs):
+        for job in jobs:
+            job(model=self.shadow_model, sky_model=self.shadow_sky_model)
@@ -0,0 +1,140 @@
+import os
+import re
+import json
+import hashlib
+import torch
+
+
+'''
+LinGaoyuan_operation_20261018: manifest of the ckpts of an experiment folder (checkpoints.json), written by
+CheckpointWriter for every saved ckpt:
+{"model": {"100": {"file": "model_000100.pth", "keys": {"net_coarse": bytes, ...}, "size": bytes, "sha256": ...}}, ...}
+'''
+
+MANIFEST_NAME = "checkpoints.json"
+
+CKPT_PATTERN = re.compile(r"^(.*?)_?(\d+)\.pth$")
+
+
+def checkpoint_series(fpath):
+    '''
+    :return: series and step of a numbered ckpt ('sky_model_000100.pth' -> ('sky_model', 100)), None if not numbered
+    '''
+    match = CKPT_PATTERN.match(os.path.basename(fpath))
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+def checkpoint_step(fpath):
+    'step of a ckpt file, 0 if the file name has no step'
+    series = checkpoint_series(fpath)
+    return 0 if series is None else series[1]
+
+
+def tensor_bytes(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(tensor_bytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(tensor_bytes(v) for v in obj)
+    return 0
+
+
+def file_sha256(fpath, block_size=1 << 24):
+    sha = hashlib.sha256()
+    with open(fpath, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_manifest(out_folder):
+    fpath = os.path.join(out_folder, MANIFEST_NAME)
+    if not os.path.isfile(fpath):
+        return None
+    with open(fpath, "r") as f:
+        return json.load(f)
+
+
+def write_manifest(out_folder, manifest):
+    fpath = os.path.join(out_folder, MANIFEST_NAME)
+    with open(fpath + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(fpath + ".tmp", fpath)
+
+
+def add_to_manifest(out_folder, fpath, snapshot):
+    '''
+    :param snapshot: the object saved in fpath
+    '''
+    series = checkpoint_series(fpath)
+    if series is None:
+        return
+    name, step = series
+    manifest = read_manifest(out_folder) or {}
+    keys = {k: tensor_bytes(v) for k, v in snapshot.items()} if isinstance(snapshot, dict) else {}
+    manifest.setdefault(name, {})[str(step)] = {
+        "file": os.path.basename(fpath),
+        "keys": keys,
+        "size": os.path.getsize(fpath),
+        "sha256": file_sha256(fpath),
+    }
+    write_manifest(out_folder, manifest)
+
+
+def remove_from_manifest(out_folder, fpaths):
+    manifest = read_manifest(out_folder)
+    if manifest is None:
+        return
+    for fpath in fpaths:
+        series = checkpoint_series(fpath)
+        if series is not None and series[0] in manifest:
+            manifest[series[0]].pop(str(series[1]), None)
+    write_manifest(out_folder, manifest)
+
+
+def latest_checkpoint(out_folder, series):
+    '''
+    :param series: 'model' or 'sky_model'
+    :return: path of the ckpt of the series with the largest step, None if there is none. The manifest is used if the
+    folder has one, otherwise the numbered files of the series are listed.
+    '''
+    if not os.path.exists(out_folder):
+        return None
+
+    manifest = read_manifest(out_folder)
+    if manifest is not None and len(manifest.get(series, {})) > 0:
+        for step in sorted(manifest[series], key=int, reverse=True):
+            fpath = os.path.join(out_folder, manifest[series][step]["file"])
+            if os.path.isfile(fpath):
+                return fpath
+
+    ckpts = []
+    for f in os.listdir(out_folder):
+        match = checkpoint_series(f)
+        if match is not None and match[0] == series:
+            ckpts.append((match[1], f))
+    if len(ckpts) == 0:
+        return None
+    return os.path.join(out_folder, max(ckpts)[1])
+
+
+def load_checkpoint(fpath, skip_keys=()):
+    '''
+    load a ckpt memory-mapped on the cpu, the entries in skip_keys (e.g. optimizer and scheduler state) are never
+    read from the file. load_state_dict() copies the tensors to the device of the parameters.
+    '''
+    try:
+        to_load = torch.load(fpath, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        'torch < 2.1 has no mmap, ckpts in the legacy (non zip) format can not be memory-mapped'
+        to_load = torch.load(fpath, map_location="cpu")
+    for k in skip_keys:
+        to_load.pop(k, None)
+    return to_load
+
+
+def skipped_state_keys(load_opt, load_scheduler, optimizer_keys=("optimizer",), scheduler_keys=("scheduler",)):
+    return (tuple() if load_opt else tuple(optimizer_keys)) + (tuple() if load_scheduler else tuple(scheduler_keys))
@@ -0,0 +1,169 @@
+import os
+import time
+import queue
+import threading
+import torch
+
+from LinGaoyuan_function.checkpoint_manifest import checkpoint_series, add_to_manifest, remove_from_manifest
+
+
+'LinGaoyuan_operation_20261018: checkpoints are copied to host memory in the training loop and written to disk in a thread'
+
+
+def snapshot_to_cpu(obj, pinned=None):
+    '''
+    copy of obj (nested dicts / lists / tuples of tensors, e.g. state dicts) with every tensor copied to host memory,
+    later in-place updates of the training do not change the snapshot. The copies of cuda tensors are asynchronous,
+    the caller records a cuda event after snapshot_to_cpu() and waits for it before reading the snapshot.
+    :param pinned: dict of the pinned host tensors of the previous snapshot of the same structure, they are reused if
+    their shape and dtype still match and replaced otherwise. None allocates new pinned tensors.
+    '''
+    return _snapshot_to_cpu(obj, pinned, ())
+
+
+def _snapshot_to_cpu(obj, pinned, path):
+    if isinstance(obj, torch.Tensor):
+        if obj.is_cuda:
+            out = None if pinned is None else pinned.get(path)
+            if out is None or out.shape != obj.shape or out.dtype != obj.dtype:
+                out = torch.empty(obj.shape, dtype=obj.dtype, device="cpu", pin_memory=True)
+                if pinned is not None:
+                    pinned[path] = out
+            return out.copy_(obj.detach(), non_blocking=True)
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, _snapshot_to_cpu(v, pinned, path + (k,))) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot_to_cpu(v, pinned, path + (i,)) for i, v in enumerate(obj))
+    return obj
+
+
+class SnapshotSlot(object):
+    'pinned host tensors of the snapshots of one checkpoint series, free is set while no snapshot of it is queued'
+
+    def __init__(self):
+        self.pinned = {}
+        self.free = threading.Event()
+        self.free.set()
+
+
+class CheckpointWriter(object):
+    """
+    save(obj, filename) snapshots obj to host memory and returns, a background thread serialises the snapshot to
+    filename + '.tmp' and renames it to filename, so a checkpoint file is never seen half written (the '.tmp' files do
+    not match the '.pth' filter of load_from_ckpt).
+
+    Numbered checkpoints ('model_000100.pth', 'sky_model_000100.pth', ...) are recorded in the manifest of out_folder
+    (checkpoint_manifest.py) and pruned to the last keep_last files of their series (0 keeps all of them).
+
+    The snapshot of a series ('model', 'sky_model', or the file name of an unnumbered file) is copied into pinned host
+    tensors that are allocated on its first save and reused by the next ones, they stay allocated until close(). The
+    training loop does not synchronize the device, the writer waits for a cuda event recorded after the copies.
+    """
+
+    def __init__(self, out_folder, keep_last=0, background=True, verbose=True):
+        self.out_folder = out_folder
+        self.keep_last = keep_last
+        self.background = background
+        self.verbose = verbose
+        self.error = None
+        self.slots = {}
+
+        self.queue = queue.Queue()
+        self.thread = None
+        if self.background:
+            self.thread = threading.Thread(target=self._run, name="checkpoint_writer", daemon=True)
+            self.thread.start()
+
+    def save(self, obj, filename):
+        '''
+        :return: time spent in the training loop to snapshot obj
+        '''
+        self._raise_error()
+        time0 = time.time()
+        series = checkpoint_series(filename)
+        key = series[0] if series is not None else os.path.basename(filename)
+        if key not in self.slots:
+            self.slots[key] = SnapshotSlot()
+        slot = self.slots[key]
+        'the pinned tensors are overwritten only after the last snapshot of the series is on disk'
+        slot.free.wait()
+        slot.free.clear()
+
+        snapshot = snapshot_to_cpu(obj, slot.pinned)
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+        snapshot_time = time.time() - time0
+
+        if self.background:
+            self.queue.put((snapshot, filename, snapshot_time, event, slot))
+        else:
+            self._write(snapshot, filename, snapshot_time, event, slot)
+        return snapshot_time
+
+    def wait(self):
+        'block until every queued checkpoint is on disk'
+        if self.background:
+            self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.slots = {}
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing a checkpoint failed") from error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, snapshot, filename, snapshot_time, event, slot):
+        time0 = time.time()
+        try:
+            if event is not None:
+                event.synchronize()
+            tmp_filename = filename + ".tmp"
+            torch.save(snapshot, tmp_filename)
+            os.replace(tmp_filename, filename)
+        finally:
+            slot.free.set()
+        persist_time = time.time() - time0
+
+        series = checkpoint_series(filename)
+        if series is not None:
+            add_to_manifest(self.out_folder, filename, snapshot)
+            self.prune(series[0])
+        if self.verbose:
+            print("checkpoint {}: snapshot {:.3f} s (training loop), persist {:.3f} s ({})".format(
+                os.path.basename(filename), snapshot_time, persist_time,
+                "background" if self.background else "training loop"))
+
+    def prune(self, series):
+        if self.keep_last <= 0:
+            return
+        ckpts = []
+        for f in os.listdir(self.out_folder):
+            match = checkpoint_series(f)
+            if match is not None and match[0] == series:
+                ckpts.append((match[1], f))
+        removed = [os.path.join(self.out_folder, f) for _, f in sorted(ckpts)[:-self.keep_last]]
+        for fpath in removed:
+            os.remove(fpath)
+        remove_from_manifest(self.out_folder, removed)
@@ -149,11 +149,9 @@ class Embedder(nn.Module):
         self.create_embedding_fn()
 
     def create_embedding_fn(self):
-        embed_fns = []
         d = self.kwargs["input_dims"]
         out_dim = 0
         if self.kwargs["include_input"]:
-            embed_fns.append(lambda x: x)
             out_dim += d
 
         max_freq = self.kwargs["max_freq_log2"]
@@ -164,16 +162,25 @@ class Embedder(nn.Module):
         else:
             freq_bands = torch.linspace(2.0**0.0, 2.0**max_freq, steps=N_freqs)
 
-        for freq in freq_bands:
-            for p_fn in self.kwargs["periodic_fns"]:
-                embed_fns.append(lambda x, p_fn=p_fn, freq=freq: p_fn(x * freq))
-                out_dim += d
+        self.periodic_fns = self.kwargs["periodic_fns"]
+        out_dim += N_freqs * len(self.periodic_fns) * d
 
-        self.embed_fns = embed_fns
+        'LinGaoyuan_operation_20261018: not persistent, the state dict stays the same as the one of the lambda version'
+        self.register_buffer("freq_bands", freq_bands, persistent=False)
         self.out_dim = out_dim
 
     def forward(self, inputs):
-        return torch.cat([fn(inputs) for fn in self.embed_fns], -1)
+        """
+        same output order as the concatenation of [x, p_fn_0(x * f_0), p_fn_1(x * f_0), p_fn_0(x * f_1), ...]
+        :param inputs: [..., input_dims]
+        :return: [..., out_dim]
+        """
+        x_freq = inputs[..., None, :] * self.freq_bands[:, None]  # [..., N_freqs, input_dims]
+        embed = torch.stack([p_fn(x_freq) for p_fn in self.periodic_fns], dim=-2)  # [..., N_freqs, n_fns, input_dims]
+        embed = embed.reshape(list(inputs.shape[:-1]) + [-1])
+        if self.kwargs["include_input"]:
+            embed = torch.cat([inputs, embed], dim=-1)
+        return embed
 
 
 def Loss_clip(clip_model, clip_preprocess, input_img, rendered_img, device):
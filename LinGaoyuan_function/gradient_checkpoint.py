@@ -0,0 +1,27 @@
+import functools
+import torch
+from torch.utils.checkpoint import checkpoint
+
+
+'LinGaoyuan_operation_20261018: activation checkpointing of single transformer blocks'
+
+
+def use_block_checkpoint(layer_idx, num_checkpoint_layers):
+    '''
+    :param layer_idx: index of the block in its stack, counted from the input
+    :param num_checkpoint_layers: number of blocks that are checkpointed, -1 means all blocks, 0 disables checkpointing
+    '''
+    if num_checkpoint_layers < 0:
+        return True
+    return layer_idx < num_checkpoint_layers
+
+
+def run_block(block, *inputs, use_checkpoint=False, **kwargs):
+    '''
+    run block(*inputs, **kwargs), if use_checkpoint is True the activations inside the block are not kept for the
+    backward pass but recomputed from the inputs, this trades one extra forward of the block for its activation memory.
+    Checkpointing is skipped when autograd is disabled (validation / rendering), there is nothing to save there.
+    '''
+    if not use_checkpoint or not torch.is_grad_enabled():
+        return block(*inputs, **kwargs)
+    return checkpoint(functools.partial(block, **kwargs), *inputs, use_reentrant=False)
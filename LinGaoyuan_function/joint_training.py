@@ -0,0 +1,113 @@
+import collections
+import torch
+import torch.nn as nn
+
+
+'LinGaoyuan_operation_20261018: one optimizer, one backward pass and one DDP module for the scene and the sky model'
+
+SCENE_NETS = ["net_coarse", "net_fine", "feature_net", "retr_feature_extractor", "retr_feature_volume"]
+
+
+def scene_networks(args, model):
+    '''
+    :return: names of the networks of Model that the training step uses. DDP expects a gradient for every registered
+    parameter, net_fine exists with --single_net False but is only called if N_importance > 0
+    '''
+    names = []
+    for name in SCENE_NETS:
+        if getattr(model, name, None) is None:
+            continue
+        if name == "net_fine" and args.N_importance <= 0:
+            continue
+        names.append(name)
+    return names
+
+
+class JointTrainingModule(nn.Module):
+    """
+    container of all trained networks of Model and of the sky model. It is wrapped in DistributedDataParallel as a
+    whole, so the gradients of every network are reduced in the same buckets after the single backward pass instead
+    of one allreduce per network. The networks must not be wrapped in DDP themselves (ddp_wrap=False).
+    Only the networks in net_names are registered, every registered parameter must be used by the step.
+    """
+
+    def __init__(self, model, sky_model, net_names):
+        super().__init__()
+        self.scene = nn.ModuleDict({name: getattr(model, name) for name in net_names})
+        self.sky = sky_model
+
+    def forward(self, step_fn, *inputs, **kwargs):
+        '''
+        :param step_fn: forward pass of the training step (feature extraction + render_rays), it runs inside the
+        DDP forward so that DDP knows the step outputs, it may only use the networks registered in this module
+        '''
+        return step_fn(*inputs, **kwargs)
+
+
+def wrap_joint_module(args, model, sky_model):
+    module = JointTrainingModule(model, sky_model, scene_networks(args, model))
+    if args.distributed:
+        module = torch.nn.parallel.DistributedDataParallel(
+            module, device_ids=[args.local_rank], output_device=args.local_rank
+        )
+    return module
+
+
+class JointOptimizer(object):
+    """
+    single Adam over the parameter groups of the optimizers of Model and of the sky model.
+
+    The group dicts are shared with the original optimizers, so their schedulers still set the learning rates and
+    keep their own decay steps. The original optimizers are never stepped, sync_state() copies the Adam state back
+    to them before their owner saves a checkpoint, so the checkpoint format does not change.
+    """
+
+    def __init__(self, optimizers):
+        self.optimizers = optimizers
+        self.optimizer = torch.optim.Adam([group for opt in optimizers for group in opt.param_groups])
+        'state loaded from the checkpoints of the single models'
+        for opt in optimizers:
+            self.optimizer.state.update(opt.state)
+
+    def zero_grad(self, set_to_none=True):
+        self.optimizer.zero_grad(set_to_none=set_to_none)
+
+    def step(self, grad_scaler=None):
+        if grad_scaler is None:
+            self.optimizer.step()
+        else:
+            grad_scaler.step(self.optimizer)
+
+    def sync_state(self):
+        for opt in self.optimizers:
+            opt.state = collections.defaultdict(dict, {
+                p: self.optimizer.state[p] for group in opt.param_groups for p in group["params"]
+                if p in self.optimizer.state
+            })
+
+
+def sky_optimizers(args, sky_model):
+    if args.sky_model_type == 'mlp':
+        return [sky_model.sky_optimizer, sky_model.sky_style_optimizer]
+    return [sky_model.optimizer]
+
+
+def sky_networks(args):
+    if args.sky_model_type == 'mlp':
+        return ["sky_model", "sky_style_model"]
+    return ["sky_transformer"]
+
+
+def sky_schedulers(args, sky_model):
+    if args.sky_model_type == 'mlp':
+        return [sky_model.sky_scheduler, sky_model.sky_style_scheduler]
+    return [sky_model.scheduler]
+
+
+def set_grad_sync(module, sync):
+    '''
+    gradient accumulation: the DDP module skips the gradient allreduce of the backward passes with sync=False,
+    same as module.no_sync() but without a context around the forward and backward pass
+    '''
+    if isinstance(module, torch.nn.parallel.DistributedDataParallel):
+        module.require_backward_grad_sync = sync
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import queue
+import threading
+import collections
+import contextlib
+import torch
+
+from utils import mse2psnr
+from LinGaoyuan_function.checkpoint_writer import snapshot_to_cpu
+
+
+'''
+LinGaoyuan_operation_20261018: metric logging of the train loop without .item(). The losses are summed on the device
+by MetricAccumulator, flush() starts a non-blocking copy of the sums to pinned host memory and hands them to
+MetricSink, whose thread waits for the copy and writes the averages to metrics.jsonl and / or tensorboard.
+'''
+
+# metrics given as mse, their psnr is added to the record
+PSNR_METRICS = {"train/coarse-loss": "train/coarse-psnr", "train/fine-loss": "train/fine-psnr"}
+
+
+class MetricAccumulator(object):
+    """
+    running sums of the metrics of the steps since the last flush(). Tensors stay on their device, python numbers
+    (e.g. number of rays, learning rates) are summed on the host.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sums = collections.OrderedDict()
+        self.host_sums = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        self.totals = collections.OrderedDict()
+        self.num_steps = 0
+        self.time0 = time.time()
+
+    def add(self, name, value):
+        '''
+        the metric is averaged over the add() calls of the interval, value is a scalar tensor or a python number
+        '''
+        if value is None:
+            return
+        if isinstance(value, torch.Tensor):
+            value = value.detach().float().reshape(())
+            if name in self.sums:
+                self.sums[name] += value
+            else:
+                self.sums[name] = value.clone()
+        else:
+            self.host_sums[name] = self.host_sums.get(name, 0.0) + float(value)
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def count(self, name, n):
+        'n is added to the total of name, the total is reported per second (e.g. rays -> rays/sec)'
+        self.totals[name] = self.totals.get(name, 0) + n
+
+    def step(self):
+        self.num_steps += 1
+
+    @contextlib.contextmanager
+    def paused(self):
+        'the time of the enclosed code (e.g. validation rendering) is not counted for the per second metrics'
+        time0 = time.time()
+        try:
+            yield
+        finally:
+            self.time0 += time.time() - time0
+
+    def flush(self, step, **info):
+        '''
+        :param info: python values written as they are, e.g. epoch
+        :return: PendingMetrics of the interval, the accumulator is reset. No device synchronization.
+        '''
+        elapsed = time.time() - self.time0
+        names = list(self.sums.keys())
+        values, event = None, None
+        if len(names) > 0:
+            values = torch.stack([self.sums[name] for name in names])
+            if values.is_cuda:
+                values = snapshot_to_cpu(values)
+                event = torch.cuda.Event()
+                event.record()
+
+        pending = PendingMetrics(
+            step, info, names, values, event,
+            host_sums=self.host_sums, counts=self.counts, totals=self.totals,
+            num_steps=self.num_steps, elapsed=elapsed,
+        )
+        self.reset()
+        return pending
+
+
+class PendingMetrics(object):
+    def __init__(self, step, info, names, values, event, host_sums, counts, totals, num_steps, elapsed):
+        self.step = step
+        self.info = info
+        self.names = names
+        self.values = values
+        self.event = event
+        self.host_sums = host_sums
+        self.counts = counts
+        self.totals = totals
+        self.num_steps = num_steps
+        self.elapsed = elapsed
+
+    def resolve(self):
+        '''
+        :return: record {"step": ..., **info, metric: average, ...}, blocks until the copy of the sums is finished
+        '''
+        if self.event is not None:
+            self.event.synchronize()
+        record = collections.OrderedDict(step=self.step)
+        record.update(self.info)
+        if self.values is not None:
+            for name, value in zip(self.names, self.values.tolist()):
+                record[name] = value / self.counts[name]
+        for name, value in self.host_sums.items():
+            record[name] = value / self.counts[name]
+        for name, psnr_name in PSNR_METRICS.items():
+            if name in record:
+                record[psnr_name] = float(mse2psnr(record[name]))
+        elapsed = max(self.elapsed, 1e-9)
+        for name, total in self.totals.items():
+            record["{}/sec".format(name)] = total / elapsed
+        record["time/step_sec"] = elapsed / max(self.num_steps, 1)
+        return record
+
+
+class MetricSink(object):
+    """
+    writes the records of PendingMetrics in a thread, as lines of out_folder/metrics.jsonl ('jsonl'), as tensorboard
+    scalars in out_folder/tensorboard ('tensorboard') or both ('both'), and prints them if verbose.
+    """
+
+    def __init__(self, out_folder, sink="jsonl", verbose=True, prefix=""):
+        self.verbose = verbose
+        self.prefix = prefix
+        self.error = None
+
+        self.jsonl_file = None
+        if sink in ("jsonl", "both"):
+            self.jsonl_file = open(os.path.join(out_folder, "metrics.jsonl"), "a")
+        self.tb_writer = None
+        if sink in ("tensorboard", "both"):
+            from torch.utils.tensorboard import SummaryWriter
+            self.tb_writer = SummaryWriter(os.path.join(out_folder, "tensorboard"))
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="metric_sink", daemon=True)
+        self.thread.start()
+
+    def write(self, pending):
+        self._raise_error()
+        self.queue.put(pending)
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.jsonl_file is not None:
+            self.jsonl_file.close()
+        if self.tb_writer is not None:
+            self.tb_writer.close()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing the metrics failed") from error
+
+    def _run(self):
+        while True:
+            pending = self.queue.get()
+            try:
+                if pending is None:
+                    return
+                self._write(pending.resolve())
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, record):
+        if self.jsonl_file is not None:
+            self.jsonl_file.write(json.dumps(record) + "\n")
+            self.jsonl_file.flush()
+        if self.tb_writer is not None:
+            for name, value in record.items():
+                if name != "step" and isinstance(value, (int, float)):
+                    self.tb_writer.add_scalar(name, value, record["step"])
+            self.tb_writer.flush()
+        if self.verbose:
+            print(self.prefix + " ".join(
+                "{}: {:.6f}".format(k, v) if isinstance(v, float) else "{}: {}".format(k, v) for k, v in record.items()
+            ))
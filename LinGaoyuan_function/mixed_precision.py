@@ -0,0 +1,70 @@
+import functools
+import contextlib
+import torch
+
+
+'LinGaoyuan_operation_20261018: helper functions of the mixed precision (--amp) mode'
+
+AMP_DTYPES = {"none": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def get_amp_dtype(args, device):
+    '''
+    :return: the autocast dtype selected by args.amp, None if mixed precision is disabled
+    '''
+    dtype = AMP_DTYPES[getattr(args, "amp", "none")]
+    if dtype == torch.float16 and torch.device(device).type == "cpu":
+        print("fp16 autocast is not supported on cpu, use bf16 instead")
+        dtype = torch.bfloat16
+    return dtype
+
+
+def autocast(args, device):
+    '''
+    autocast context of the forward pass (feature extractor, projector sampling, transformers and losses),
+    a no-op context if args.amp is 'none'
+    '''
+    dtype = get_amp_dtype(args, device)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+
+def make_grad_scaler(args, device):
+    '''
+    loss scaling is only needed for fp16, for bf16 and fp32 the returned scaler is disabled and
+    scale() / step() / update() fall through to the plain loss and optimizer
+    '''
+    enabled = get_amp_dtype(args, device) == torch.float16 and torch.device(device).type == "cuda"
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def autocast_disabled():
+    '''
+    float32 region inside an autocast context, the inputs of the region have to be cast to float32 by the caller
+    '''
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.autocast(device_type="cpu", enabled=False))
+    if torch.cuda.is_available():
+        stack.enter_context(torch.autocast(device_type="cuda", enabled=False))
+    return stack
+
+
+def _to_float32(x):
+    if isinstance(x, torch.Tensor) and torch.is_floating_point(x) and x.dtype != torch.float32:
+        return x.float()
+    return x
+
+
+def float32_function(fn):
+    '''
+    decorator for numerically sensitive functions (sample_pdf, cumprod of the transmittance, ...):
+    floating point tensor arguments are cast to float32 and autocast is disabled inside the function
+    '''
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        args = [_to_float32(a) for a in args]
+        kwargs = {k: _to_float32(v) for k, v in kwargs.items()}
+        with autocast_disabled():
+            return fn(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,41 @@
+import torch
+
+
+'LinGaoyuan_operation_20261018: training batches with several target views (--num_target_views)'
+
+
+def split_target_views(train_data):
+    '''
+    :param train_data: batch of the train loader with B target views, each with its own source views
+    :return: list of B batches in the format of the batch_size=1 loader (RaySamplerSingleImage, Projector)
+    '''
+    num_views = len(train_data["camera"])
+    views = []
+    for b in range(num_views):
+        view = {}
+        for k, v in train_data.items():
+            if isinstance(v, (torch.Tensor, list, tuple)) and len(v) == num_views:
+                view[k] = v[b : b + 1]
+            else:
+                view[k] = v
+        views.append(view)
+    return views
+
+
+def stack_source_views(ray_batches):
+    '''
+    :return: source images of all target views as one [B * n_views, 3, h, w] batch for the feature extractor
+    '''
+    return torch.cat([ray_batch["src_rgbs"].squeeze(0) for ray_batch in ray_batches], dim=0).permute(0, 3, 1, 2)
+
+
+def select_source_views(features, start, end):
+    '''
+    :param features: output of the feature extractor for stack_source_views(), a tensor or nested tuples / lists of them
+    :return: the same structure with the source views start:end of one target view
+    '''
+    if isinstance(features, torch.Tensor):
+        return features[start:end]
+    if isinstance(features, (tuple, list)):
+        return type(features)(select_source_views(f, start, end) for f in features)
+    return features
@@ -7,6 +7,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 import os
 
+from LinGaoyuan_function.checkpoint_manifest import latest_checkpoint, checkpoint_step, load_checkpoint, skipped_state_keys
+
 
 
 class StyleMLP(nn.Module):
@@ -94,12 +96,47 @@ class SKYMLP(nn.Module):
 
         return c
 
+class SkyTexture(object):
+    """
+    LinGaoyuan_operation_20261018: sky color baked for one style code. The sky network gets the unnormalised ray_d,
+    the texture is indexed by longitude, latitude (equirectangular) and the length of ray_d, the lookup is a trilinear
+    grid_sample.
+    """
+
+    def __init__(self, texture, style_code, max_scale, black_background):
+        """
+        :param texture: [1, 3, num_scales, H, 2H]
+        :param style_code: output of the style network for the baked code
+        """
+        self.texture = texture
+        self.style_code = style_code
+        self.max_scale = max_scale
+        self.black_background = black_background
+        'the style code the texture was baked for, set by SkyModel.get_sky_texture()'
+        self.sky_style_code = None
+
+    def __call__(self, ray_d, sky_mask):
+        scale = ray_d.norm(dim=-1, keepdim=True)
+        d = ray_d / scale
+        u = torch.atan2(d[:, 1], d[:, 0]) / np.pi
+        v = torch.asin(d[:, 2].clamp(-1.0, 1.0)) / (np.pi / 2)
+        w = (scale[:, 0] - 1.0) / max(self.max_scale - 1.0, 1e-6) * 2 - 1
+        grid = torch.stack([u, v, w], dim=-1).view(1, 1, 1, -1, 3).type_as(self.texture)
+
+        rgb = F.grid_sample(self.texture, grid, mode='bilinear', padding_mode='border', align_corners=True)
+        rgb = rgb.view(3, -1).t()
+        return rgb * (1.0 - sky_mask) + self.black_background * (sky_mask)
+
+
 class SkyModel(nn.Module):
-    def __init__(self, args, style_dims=128, load_opt=True, load_scheduler=True):
+    def __init__(self, args, style_dims=128, load_opt=True, load_scheduler=True, ddp_wrap=True):
         super().__init__()
         self.args = args
         device = torch.device("cuda:{}".format(args.local_rank))
 
+        'baked sky texture of the last style code used in eval mode, see get_sky_texture()'
+        self.sky_texture = None
+
         self.sky_model = SKYMLP(in_channels = 3, style_dim=style_dims).to(device)
         self.sky_style_model = StyleMLP(style_dim = style_dims, out_dim = style_dims).to(device)
 
@@ -114,7 +151,8 @@ class SkyModel(nn.Module):
             gamma=args.lrate_decay_factor_sky_style_model
         )
 
-        if args.distributed:
+        'LinGaoyuan_operation_20261018: ddp_wrap is False if the sky model is wrapped together with Model (JointTrainingModule)'
+        if args.distributed and ddp_wrap:
             self.sky_model = torch.nn.parallel.DistributedDataParallel(
                 self.sky_model, device_ids=[args.local_rank], output_device=args.local_rank
             )
@@ -132,21 +170,79 @@ class SkyModel(nn.Module):
 
 
     def forward(self, ray_d, sky_style_code, sky_mask):
-        ray_d = ray_d.cuda()
+        sky_style_code = self.map_style(sky_style_code)
+
+        rgb_sky = self.render(ray_d, sky_style_code, sky_mask)
+
+        return rgb_sky, sky_style_code
 
+    def map_style(self, sky_style_code):
+        """
+        LinGaoyuan_operation_20261018: the style mapping does not depend on the rays, it is run once per step / image
+        and the result is shared by all chunks through render()
+        :return: mapped style code, the input of render()
+        """
         sky_style_code = self.sky_style_model(sky_style_code)
 
         self.sky_style_code = sky_style_code
 
+        return sky_style_code
+
+    def render(self, ray_d, sky_style_code, sky_mask):
+        """
+        :param sky_style_code: output of map_style()
+        """
+        ray_d = ray_d.cuda()
+
         skynet_out_color = self.sky_model(ray_d, sky_style_code)
 
         skynet_out_c = skynet_out_color * (1.0 - sky_mask) + self.black_background * (sky_mask)
 
         rgb_sky = skynet_out_c
 
-        return rgb_sky, sky_style_code
+        return rgb_sky
 
-    def save_model(self, filename):
+    @torch.no_grad()
+    def bake_texture(self, sky_style_code, resolution=256, num_scales=8, max_scale=2.0, chunk_size=65536):
+        """
+        LinGaoyuan_operation_20261018: evaluate the sky network on a (ray_d length, latitude, longitude) grid
+        :param resolution: height of the equirectangular texture, the width is 2 * resolution
+        :param num_scales: number of ray_d length layers in [1, max_scale], |ray_d| >= 1 since the camera z of ray_d is 1
+        :return: SkyTexture
+        """
+        device = sky_style_code.device
+        style_code = self.map_style(sky_style_code)
+
+        scale = torch.linspace(1.0, max_scale, num_scales, device=device)
+        lat = torch.linspace(-np.pi / 2, np.pi / 2, resolution, device=device)
+        lon = torch.linspace(-np.pi, np.pi, 2 * resolution, device=device)
+        scale, lat, lon = torch.meshgrid(scale, lat, lon, indexing='ij')
+        ray_d = torch.stack([lat.cos() * lon.cos(), lat.cos() * lon.sin(), lat.sin()], dim=-1) * scale[..., None]
+        ray_d = ray_d.reshape(-1, 3)
+
+        color = torch.cat([self.sky_model(ray_d[i:i + chunk_size], style_code)
+                           for i in range(0, ray_d.shape[0], chunk_size)], dim=0)
+        texture = color.t().reshape(1, 3, num_scales, resolution, 2 * resolution).contiguous()
+        return SkyTexture(texture, style_code, max_scale, self.black_background.to(device))
+
+    def get_sky_texture(self, sky_style_code):
+        """
+        :return: the SkyTexture of sky_style_code, it is baked again if the value of the code changed. A change of the
+        weights is not detected, the texture is cleared (sky_texture = None) in switch_to_train(), load_model() and
+        before the validation views of the train loop. The comparison of the codes synchronizes with the device, call
+        it once per image (render_single_image) and pass the texture to the chunks
+        """
+        if self.sky_texture is None or not torch.equal(self.sky_texture.sky_style_code, sky_style_code):
+            self.sky_texture = self.bake_texture(sky_style_code, resolution=self.args.sky_texture_resolution,
+                                                 num_scales=self.args.sky_texture_scales,
+                                                 max_scale=self.args.sky_texture_max_scale)
+            self.sky_texture.sky_style_code = sky_style_code.detach().clone()
+        return self.sky_texture
+
+    def save_model(self, filename, checkpoint_writer=None):
+        '''
+        :param checkpoint_writer: CheckpointWriter, if not None the file is written in its background thread
+        '''
         to_save = {
             "sky_optimizer": self.sky_optimizer.state_dict(),
             "sky_scheduler": self.sky_scheduler.state_dict(),
@@ -157,13 +253,16 @@ class SkyModel(nn.Module):
             "sky_style_code": self.sky_style_code,
         }
 
-        torch.save(to_save, filename)
+        if checkpoint_writer is not None:
+            checkpoint_writer.save(to_save, filename)
+        else:
+            torch.save(to_save, filename)
 
     def load_model(self, filename, load_opt=True, load_scheduler=True):
-        if self.args.distributed:
-            to_load = torch.load(filename, map_location="cuda:{}".format(self.args.local_rank))
-        else:
-            to_load = torch.load(filename)
+        'LinGaoyuan_operation_20261018: memory-mapped load, the optimizer / scheduler state is not read if it is not used'
+        to_load = load_checkpoint(filename, skip_keys=skipped_state_keys(
+            load_opt, load_scheduler, optimizer_keys=("sky_optimizer", "sky_style_optimizer"), scheduler_keys=("sky_scheduler", "sky_style_scheduler")
+        ))
         # print(to_load["net_coarse"].keys())
         # exit()
         if load_opt:
@@ -175,7 +274,8 @@ class SkyModel(nn.Module):
 
         self.sky_model.load_state_dict(to_load["sky_model"])
         self.sky_style_model.load_state_dict(to_load["sky_style_model"])
-        self.sky_style_code = to_load["sky_style_code"]
+        self.sky_style_code = to_load["sky_style_code"].to("cuda:{}".format(self.args.local_rank))
+        self.sky_texture = None
 
 
     def load_from_ckpt(
@@ -187,30 +287,16 @@ class SkyModel(nn.Module):
         :return: the current starting step
         """
 
-        # all existing ckpts
-        sky_ckpts = []
-        if os.path.exists(out_folder):
-            sky_ckpts = [
-                os.path.join(out_folder, f)
-                for f in sorted(os.listdir(out_folder))
-                if f.endswith(".pth")
-            ]
-
-        'LinGaoyuan code: remove all the elements in ckpts which name contains sky_model'
-        ckpts_copy = []
-        for i in sky_ckpts:
-            if i.split("/")[-1].find('sky_model') == 0:
-                ckpts_copy.append(i)
-        sky_ckpts = ckpts_copy
+        'LinGaoyuan_operation_20261018: latest sky_model_*.pth from the ckpt manifest (or the numbered files of the folder)'
+        fpath = latest_checkpoint(out_folder, "sky_model")
 
         if self.args.ckpt_path is not None and not force_latest_ckpt:
             if os.path.isfile(self.args.ckpt_path):  # load the specified ckpt
-                sky_ckpts = [self.args.ckpt_path]
+                fpath = self.args.ckpt_path
 
-        if len(sky_ckpts) > 0 and not self.args.no_reload:
-            fpath = sky_ckpts[-1]
+        if fpath is not None and not self.args.no_reload:
             self.load_model(fpath, load_opt, load_scheduler)
-            step = int(fpath[-10:-4])
+            step = checkpoint_step(fpath)
             print("Reloading from {}, starting at step={}".format(fpath, step))
         else:
             print("No ckpts found, training from scratch...")
@@ -225,4 +311,6 @@ class SkyModel(nn.Module):
     def switch_to_train(self):
         self.sky_model.train()
         self.sky_style_model.train()
+        'the weights change in training, the baked texture is outdated'
+        self.sky_texture = None
 
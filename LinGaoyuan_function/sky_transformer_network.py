@@ -4,6 +4,8 @@ import torch.nn as nn
 from torch.nn import TransformerEncoder
 import os
 
+from LinGaoyuan_function.checkpoint_manifest import latest_checkpoint, checkpoint_step, load_checkpoint, skipped_state_keys
+
 'use the ray_d and the mask of sky area of image to predict sky rgb'
 class SkyAttention(nn.Module):
     def __init__(self, dim_input = 256, dim_embed = 256, input_embedding = False, num_head = 1, dropout=0.1):
@@ -177,6 +179,23 @@ class SkyTransformer(nn.Module):
         # self.fc_z_a = nn.Linear(style_dim, dim_embed, bias=False)
         # self.fc_x_a = nn.Linear(style_dim, dim_embed, bias=False)
 
+    def map_style(self, z):
+        'LinGaoyuan_operation_20261018: style branch of forward(), it does not depend on the rays'
+        for i, skystyletran in enumerate(self.SkyStyleTrans):
+            z = skystyletran(z)
+        return z
+
+    def render(self, x, sky_style_code):
+        'ray branch of forward(), sky_style_code is the output of map_style()'
+        z = self.fc_z_a(sky_style_code)
+
+        x = self.act(self.fc1(x) + z)
+
+        for i, skytran in enumerate(self.SkyTrans):
+            x = skytran(x)
+
+        return self.fc_out_c(x)
+
     def forward(self, x, z=None, sky_mask=None):
         # for i in range(self.num_layers):
         #     z = self.sky_style_attention(z)
@@ -187,19 +206,9 @@ class SkyTransformer(nn.Module):
 
         # for i in range(self.num_layers):
         #     x = self.sky_attention(x)
-        for i, skystyletran in enumerate(self.SkyStyleTrans):
-            z = skystyletran(z)
+        sky_style_code = self.map_style(z)
 
-        sky_style_code = z
-
-        z = self.fc_z_a(z)
-
-        x = self.act(self.fc1(x) + z)
-
-        for i, skytran in enumerate(self.SkyTrans):
-            x = skytran(x)
-
-        skynet_out_color = self.fc_out_c(x)
+        skynet_out_color = self.render(x, sky_style_code)
 
         # skynet_out_c = skynet_out_color * (1.0 - sky_mask) + self.black_background * (sky_mask)
         #
@@ -233,19 +242,38 @@ class SkyTransformerModel(nn.Module):
         self.start_step = self.load_from_ckpt(out_folder, load_opt=load_opt, load_scheduler=load_scheduler)
 
     def forward(self, x, z=None, sky_mask=None):
-        x = x.cuda()
-        z = z.cuda()
-        skynet_out_c, sky_style_code = self.sky_transformer(x,z)
+        sky_style_code = self.map_style(z)
+
+        rgb_sky = self.render(x, sky_style_code, sky_mask)
+
+        return rgb_sky, sky_style_code
+
+    def map_style(self, z):
+        """
+        LinGaoyuan_operation_20261018: same split as SkyModel, the style transformer is run once per step / image
+        """
+        sky_style_code = self.sky_transformer.map_style(z.cuda())
 
         self.sky_style_code = sky_style_code
 
+        return sky_style_code
+
+    def render(self, x, sky_style_code, sky_mask):
+        """
+        :param sky_style_code: output of map_style()
+        """
+        skynet_out_c = self.sky_transformer.render(x.cuda(), sky_style_code)
+
         skynet_out_c = skynet_out_c * (1.0 - sky_mask) + self.black_background * (sky_mask)
 
         rgb_sky = skynet_out_c
 
-        return rgb_sky, sky_style_code
+        return rgb_sky
 
-    def save_model(self, filename):
+    def save_model(self, filename, checkpoint_writer=None):
+        '''
+        :param checkpoint_writer: CheckpointWriter, if not None the file is written in its background thread
+        '''
         to_save = {
             "optimizer": self.optimizer.state_dict(),
             "scheduler": self.scheduler.state_dict(),
@@ -253,13 +281,16 @@ class SkyTransformerModel(nn.Module):
             "sky_style_code": self.sky_style_code,
         }
 
-        torch.save(to_save, filename)
+        if checkpoint_writer is not None:
+            checkpoint_writer.save(to_save, filename)
+        else:
+            torch.save(to_save, filename)
 
     def load_model(self, filename, load_opt=True, load_scheduler=True):
-        if self.args.distributed:
-            to_load = torch.load(filename, map_location="cuda:{}".format(self.args.local_rank))
-        else:
-            to_load = torch.load(filename)
+        'LinGaoyuan_operation_20261018: memory-mapped load, the optimizer / scheduler state is not read if it is not used'
+        to_load = load_checkpoint(filename, skip_keys=skipped_state_keys(
+            load_opt, load_scheduler, optimizer_keys=("optimizer",), scheduler_keys=("scheduler",)
+        ))
         # print(to_load["net_coarse"].keys())
         # exit()
 
@@ -270,7 +301,7 @@ class SkyTransformerModel(nn.Module):
             self.scheduler.load_state_dict(to_load["scheduler"])
 
         self.sky_transformer.load_state_dict(to_load["sky_transformer"])
-        self.sky_style_code = to_load["sky_style_code"]
+        self.sky_style_code = to_load["sky_style_code"].to(self.device)
 
 
     def load_from_ckpt(
@@ -282,30 +313,16 @@ class SkyTransformerModel(nn.Module):
         :return: the current starting step
         """
 
-        # all existing ckpts
-        sky_ckpts = []
-        if os.path.exists(out_folder):
-            sky_ckpts = [
-                os.path.join(out_folder, f)
-                for f in sorted(os.listdir(out_folder))
-                if f.endswith(".pth")
-            ]
-
-        'LinGaoyuan code: remove all the elements in ckpts which name contains sky_model'
-        ckpts_copy = []
-        for i in sky_ckpts:
-            if i.split("/")[-1].find('sky_model') == 0:
-                ckpts_copy.append(i)
-        sky_ckpts = ckpts_copy
+        'LinGaoyuan_operation_20261018: latest sky_model_*.pth from the ckpt manifest (or the numbered files of the folder)'
+        fpath = latest_checkpoint(out_folder, "sky_model")
 
         if self.args.ckpt_path is not None and not force_latest_ckpt:
             if os.path.isfile(self.args.ckpt_path):  # load the specified ckpt
-                sky_ckpts = [self.args.ckpt_path]
+                fpath = self.args.ckpt_path
 
-        if len(sky_ckpts) > 0 and not self.args.no_reload:
-            fpath = sky_ckpts[-1]
+        if fpath is not None and not self.args.no_reload:
             self.load_model(fpath, load_opt, load_scheduler)
-            step = int(fpath[-10:-4])
+            step = checkpoint_step(fpath)
             print("Reloading from {}, starting at step={}".format(fpath, step))
         else:
             print("No ckpts found, training from scratch...")
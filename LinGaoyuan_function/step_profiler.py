@@ -0,0 +1,174 @@
+import os
+import functools
+import time
+import threading
+import collections
+import contextlib
+import torch
+
+
+'''
+LinGaoyuan_operation_20261018: per-stage timing of the training step (--profile_stages).
+The stages are marked with profile_stage(name) in the train loop, render_rays, Projector.compute and the transformers,
+it is a no-op context as long as no profiler is installed with set_profiler(). Stages can be nested (e.g. projection
+inside forward), every stage is timed on its own.
+'''
+
+_NULL_CONTEXT = contextlib.nullcontext()
+_profiler = None
+
+
+def set_profiler(profiler):
+    global _profiler
+    _profiler = profiler
+
+
+def get_profiler():
+    return _profiler
+
+
+def _is_compiling():
+    compiler = getattr(torch, "compiler", None)
+    return compiler is not None and hasattr(compiler, "is_compiling") and compiler.is_compiling()
+
+
+def profile_stage(name):
+    '''
+    context that times the enclosed code as stage name of the installed StepProfiler
+    '''
+    if _profiler is None or not _profiler.enabled or _is_compiling():
+        return _NULL_CONTEXT
+    if threading.get_ident() != _profiler.thread_id:
+        'only the train loop is timed, not e.g. the asynchronous validation'
+        return _NULL_CONTEXT
+    return _profiler.stage(name)
+
+
+class StepProfiler(object):
+    """
+    On cuda the stages are timed with cuda events, they are only resolved (one synchronize) in summary(), so the
+    timing does not add synchronizations to the step. On cpu time.perf_counter is used.
+
+    If trace_start >= 0, the steps trace_start ... trace_start + trace_steps - 1 are recorded with torch.profiler and
+    written as chrome trace to trace_dir, the stages show up as record_function ranges in the trace.
+    """
+
+    def __init__(self, device, enabled=True, trace_start=-1, trace_steps=0, trace_dir=None):
+        self.use_cuda = torch.device(device).type == "cuda" and torch.cuda.is_available()
+        self.enabled = enabled
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+        self.trace = None
+        self.thread_id = threading.get_ident()
+
+        self.num_steps = 0
+        self.interval_steps = 0
+        # stage name -> list of (start, end) cuda events
+        self.events = collections.OrderedDict()
+        # stage name -> seconds measured on the host
+        self.host_times = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = torch.profiler.record_function(name) if self.trace is not None else _NULL_CONTEXT
+        with record:
+            if self.use_cuda:
+                start = torch.cuda.Event(enable_timing=True)
+                end = torch.cuda.Event(enable_timing=True)
+                start.record()
+                try:
+                    yield
+                finally:
+                    end.record()
+                    self.events.setdefault(name, []).append((start, end))
+            else:
+                time0 = time.perf_counter()
+                try:
+                    yield
+                finally:
+                    self.add(name, time.perf_counter() - time0)
+
+    def add(self, name, seconds):
+        'time measured by the caller on the host, e.g. waiting for the data loader'
+        if self.enabled:
+            self.host_times[name] = self.host_times.get(name, 0.0) + seconds
+
+    def iterate(self, name, iterable):
+        '''
+        iterate over iterable, the time spent in next() is added to stage name
+        '''
+        iterator = iter(iterable)
+        while True:
+            time0 = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - time0)
+            yield item
+
+    @contextlib.contextmanager
+    def paused(self):
+        'the enclosed code is not timed, e.g. the validation rendering inside the train loop'
+        enabled, self.enabled = self.enabled, False
+        try:
+            yield
+        finally:
+            self.enabled = enabled
+
+    def step(self):
+        'call once per optimizer step'
+        self.num_steps += 1
+        self.interval_steps += 1
+
+        if self.trace_start < 0:
+            return
+        if self.num_steps == self.trace_start and self.trace is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities=activities)
+            self.trace.__enter__()
+        elif self.num_steps == self.trace_start + self.trace_steps and self.trace is not None:
+            self.trace.__exit__(None, None, None)
+            os.makedirs(self.trace_dir, exist_ok=True)
+            fpath = os.path.join(self.trace_dir, "trace_steps_{}_{}.json".format(self.trace_start, self.num_steps - 1))
+            self.trace.export_chrome_trace(fpath)
+            print("profiler trace written to {}".format(fpath))
+            self.trace = None
+
+    def summary(self):
+        '''
+        :return: {stage: average ms per step} since the last summary(), the interval is reset
+        '''
+        if self.use_cuda and len(self.events) > 0:
+            torch.cuda.synchronize()
+        steps = max(self.interval_steps, 1)
+        summary = collections.OrderedDict()
+        for name, seconds in self.host_times.items():
+            summary[name] = seconds * 1000.0 / steps
+        for name, events in self.events.items():
+            summary[name] = summary.get(name, 0.0) + sum(start.elapsed_time(end) for start, end in events) / steps
+
+        self.events = collections.OrderedDict()
+        self.host_times = collections.OrderedDict()
+        self.interval_steps = 0
+        return summary
+
+    @staticmethod
+    def format(summary):
+        return ", ".join("{}: {:.2f} ms".format(name, ms) for name, ms in summary.items())
+
+
+def profiled(name):
+    '''
+    decorator, every call of the function is timed as stage name
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with profile_stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -170,3 +170,17 @@ class SceneContraction(nn.Module):
     return contract(positions)
 
 
+
+
+def contract_points(pts, contraction_type):
+  '''
+  LinGaoyuan_operation_20261018: contraction of sample points by args.contraction_type, shared by render_rays and the
+  sparse feature volume (which has to place its voxels in the same contracted space)
+  '''
+  if contraction_type == 'nerfstudio':
+    return SceneContraction(order=float("inf"))(pts)
+  elif contraction_type == 'zhengzhisheng':
+    return contract_to_unisphere_LinGaoyuan(pts)
+  elif contraction_type == 'xuyan':
+    return contract_to_unisphere_LinGaoyuan_xuyan(pts)
+  return pts
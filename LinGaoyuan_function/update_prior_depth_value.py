@@ -7,6 +7,7 @@ import torchvision
 
 from model_and_model_component.render_image_LinGaoyuan import render_single_image
 from model_and_model_component.sample_ray_LinGaoyuan import RaySamplerSingleImage
+from model_and_model_component.feature_bank_LinGaoyuan import scene_feature_bank
 
 
 def get_ret(
@@ -24,12 +25,15 @@ def get_ret(
         sky_style_code=None,
         # sky_style_model=None,
         sky_model=None,
+        feature_bank=None,
 ):
     model.switch_to_eval()
     with torch.no_grad():
         ray_batch = ray_sampler.get_all()
 
-        if model.feature_net is not None:
+        if feature_bank is not None:
+            featmaps = None
+        elif model.feature_net is not None:
             featmaps = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
         else:
             featmaps = [None, None]
@@ -52,6 +56,7 @@ def get_ret(
             sky_style_code=sky_style_code,
             # sky_style_model=sky_style_model,
             sky_model=sky_model,
+            feature_bank=feature_bank,
         )
         return ret
 
@@ -77,6 +82,11 @@ def update_prior_depth_value(
     time0 = time.time()
 
 
+    'the weights do not change during the update, the source features of each frame are computed only once'
+    'one bank per scene and split, the frame ids are indices into the pose list of a scene'
+    train_feature_banks = {}
+    val_feature_banks = {}
+
     train_updated_depth_values = torch.zeros((len(train_dataloader), 900,1600)).cuda()
 
     train_idx_list = []
@@ -93,6 +103,10 @@ def update_prior_depth_value(
 
         train_ray_sample = RaySamplerSingleImage(
                         train_data, device, render_stride=args.render_stride)
+        if args.use_feature_bank is True:
+            train_feature_bank = scene_feature_bank(args, model, train_feature_banks, train_data, split="train")
+        else:
+            train_feature_bank = None
         train_ret = get_ret(
             global_step,
             args,
@@ -109,6 +123,7 @@ def update_prior_depth_value(
             sky_style_code=sky_style_code,
             # sky_style_model=sky_style_model,
             sky_model=sky_model,
+            feature_bank=train_feature_bank,
         )
         update_depth_value = train_ret['outputs_coarse']['depth'][None, ...]
         # train_data['depth_value'] = update_depth_value
@@ -133,6 +148,10 @@ def update_prior_depth_value(
 
         val_ray_sample = RaySamplerSingleImage(
                         val_data, device, render_stride=args.render_stride)
+        if args.use_feature_bank is True:
+            val_feature_bank = scene_feature_bank(args, model, val_feature_banks, val_data, split="val")
+        else:
+            val_feature_bank = None
         val_ret = get_ret(
             global_step,
             args,
@@ -149,6 +168,7 @@ def update_prior_depth_value(
             sky_style_code=sky_style_code,
             # sky_style_model=sky_style_model,
             sky_model=sky_model,
+            feature_bank=val_feature_bank,
         )
         update_depth_value = val_ret['outputs_coarse']['depth'][None, ...]
         # val_data['depth_value'] = update_depth_value
@@ -0,0 +1,145 @@
+import time
+from types import SimpleNamespace
+import torch
+
+import config
+from model_and_model_component.GNT_model_LinGaoyuan import GNT
+from model_and_model_component.GNT_feature_extractor import ResUNet
+from model_and_model_component.ReTR_model_LinGaoyuan import LinGaoyuan_ReTR_model
+from LinGaoyuan_function.ReTR_function.ReTR_feature_extractor import FPN_FeatureExtractor
+from LinGaoyuan_function.ReTR_function.ReTR_feature_volume import build_feature_volume
+from model_and_model_component.projection import Projector
+from model_and_model_component.render_ray_LinGaoyuan import render_core, render_model_type, CompiledRenderCore
+
+
+'LinGaoyuan_operation_20261018: per-chunk latency of the eager and the compiled render_rays core (--compile_render)'
+
+
+def build_networks(args, device):
+    '''
+    the networks are created directly on the device instead of with Model(), which always uses cuda:{local_rank}
+    '''
+    if args.use_retr_model is True:
+        net_coarse = LinGaoyuan_ReTR_model(
+            args, in_feat_ch=32, posenc_dim=3, viewenc_dim=3, ret_alpha=False,
+            use_volume_feature=args.use_volume_feature
+        )
+    else:
+        net_coarse = GNT(
+            args, in_feat_ch=args.coarse_feat_dim, posenc_dim=3 + 3 * 2 * 10, viewenc_dim=3 + 3 * 2 * 10, ret_alpha=True
+        )
+    model = SimpleNamespace(net_coarse=net_coarse.to(device).eval())
+
+    if args.use_retr_feature_extractor is True:
+        model.retr_feature_extractor = FPN_FeatureExtractor(out_ch=32).to(device).eval()
+        if args.use_volume_feature is True:
+            model.retr_feature_volume = build_feature_volume(args, volume_reso=100).to(device).eval()
+    else:
+        model.feature_net = ResUNet(
+            coarse_out_ch=args.coarse_feat_dim, fine_out_ch=args.fine_feat_dim, single_net=args.single_net
+        ).to(device).eval()
+    return model
+
+
+def synthetic_inputs(args, model, device, num_rays, N_samples, num_source_views, h=176, w=240):
+    '''
+    pinhole cameras with identity pose looking along +z, the sample points lie in front of the cameras
+    '''
+    K = torch.eye(4, device=device)
+    K[0, 0] = K[1, 1] = 0.8 * w
+    K[0, 2], K[1, 2] = w / 2.0, h / 2.0
+    camera = torch.cat([torch.tensor([h, w], dtype=torch.float32, device=device),
+                        K.reshape(-1), torch.eye(4, device=device).reshape(-1)])
+    ray_batch = {
+        "camera": camera[None],
+        "src_cameras": camera[None, None].repeat(1, num_source_views, 1),
+        "src_rgbs": torch.rand(1, num_source_views, h, w, 3, device=device),
+    }
+
+    ray_d = torch.nn.functional.normalize(
+        torch.cat([torch.rand(num_rays, 2, device=device) - 0.5, torch.ones(num_rays, 1, device=device)], dim=-1), dim=-1
+    )
+    z_vals = torch.linspace(1.0, 10.0, N_samples, device=device)[None].repeat(num_rays, 1)
+    pts = ray_d[:, None, :] * z_vals[..., None]
+
+    feature_volume = None
+    with torch.no_grad():
+        x = ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2)
+        if args.use_retr_feature_extractor is True:
+            featmaps, fpn = model.retr_feature_extractor(x)
+            if args.use_volume_feature is True:
+                feature_volume = model.retr_feature_volume(fpn, ray_batch)
+        else:
+            featmaps = model.feature_net(x)
+    return pts, z_vals, ray_d, ray_batch, featmaps, feature_volume
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+@torch.no_grad()
+def time_core(core, inputs, num_warmup, num_iters, device):
+    for _ in range(num_warmup):
+        core(*inputs)
+    synchronize(device)
+    start = time.time()
+    for _ in range(num_iters):
+        core(*inputs)
+    synchronize(device)
+    return (time.time() - start) / num_iters * 1000.0
+
+
+@torch.no_grad()
+def memory_per_chunk(core, inputs, device):
+    '''
+    :return: peak memory during one chunk and memory still allocated after it (e.g. attention maps kept by modules), in MB
+    '''
+    synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    allocated_before = torch.cuda.memory_allocated(device)
+    output = core(*inputs)
+    del output
+    synchronize(device)
+    peak = torch.cuda.max_memory_allocated(device) - allocated_before
+    retained = torch.cuda.memory_allocated(device) - allocated_before
+    return peak / 1024 ** 2, retained / 1024 ** 2
+
+
+if __name__ == "__main__":
+    parser = config.config_parser()
+    parser.add_argument("--bench_iters", type=int, default=20, help="timed iterations per setting")
+    parser.add_argument("--bench_warmup", type=int, default=3, help="untimed iterations (compilation) per setting")
+    args = parser.parse_args()
+
+    devices = [torch.device("cpu")]
+    if torch.cuda.is_available():
+        devices.append(torch.device("cuda:{}".format(args.local_rank)))
+
+    N_samples = args.N_samples
+    num_source_views = args.num_source_views
+    print("model type: {}, N_samples: {}, num_source_views: {}, chunk_size: {}".format(
+        render_model_type(args), N_samples, num_source_views, args.chunk_size))
+
+    for device in devices:
+        model = build_networks(args, device)
+        projector = Projector(device=device, mip_levels=args.feature_mip_levels)
+        pts, z_vals, ray_d, ray_batch, featmaps, feature_volume = synthetic_inputs(
+            args, model, device, args.chunk_size, N_samples, num_source_views
+        )
+        ret_alpha = args.use_retr_model is not True
+        inputs = (args, model, projector, pts, z_vals, ray_d, ray_batch, featmaps, feature_volume, ret_alpha)
+
+        eager_ms = time_core(render_core, inputs, args.bench_warmup, args.bench_iters, device)
+        compiled = CompiledRenderCore((N_samples, num_source_views, render_model_type(args)), mode=args.compile_mode)
+        compiled_ms = time_core(compiled, inputs, args.bench_warmup, args.bench_iters, device)
+
+        print("[{}] eager: {:.2f} ms/chunk, compiled ({}{}): {:.2f} ms/chunk, speedup: {:.2f}x".format(
+            device, eager_ms, args.compile_mode, ", fell back to eager" if compiled.failed else "",
+            compiled_ms, eager_ms / compiled_ms))
+
+        if device.type == "cuda":
+            peak_mb, retained_mb = memory_per_chunk(render_core, inputs, device)
+            print("[{}] eager: peak memory {:.1f} MB/chunk, retained after the chunk {:.1f} MB".format(
+                device, peak_mb, retained_mb))
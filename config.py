@@ -114,6 +114,15 @@ def config_parser():
         default=32 * 16,
         help="batch size (number of random rays per gradient step)",
     )
+    parser.add_argument(
+        "--num_target_views", type=int, default=1,
+        help="number of target views (each with its own source views) per training batch, "
+             "the N_rand rays of the batch are split among them",
+    )
+    parser.add_argument(
+        "--grad_accum_steps", type=int, default=1,
+        help="number of training batches whose gradients are accumulated before one optimizer step",
+    )
     parser.add_argument(
         "--chunk_size",
         type=int,
@@ -166,6 +175,68 @@ def config_parser():
         "--aliasing_filter_type", type=str, default=None, help="the type aliasing filter, filter bank or single filter"
     )
 
+    parser.add_argument(
+        "--view_attn_chunk_size", type=int, default=0,
+        help="if > 0, the view attention of GNT processes the source views in blocks of this size with an online softmax "
+             "to reduce the peak memory, 0 processes all views at once"
+    )
+
+    parser.add_argument(
+        "--attn_backend", type=str, default="sdpa", choices=["sdpa", "manual"],
+        help="attention implementation of the GNT ray transformer: fused torch scaled_dot_product_attention or the "
+             "explicit softmax(QK^T)V, the explicit one is always used when the attention map is returned"
+    )
+
+    parser.add_argument(
+        "--ray_attn_type", type=str, default="full", choices=["full", "window", "linear"],
+        help="attention along the ray in the GNT ray transformer and the ReTR occupancy transformer: full (quadratic in "
+             "the samples per ray), window (banded attention plus global tokens) or linear (LinearAttention)"
+    )
+    parser.add_argument(
+        "--ray_attn_window", type=int, default=16,
+        help="window attention: number of neighbouring samples on each side every sample attends to"
+    )
+    parser.add_argument(
+        "--ray_attn_global_tokens", type=int, default=1,
+        help="window attention in GNT: number of global summary tokens (means of consecutive ray segments), "
+             "ReTR always uses its RadianceToken as the global token"
+    )
+
+    parser.add_argument(
+        "--amp", type=str, default="none", choices=["none", "fp16", "bf16"],
+        help="mixed precision for the feature extractor, projector sampling and transformers, fp16 uses loss scaling, "
+             "bf16 also works on cpu; sample_pdf, contraction and depth accumulation always run in float32"
+    )
+
+    parser.add_argument(
+        "--grad_checkpoint_layers", type=int, default=0,
+        help="number of transformer layers, counted from the input, whose activations are recomputed in backward "
+             "instead of stored (GNT: view+ray transformer of each layer, ReTR: view and occupancy transformer), "
+             "-1 for all layers, 0 disables activation checkpointing"
+    )
+
+    parser.add_argument(
+        "--feature_mip_levels", type=int, default=1,
+        help="number of levels of the source feature pyramid, if > 1 the image features are sampled from the level "
+             "that matches the projected footprint of each sample"
+    )
+
+    parser.add_argument(
+        "--early_exit_threshold", type=float, default=0.0,
+        help="GNT eval mode only: samples whose mean ray attention weight over the previous layers is below "
+             "early_exit_threshold / N_samples are frozen and skip the later view transformer layers, 0 disables it"
+    )
+
+    parser.add_argument(
+        "--compile_render", action="store_true",
+        help="compile the contraction / projection / network / depth accumulation core of render_rays with "
+             "torch.compile, one compiled variant per (N_samples, num_source_views, model type)"
+    )
+    parser.add_argument(
+        "--compile_mode", type=str, default="default", choices=["default", "reduce-overhead", "max-autotune"],
+        help="torch.compile mode of --compile_render"
+    )
+
     ########## checkpoints ##########
     parser.add_argument(
         "--no_reload", action="store_true", help="do not reload weights from saved ckpt"
@@ -208,6 +279,14 @@ def config_parser():
     ########### loss coefficient ###########
     parser.add_argument("--lambda_rgb", type=float, default=0.5, help="loss coefficient for rgb loss")
     parser.add_argument("--lambda_depth", type=float, default=0.5, help="loss coefficient for depth loss")
+    parser.add_argument(
+        "--lambda_sky_rgb", type=float, default=1.0,
+        help="loss coefficient for the sky rgb loss (joint and separate backward passes)"
+    )
+    parser.add_argument(
+        "--no_joint_training", action="store_true",
+        help="use a separate backward pass, optimizer step and DDP wrapper for the scene and the sky model",
+    )
 
     ########### depth prior update relevant variable ###########
 
@@ -238,6 +317,19 @@ def config_parser():
     parser.add_argument(
         "--sky_model_type", type=str, default="mlp", help="the type of model to use for sky"
     )
+    parser.add_argument(
+        "--sky_texture_resolution", type=int, default=0,
+        help="mlp sky model: at inference the sky is looked up in an equirectangular texture of this height "
+             "(width = 2 * height) baked for the sky style code, 0 evaluates the sky network for every ray"
+    )
+    parser.add_argument(
+        "--sky_texture_scales", type=int, default=8,
+        help="number of ray_d length layers of the sky texture, the sky network is fed unnormalised ray directions"
+    )
+    parser.add_argument(
+        "--sky_texture_max_scale", type=float, default=2.0,
+        help="largest ray_d length covered by the sky texture (1 / cos of the largest angle to the optical axis)"
+    )
     parser.add_argument("--lrate_sky_model", type=float, default=0.005, help="learning rate for sky model")
     parser.add_argument(
         "--lrate_decay_factor_sky_model",
@@ -271,6 +363,20 @@ def config_parser():
         "--use_volume_feature", action="store_true", help="whether or not to use feature extractor of ReTR"
     )
 
+    parser.add_argument(
+        "--sparse_feature_volume", action="store_true",
+        help="build the ReTR feature volume only in the blocks seen by the source views and near the depth prior, "
+             "the volume is zero elsewhere"
+    )
+    parser.add_argument(
+        "--feature_volume_block_size", type=int, default=20,
+        help="sparse feature volume: edge length of a block in voxels, has to divide the volume resolution (100)"
+    )
+    parser.add_argument(
+        "--feature_volume_min_views", type=int, default=1,
+        help="sparse feature volume: number of source views that have to see a block for it to be built"
+    )
+
     parser.add_argument(
         "--use_retr_feature_extractor", action="store_true", help="whether or not to use volume feature extractor of ReTR"
     )
@@ -327,12 +433,44 @@ def config_parser():
 
     ########## logging/saving options ##########
     parser.add_argument("--i_print", type=int, default=100, help="frequency of terminal printout")
+    parser.add_argument(
+        "--profile_stages", action="store_true",
+        help="time the stages of the training step (data, ray sampling, feature extraction, projection, transformers, "
+             "sky model, loss, backward, optimizer) and print the average per step every i_print steps"
+    )
+    parser.add_argument(
+        "--profile_trace_start", type=int, default=-1,
+        help="if >= 0, record a torch.profiler trace starting at this step of the run, written to out/<expname>/profiler"
+    )
+    parser.add_argument("--profile_trace_steps", type=int, default=5, help="number of steps in the torch.profiler trace")
+    parser.add_argument(
+        "--metrics_sink", type=str, default="jsonl", choices=["jsonl", "tensorboard", "both"],
+        help="where the training metrics of every i_print steps are written: out/<expname>/metrics.jsonl, "
+             "out/<expname>/tensorboard or both, they are printed in any case"
+    )
     parser.add_argument(
         "--i_img", type=int, default=500, help="frequency of tensorboard image logging"
     )
     parser.add_argument(
         "--i_weights", type=int, default=10000, help="frequency of weight ckpt saving"
     )
+    parser.add_argument(
+        "--keep_checkpoints", type=int, default=0,
+        help="number of the latest model / sky model ckpts that are kept on disk, 0 keeps all ckpts"
+    )
+    parser.add_argument(
+        "--no_async_checkpoint", action="store_true",
+        help="write the ckpts in the training loop instead of a background thread"
+    )
+    parser.add_argument(
+        "--no_async_validation", action="store_true",
+        help="render the validation views of every i_img steps in the training loop instead of a thread on a side "
+             "cuda stream from a copy of the weights (the copy needs as much memory as the weights)"
+    )
+    parser.add_argument(
+        "--train_view_render_stride", type=int, default=1,
+        help="render stride of the training view that is logged with the validation view every i_img steps"
+    )
 
     parser.add_argument(
         "--update_prior_depth", action="store_true",
@@ -356,4 +494,16 @@ def config_parser():
         help="will take every 1/N images as LLFF test set, paper uses 8",
     )
 
+    parser.add_argument(
+        "--use_feature_bank", action="store_true",
+        help="cache the feature maps of each source frame once per scene and reuse them for all target views in eval"
+    )
+    parser.add_argument(
+        "--feature_bank_half", action="store_true", help="store the feature maps of the feature bank as float16"
+    )
+    parser.add_argument(
+        "--feature_bank_dir", type=str, default=None,
+        help="if set, the feature maps of the feature bank are memory-mapped from .npy files in this directory"
+    )
+
     return parser
@@ -8,7 +8,8 @@ from torch.utils.data import DataLoader
 
 from model_and_model_component.data_loaders import dataset_dict
 from model_and_model_component.render_image_LinGaoyuan import render_single_image
-from model_and_model_component.model_LinGaoyuan import Model
+from model_and_model_component.model_LinGaoyuan import Model, de_parallel
+from model_and_model_component.feature_bank_LinGaoyuan import scene_feature_bank
 from model_and_model_component.sample_ray_LinGaoyuan import RaySamplerSingleImage
 from utils import img_HWC2CHW, colorize, img2psnr, lpips, ssim
 import config
@@ -117,17 +118,18 @@ def eval(args):
         iterator = iter(loader)
 
     # Create GNT model
+    'LinGaoyuan_operation_20261018: eval does not step the optimizers, their state is not read from the ckpts'
     model = Model(
-        args, load_opt=not args.no_load_opt, load_scheduler=not args.no_load_scheduler
+        args, load_opt=False, load_scheduler=False
     )
 
     'LinGaoyuan_operation_20240927: add sky model to eval_LinGaoyuan'
     # Create sky model
     if args.sky_model_type == 'mlp':
-        sky_model = SkyModel(args, load_opt=not args.no_load_opt, load_scheduler=not args.no_load_scheduler)
+        sky_model = SkyModel(args, load_opt=False, load_scheduler=False)
     else:
         sky_model = SkyTransformerModel(args, ray_d_input=3, style_dim=128, dim_embed=256, num_head=2, input_embedding=False,
-                                   dropout=0.05, num_layers=5).to(device)
+                                   dropout=0.05, num_layers=5, load_opt=False, load_scheduler=False).to(device)
 
     'LinGaoyuan_20240927: create sky style code'
     style_dims = 128
@@ -141,7 +143,10 @@ def eval(args):
 
 
     # create projector
-    projector = Projector(device=device)
+    projector = Projector(device=device, mip_levels=args.feature_mip_levels)
+
+    'one source feature bank per scene, the source frame ids are only unique inside a scene'
+    feature_banks = {}
 
     indx = 0
     psnr_scores = []
@@ -158,6 +163,11 @@ def eval(args):
             H, W = tmp_ray_sampler.H, tmp_ray_sampler.W
             gt_img = tmp_ray_sampler.rgb.reshape(H, W, 3)
 
+            if args.use_feature_bank is True:
+                feature_bank = scene_feature_bank(args, model, feature_banks, data)
+            else:
+                feature_bank = None
+
             # 获取3D可视化数据
             if viewer is not None:
                 try:
@@ -168,7 +178,8 @@ def eval(args):
                         projector,
                         sky_style_code=z,
                         sky_model=sky_model,
-                        data_mode='val'
+                        data_mode='val',
+                        feature_bank=feature_bank,
                     )
                     viewer.update_point_cloud(vis_data)
                 except Exception as e:
@@ -190,7 +201,11 @@ def eval(args):
                 sky_style_code=z,
                 sky_model=sky_model,
                 data_mode='val',
+                feature_bank=feature_bank,
             )
+            if feature_bank is not None:
+                print('feature bank: {} frames, {} hits, {} misses'.format(
+                    len(feature_bank), feature_bank.num_hits, feature_bank.num_misses))
             psnr_scores.append(psnr_curr_img)
             lpips_scores.append(lpips_curr_img)
             ssim_scores.append(ssim_curr_img)
@@ -206,6 +221,9 @@ def eval(args):
     np.savetxt(os.path.join(out_folder, 'ssim_scores.txt'), ssim_scores, delimiter=',')
     np.savetxt(os.path.join(out_folder, 'lpips_scores.txt'), lpips_scores, delimiter=',')
 
+    if args.early_exit_sweep is not None and args.local_rank == 0:
+        early_exit_sweep(args, model, projector, loader, z, sky_model, out_folder)
+
     # Close viewer if it was initialized
     if viewer is not None:
         viewer.close()
@@ -229,6 +247,7 @@ def log_view(
     sky_style_code=None,
     sky_model=None,
     data_mode=None,
+    feature_bank=None,
 ):
     model.switch_to_eval()
     with torch.no_grad():
@@ -239,14 +258,19 @@ def log_view(
         #     featmaps = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
         # else:
         #     featmaps = [None, None]
-        if args.use_retr_feature_extractor is False:
-            featmaps = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
-        else:
-            featmaps, fpn = model.retr_feature_extractor(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
-        if args.use_volume_feature is True and args.use_retr_feature_extractor is True:
-            feature_volume = model.retr_feature_volume(fpn, ray_batch)
-        else:
+        if feature_bank is not None:
+            'the feature maps are served by render_single_image from the feature bank'
+            featmaps = None
             feature_volume = None
+        else:
+            if args.use_retr_feature_extractor is False:
+                featmaps = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
+            else:
+                featmaps, fpn = model.retr_feature_extractor(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
+            if args.use_volume_feature is True and args.use_retr_feature_extractor is True:
+                feature_volume = model.retr_feature_volume(fpn, ray_batch)
+            else:
+                feature_volume = None
 
 
         ret = render_single_image(
@@ -270,7 +294,8 @@ def log_view(
             sky_model=sky_model,
             feature_volume=feature_volume,
             data_mode=data_mode,
-            use_updated_prior_depth=True
+            use_updated_prior_depth=True,
+            feature_bank=feature_bank,
         )
 
     'LinGaoyuan_20240927: average_im is seem that useless in eval process'
@@ -381,6 +406,96 @@ def log_view(
     return psnr_curr_img, lpips_curr_img, ssim_curr_img
 
 
+@torch.no_grad()
+def early_exit_sweep(args, model, projector, loader, sky_style_code, sky_model, out_folder):
+    '''
+    LinGaoyuan_operation_20261018: render the eval split once per threshold in args.early_exit_sweep and report the
+    rendering throughput, the fraction of samples that still run the view transformer and the PSNR of each threshold,
+    the results are saved to out_folder/early_exit_sweep.json
+    '''
+    net = de_parallel(model.net_coarse)
+    if not hasattr(net, 'early_exit_threshold'):
+        print('early exit is only implemented in the GNT model, skip the sweep')
+        return
+
+    device = "cuda:{}".format(args.local_rank)
+    model.switch_to_eval()
+    results = []
+    for threshold in args.early_exit_sweep:
+        net.early_exit_threshold = threshold
+        net.reset_early_exit_stats()
+        psnr_scores = []
+        num_rays = 0
+        render_time = 0.0
+        for data in loader:
+            ray_sampler = RaySamplerSingleImage(data, device, render_stride=args.render_stride)
+            H, W = ray_sampler.H, ray_sampler.W
+            gt_img = ray_sampler.rgb.reshape(H, W, 3)[::args.render_stride, ::args.render_stride]
+            sky_mask = ray_sampler.sky_mask.reshape(H, W, 1)[::args.render_stride, ::args.render_stride]
+            ray_batch = ray_sampler.get_all()
+
+            if args.use_retr_feature_extractor is False:
+                featmaps = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
+            else:
+                featmaps, fpn = model.retr_feature_extractor(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
+            if args.use_volume_feature is True and args.use_retr_feature_extractor is True:
+                feature_volume = model.retr_feature_volume(fpn, ray_batch)
+            else:
+                feature_volume = None
+
+            'only the ray rendering is timed, the feature extraction does not depend on the threshold'
+            torch.cuda.synchronize()
+            start = time.time()
+            ret = render_single_image(
+                args,
+                ray_sampler=ray_sampler,
+                ray_batch=ray_batch,
+                model=model,
+                projector=projector,
+                chunk_size=args.chunk_size,
+                N_samples=args.N_samples,
+                inv_uniform=args.inv_uniform,
+                det=True,
+                N_importance=args.N_importance,
+                white_bkgd=args.white_bkgd,
+                render_stride=args.render_stride,
+                featmaps=featmaps,
+                ret_alpha=True,
+                single_net=args.single_net,
+                sky_style_code=sky_style_code,
+                sky_model=sky_model,
+                feature_volume=feature_volume,
+                data_mode='val',
+                use_updated_prior_depth=True,
+            )
+            torch.cuda.synchronize()
+            render_time += time.time() - start
+
+            pred_rgb = ret["outputs_coarse"]["rgb"].detach().cpu()
+            rgb_sky = torch.clamp(ret["outputs_coarse"]["rgb_sky"].detach().cpu(), 0, 1)
+            sky_mask = sky_mask.cpu()
+            pred_rgb = torch.clip(pred_rgb * sky_mask + rgb_sky * (1 - sky_mask), 0.0, 1.0)
+            psnr_scores.append(img2psnr(pred_rgb, gt_img.cpu()))
+            num_rays += pred_rgb.shape[0] * pred_rgb.shape[1]
+
+        num_active_samples = net.num_active_samples
+        if torch.is_tensor(num_active_samples):
+            num_active_samples = num_active_samples.item()
+        result = {
+            'threshold': threshold,
+            'rays_per_second': num_rays / render_time,
+            'active_sample_ratio': num_active_samples / max(net.num_total_samples, 1),
+            'psnr': float(np.mean(psnr_scores)),
+        }
+        print('early exit threshold {}: {:.0f} rays/s, {:.1%} active samples, PSNR {:.3f}'.format(
+            threshold, result['rays_per_second'], result['active_sample_ratio'], result['psnr']))
+        results.append(result)
+
+    net.early_exit_threshold = args.early_exit_threshold
+    with open(os.path.join(out_folder, 'early_exit_sweep.json'), 'w') as f:
+        json.dump(results, f, indent=4)
+
+
 @torch.no_grad()
 def render_ray_for_3d_vis(
     args,
@@ -390,6 +505,7 @@ def render_ray_for_3d_vis(
     sky_style_code=None,
     sky_model=None,
     data_mode=None,
+    feature_bank=None,
 ):
     """
     Render rays and return data suitable for 3D visualization in viser.
@@ -405,15 +521,19 @@ def render_ray_for_3d_vis(
         ray_batch = ray_sampler.get_all()
         
         # Get feature maps
-        if args.use_retr_feature_extractor is False:
-            featmaps = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
-        else:
-            featmaps, fpn = model.retr_feature_extractor(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
-            
-        if args.use_volume_feature is True and args.use_retr_feature_extractor is True:
-            feature_volume = model.retr_feature_volume(fpn, ray_batch)
-        else:
+        if feature_bank is not None:
+            featmaps = None
             feature_volume = None
+        else:
+            if args.use_retr_feature_extractor is False:
+                featmaps = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
+            else:
+                featmaps, fpn = model.retr_feature_extractor(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
+
+            if args.use_volume_feature is True and args.use_retr_feature_extractor is True:
+                feature_volume = model.retr_feature_volume(fpn, ray_batch)
+            else:
+                feature_volume = None
 
         # Render the image
         ret = render_single_image(
@@ -436,7 +556,8 @@ def render_ray_for_3d_vis(
             sky_model=sky_model,
             feature_volume=feature_volume,
             data_mode=data_mode,
-            use_updated_prior_depth=True
+            use_updated_prior_depth=True,
+            feature_bank=feature_bank,
         )
 
         # Extract 3D visualization data
@@ -485,6 +606,8 @@ def render_ray_for_3d_vis(
 if __name__ == "__main__":
     parser = config.config_parser()
     parser.add_argument("--run_val", action="store_true", help="run on val set")
+    parser.add_argument("--early_exit_sweep", type=float, nargs="+", default=None,
+                        help="early exit thresholds, the eval split is rendered once per threshold and throughput / PSNR are reported")
     args = parser.parse_args()
 
     if args.distributed:
@@ -320,3 +320,17 @@ class ResUNet(nn.Module):
             x_coarse = x_out[:, : self.coarse_out_ch, :]
             x_fine = x_out[:, -self.fine_out_ch :, :]
         return x_coarse, x_fine
+
+
+def build_feature_pyramid(featmaps, num_levels=3):
+    """
+    mip pyramid of the feature maps, each level is the 2x2 box-filtered copy of the previous level
+    :param featmaps: [n_views, d, h, w]
+    :param num_levels: number of levels, including the full resolution level
+    :return: list of num_levels feature maps, level l is [n_views, d, ceil(h / 2^l), ceil(w / 2^l)]. For odd sizes the
+    last row / column of a level averages only the pixels inside the previous level.
+    """
+    pyramid = [featmaps]
+    for _ in range(1, num_levels):
+        pyramid.append(F.avg_pool2d(pyramid[-1], kernel_size=2, stride=2, ceil_mode=True))
+    return pyramid
@@ -1,42 +1,13 @@
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
-from LinGaoyuan_function.aliasing import exercute_aliasing_filter
-
-# sin-cose embedding module
-class Embedder(nn.Module):
-    def __init__(self, **kwargs):
-        super(Embedder, self).__init__()
-        self.kwargs = kwargs
-        self.create_embedding_fn()
-
-    def create_embedding_fn(self):
-        embed_fns = []
-        d = self.kwargs["input_dims"]
-        out_dim = 0
-        if self.kwargs["include_input"]:
-            embed_fns.append(lambda x: x)
-            out_dim += d
-
-        max_freq = self.kwargs["max_freq_log2"]
-        N_freqs = self.kwargs["num_freqs"]
-
-        if self.kwargs["log_sampling"]:
-            freq_bands = 2.0 ** torch.linspace(0.0, max_freq, steps=N_freqs)
-        else:
-            freq_bands = torch.linspace(2.0**0.0, 2.0**max_freq, steps=N_freqs)
-
-        for freq in freq_bands:
-            for p_fn in self.kwargs["periodic_fns"]:
-                embed_fns.append(lambda x, p_fn=p_fn, freq=freq: p_fn(x * freq))
-                out_dim += d
-
-        self.embed_fns = embed_fns
-        self.out_dim = out_dim
-
-    def forward(self, inputs):
-        return torch.cat([fn(inputs) for fn in self.embed_fns], -1)
+from LinGaoyuan_function.aliasing import exercute_aliasing_filter, build_aliasing_module
+from LinGaoyuan_function.gradient_checkpoint import run_block, use_block_checkpoint
+from LinGaoyuan_function.step_profiler import profile_stage
+from LinGaoyuan_function.clip_function import Embedder  # sin-cose embedding module, shared with clip-nerf
+from LinGaoyuan_function.ReTR_function.ReTR_linear_attention import LinearAttention, banded_attention
 
 
 class FeedForward(nn.Module):
@@ -55,8 +26,13 @@ class FeedForward(nn.Module):
 
 # Subtraction-based efficient attention
 class Attention2D(nn.Module):
-    def __init__(self, dim, dp_rate):
+    def __init__(self, dim, dp_rate, view_chunk_size=0):
+        """
+        :param view_chunk_size: if > 0, the source views are processed in blocks of this size with an online softmax,
+        so the [N_rays, N_samples, N_views, dim] intermediates are never materialised for all views at once
+        """
         super(Attention2D, self).__init__()
+        self.view_chunk_size = view_chunk_size
         self.q_fc = nn.Linear(dim, dim, bias=False)
         self.k_fc = nn.Linear(dim, dim, bias=False)
         self.v_fc = nn.Linear(dim, dim, bias=False)
@@ -74,6 +50,9 @@ class Attention2D(nn.Module):
         self.dp = nn.Dropout(dp_rate)
 
     def forward(self, q, k, pos, mask=None):
+        if self.view_chunk_size > 0 and k.shape[2] > self.view_chunk_size:
+            return self.forward_chunked(q, k, pos, mask)
+
         q = self.q_fc(q)
         k = self.k_fc(k)
         v = self.v_fc(k)
@@ -82,7 +61,7 @@ class Attention2D(nn.Module):
         attn = k - q[:, :, None, :] + pos
         attn = self.attn_fc(attn)
         if mask is not None:
-            attn = attn.masked_fill(mask == 0, -1e9)
+            attn = attn.masked_fill(mask == 0, -1e9 if attn.dtype == torch.float32 else -1e4)
         attn = torch.softmax(attn, dim=-2)
         attn = self.dp(attn)
 
@@ -90,16 +69,62 @@ class Attention2D(nn.Module):
         x = self.dp(self.out_fc(x))
         return x
 
+    def forward_chunked(self, q, k, pos, mask=None):
+        """
+        LinGaoyuan_operation_20261018: same result as forward(), the softmax over the views is accumulated block by block
+        (running max, running normaliser and running weighted sum). Dropout is applied to the unnormalised weights,
+        which is the same as applying it to the softmax output since the normaliser is shared by all views.
+        :param q: [N_rays, N_samples, dim]
+        :param k: [N_rays, N_samples, N_views, dim]
+        :param pos: [N_rays, N_samples, N_views, 4]
+        :param mask: [N_rays, N_samples, N_views, 1]
+        """
+        q = self.q_fc(q)[:, :, None, :]
+
+        running_max = None
+        running_sum = None
+        x = None
+        for start in range(0, k.shape[2], self.view_chunk_size):
+            end = start + self.view_chunk_size
+            k_block = self.k_fc(k[:, :, start:end])
+            v_block = self.v_fc(k_block)
+            pos_block = self.pos_fc(pos[:, :, start:end])
+
+            attn = self.attn_fc(k_block - q + pos_block)
+            if mask is not None:
+                attn = attn.masked_fill(mask[:, :, start:end] == 0, -1e9 if attn.dtype == torch.float32 else -1e4)
+
+            block_max = attn.max(dim=2)[0]
+            new_max = block_max if running_max is None else torch.maximum(running_max, block_max)
+            weight = torch.exp(attn - new_max[:, :, None, :])
+            block_sum = weight.sum(dim=2)
+            block_x = ((v_block + pos_block) * self.dp(weight)).sum(dim=2)
+
+            if running_max is None:
+                running_sum, x = block_sum, block_x
+            else:
+                rescale = torch.exp(running_max - new_max)
+                running_sum = running_sum * rescale + block_sum
+                x = x * rescale + block_x
+            running_max = new_max
+
+        x = x / running_sum
+        x = self.dp(self.out_fc(x))
+        return x
+
 
 # View Transformer
 class Transformer2D(nn.Module):
-    def __init__(self, dim, ff_hid_dim, ff_dp_rate, attn_dp_rate):
+    def __init__(self, dim, ff_hid_dim, ff_dp_rate, attn_dp_rate, aliasing_filter_type=None, view_chunk_size=0):
         super(Transformer2D, self).__init__()
         self.attn_norm = nn.LayerNorm(dim, eps=1e-6)
         self.ff_norm = nn.LayerNorm(dim, eps=1e-6)
 
         self.ff = FeedForward(dim, ff_hid_dim, ff_dp_rate)
-        self.attn = Attention2D(dim, attn_dp_rate)
+        self.attn = Attention2D(dim, attn_dp_rate, view_chunk_size)
+
+        'LinGaoyuan_operation_20261018: the anti-aliasing module (fixed kernel or trainable CNN) is built once here instead of in every forward'
+        self.aliasing = build_aliasing_module(aliasing_filter_type, dim)
 
     def forward(self, q, k, pos, mask=None, aliasing_filter = False, aliasing_filter_type = 'filter bank'):
         residue = q
@@ -114,7 +139,10 @@ class Transformer2D(nn.Module):
         'anti-aliasing filter should be used in here after the completion of ff layer'
         if aliasing_filter is True:
             # aliasing_filter_type = 'filter bank' # 'filter bank' or 'single filter'
-            x = exercute_aliasing_filter(x,aliasing_filter_type)
+            if self.aliasing is not None and self.aliasing.filter_type == aliasing_filter_type:
+                x = self.aliasing(x)
+            else:
+                x = exercute_aliasing_filter(x,aliasing_filter_type)
 
         x = x + residue
 
@@ -127,7 +155,16 @@ class Transformer2D(nn.Module):
 #   - pos -> replace (q.k) attention with position attention.
 #   - gate -> weighted addition of  (q.k) attention and position attention.
 class Attention(nn.Module):
-    def __init__(self, dim, n_heads, dp_rate, attn_mode="qk", pos_dim=None):
+    def __init__(
+        self, dim, n_heads, dp_rate, attn_mode="qk", pos_dim=None, use_sdpa=True,
+        ray_attn_type="full", window_size=16, num_global_tokens=1,
+    ):
+        """
+        :param use_sdpa: if True, the "qk" attention uses the fused F.scaled_dot_product_attention, for ret_attn=True
+        only the attention row of the first sample (the one used as density by Transformer) is computed explicitly
+        :param ray_attn_type: "full", "window" (banded attention of +-window_size samples plus num_global_tokens
+        summary tokens) or "linear" (LinearAttention of ReTR), "window" and "linear" are only used with attn_mode "qk"
+        """
         super(Attention, self).__init__()
         if attn_mode in ["qk", "gate"]:
             self.q_fc = nn.Linear(dim, dim, bias=False)
@@ -144,8 +181,48 @@ class Attention(nn.Module):
         self.dp = nn.Dropout(dp_rate)
         self.n_heads = n_heads
         self.attn_mode = attn_mode
+        self.use_sdpa = use_sdpa and hasattr(F, "scaled_dot_product_attention")
+        self.ray_attn_type = ray_attn_type if attn_mode == "qk" else "full"
+        self.window_size = window_size
+        self.num_global_tokens = num_global_tokens
+        if self.ray_attn_type == "linear":
+            self.linear_attn = LinearAttention()
+
+    def forward_efficient(self, x, ret_attn=False):
+        """
+        LinGaoyuan_operation_20261018: "window" / "linear" attention along the ray, the cost is linear in N_samples.
+        For "window" the global tokens are the means of num_global_tokens consecutive segments of the ray, they are
+        prepended to the samples and dropped from the output.
+        """
+        N_rand, N_samples = x.shape[:2]
+        num_global = 0
+        if self.ray_attn_type == "window" and self.num_global_tokens > 0:
+            num_global = min(self.num_global_tokens, N_samples)
+            x_global = torch.stack([s.mean(dim=1) for s in torch.tensor_split(x, num_global, dim=1)], dim=1)
+            x = torch.cat([x_global, x], dim=1)
+
+        # [N_rand, num_global + N_samples, n_heads, dim // n_heads]
+        q = self.q_fc(x).view(N_rand, x.shape[1], self.n_heads, -1)
+        k = self.k_fc(x).view(N_rand, x.shape[1], self.n_heads, -1)
+        v = self.v_fc(x).view(N_rand, x.shape[1], self.n_heads, -1)
+        if self.ray_attn_type == "window":
+            out = banded_attention(q, k, v, self.window_size, num_global)
+        else:
+            out = self.linear_attn(q, k, v)
+
+        out = out[:, num_global:].reshape(N_rand, N_samples, -1)
+        out = self.dp(self.out_fc(out))
+        if ret_attn:
+            'the density needs the attention row of the first sample over all samples, it is computed explicitly'
+            attn = torch.einsum("nhd,nshd->nhs", q[:, num_global], k[:, num_global:]) / np.sqrt(q.shape[-1])
+            attn = self.dp(torch.softmax(attn, dim=-1))[:, :, None]  # [N_rand, n_heads, 1, N_samples]
+            return out, attn
+        return out
 
     def forward(self, x, pos=None, ret_attn=False):
+        if self.ray_attn_type != "full":
+            return self.forward_efficient(x, ret_attn)
+
         if self.attn_mode in ["qk", "gate"]:
             q = self.q_fc(x)
             q = q.view(x.shape[0], x.shape[1], self.n_heads, -1).permute(0, 2, 1, 3)
@@ -154,6 +231,18 @@ class Attention(nn.Module):
         v = self.v_fc(x)
         v = v.view(x.shape[0], x.shape[1], self.n_heads, -1).permute(0, 2, 1, 3)
 
+        'LinGaoyuan_operation_20261018: fused attention, the [N_rand, n_heads, N_samples, N_samples] map is not materialised'
+        if self.use_sdpa and self.attn_mode == "qk":
+            out = F.scaled_dot_product_attention(q, k, v, dropout_p=self.dp.p if self.training else 0.0)
+            out = out.permute(0, 2, 1, 3).contiguous()
+            out = out.view(x.shape[0], x.shape[1], -1)
+            out = self.dp(self.out_fc(out))
+            if ret_attn:
+                attn = torch.matmul(q[:, :, :1], k.transpose(-2, -1)) / np.sqrt(q.shape[-1])  # [N_rand, n_heads, 1, N_samples]
+                attn = self.dp(torch.softmax(attn, dim=-1))
+                return out, attn
+            return out
+
         if self.attn_mode in ["qk", "gate"]:
             attn = torch.matmul(q, k.transpose(-2, -1)) / np.sqrt(q.shape[-1])
             attn = torch.softmax(attn, dim=-1)
@@ -182,14 +271,17 @@ class Attention(nn.Module):
 # Ray Transformer
 class Transformer(nn.Module):
     def __init__(
-        self, dim, ff_hid_dim, ff_dp_rate, n_heads, attn_dp_rate, attn_mode="qk", pos_dim=None
+        self, dim, ff_hid_dim, ff_dp_rate, n_heads, attn_dp_rate, attn_mode="qk", pos_dim=None, use_sdpa=True,
+        ray_attn_type="full", window_size=16, num_global_tokens=1,
     ):
         super(Transformer, self).__init__()
         self.attn_norm = nn.LayerNorm(dim, eps=1e-6)
         self.ff_norm = nn.LayerNorm(dim, eps=1e-6)
 
         self.ff = FeedForward(dim, ff_hid_dim, ff_dp_rate)
-        self.attn = Attention(dim, n_heads, attn_dp_rate, attn_mode, pos_dim)
+        self.attn = Attention(
+            dim, n_heads, attn_dp_rate, attn_mode, pos_dim, use_sdpa, ray_attn_type, window_size, num_global_tokens
+        )
 
     def forward(self, x, pos=None, ret_attn=False):
         residue = x
@@ -230,6 +322,8 @@ class GNT(nn.Module):
                 ff_hid_dim=int(args.netwidth * 4),
                 ff_dp_rate=0.1,
                 attn_dp_rate=0.1,
+                aliasing_filter_type=args.aliasing_filter_type if args.aliasing_filter is True and i < 2 else None,
+                view_chunk_size=args.view_attn_chunk_size,
             )
             self.view_crosstrans.append(view_trans)
             # ray transformer
@@ -239,6 +333,10 @@ class GNT(nn.Module):
                 n_heads=4,
                 ff_dp_rate=0.1,
                 attn_dp_rate=0.1,
+                use_sdpa=args.attn_backend == "sdpa",
+                ray_attn_type=args.ray_attn_type,
+                window_size=args.ray_attn_window,
+                num_global_tokens=args.ray_attn_global_tokens,
             )
             self.view_selftrans.append(ray_trans)
             # mlp
@@ -278,6 +376,33 @@ class GNT(nn.Module):
         self.aliasing_filter = args.aliasing_filter
         self.aliasing_filter_type = args.aliasing_filter_type
 
+        'LinGaoyuan_operation_20261018: number of transformer layers (counted from the input) that use activation checkpointing'
+        self.grad_checkpoint_layers = args.grad_checkpoint_layers
+
+        'LinGaoyuan_operation_20261018: adaptive early exit of samples in eval mode, 0 disables it'
+        self.early_exit_threshold = args.early_exit_threshold
+        self.num_active_samples = 0
+        self.num_total_samples = 0
+
+    def reset_early_exit_stats(self):
+        self.num_active_samples = 0
+        self.num_total_samples = 0
+
+    def forward_view_active(self, crosstrans, q_fc, i, q, rgb_feat, ray_diff, mask, input_pts, input_views, active):
+        """
+        LinGaoyuan_operation_20261018: view transformer (+ mlp) of one layer for the active samples only, the active
+        samples of all rays are gathered into [N_active, 1, ...] since every ray has a different number of them
+        :param active: [N_rand, N_samples] bool
+        :return: [N_rand, N_samples, 64], the frozen samples keep their input q
+        """
+        x = crosstrans(q[active][:, None], rgb_feat[active][:, None], ray_diff[active][:, None], mask[active][:, None])
+        if i % 2 == 0:
+            x = torch.cat((x, input_pts[active][:, None], input_views[active][:, None]), dim=-1)
+            x = q_fc(x)
+        q = q.clone()
+        q[active] = x[:, 0]
+        return q
+
     def forward(self, rgb_feat, ray_diff, mask, pts, ray_d):
         # compute positional embeddings
         viewdirs = ray_d  # (N_rand, 3)
@@ -296,6 +421,17 @@ class GNT(nn.Module):
         # q_init -> maxpool
         q = rgb_feat.max(dim=2)[0]  # (N_rand, N_samples, 64)
 
+        '''
+        LinGaoyuan_operation_20261018: early exit, after each ray transformer the attention weight of every sample
+        (attention row of the first sample, the same row that gives the density) is accumulated, samples whose mean
+        weight over the layers so far is below early_exit_threshold * (1 / N_samples) are frozen: they keep their last
+        q and skip the view transformer and mlp of the later layers. The ray transformer still runs on all samples
+        since the frozen samples remain keys / values of the active ones.
+        '''
+        early_exit = self.early_exit_threshold > 0 and not self.training
+        active = None
+        cum_attn = None
+
         # transformer modules
         for i, (crosstrans, q_fc, selftrans) in enumerate(
             zip(self.view_crosstrans, self.q_fcs, self.view_selftrans)
@@ -305,16 +441,39 @@ class GNT(nn.Module):
             if self.aliasing_filter is True and i < 2:
                 aliasing_filter = True
 
-            q = crosstrans(q, rgb_feat, ray_diff, mask, aliasing_filter, self.aliasing_filter_type)  # (N_rand, N_samples, 64)
-            # embed positional information
-            if i % 2 == 0:
-                q = torch.cat((q, input_pts, input_views), dim=-1)  # (N_rand, N_samples, 190)  190 = 64+63+63
-                q = q_fc(q)  # (N_rand, N_samples, 64)
+            'LinGaoyuan_operation_20261018: the density only comes from the attention map of the last ray transformer'
+            ret_attn = (self.ret_alpha and i == len(self.view_selftrans) - 1) or early_exit
+            use_checkpoint = use_block_checkpoint(i, self.grad_checkpoint_layers)
+
+            q_prev = q
+            'the aliasing filter works along the samples of a ray, these layers always run on all samples'
+            with profile_stage("view_transformer"):
+                if active is not None and aliasing_filter is False:
+                    q = self.forward_view_active(crosstrans, q_fc, i, q, rgb_feat, ray_diff, mask, input_pts, input_views, active)
+                else:
+                    q = run_block(crosstrans, q, rgb_feat, ray_diff, mask, aliasing_filter, self.aliasing_filter_type, use_checkpoint=use_checkpoint)  # (N_rand, N_samples, 64)
+                    # embed positional information
+                    if i % 2 == 0:
+                        q = torch.cat((q, input_pts, input_views), dim=-1)  # (N_rand, N_samples, 190)  190 = 64+63+63
+                        q = q_fc(q)  # (N_rand, N_samples, 64)
             # ray transformer
-            q = selftrans(q, ret_attn=self.ret_alpha)
+            with profile_stage("ray_transformer"):
+                q = run_block(selftrans, q, ret_attn=ret_attn, use_checkpoint=use_checkpoint)
             # 'learned' density
-            if self.ret_alpha:
+            if ret_attn:
                 q, attn = q
+
+            if early_exit:
+                num_samples = q.shape[0] * q.shape[1]
+                if active is not None:
+                    q = torch.where(active[..., None], q, q_prev)
+                'the counter stays on the device, early_exit_sweep reads it once per threshold'
+                self.num_active_samples = self.num_active_samples + (num_samples if active is None else active.sum())
+                self.num_total_samples += num_samples
+                cum_attn = attn if cum_attn is None else cum_attn + attn
+                'a frozen sample stays frozen, its q is no longer updated even if its mean attention rises again'
+                new_active = cum_attn / (i + 1) * attn.shape[-1] >= self.early_exit_threshold
+                active = new_active if active is None else active & new_active
         # normalize & rgb
         h = self.norm(q)
         outputs = self.rgb_fc(h.mean(dim=1))  # (N_rand, 3)
@@ -344,6 +503,8 @@ class GNT_prop(nn.Module):
                 ff_hid_dim=int(args.netwidth * 4),
                 ff_dp_rate=0.1,
                 attn_dp_rate=0.1,
+                aliasing_filter_type=args.aliasing_filter_type if args.aliasing_filter is True and i < 2 else None,
+                view_chunk_size=args.view_attn_chunk_size,
             )
             self.view_crosstrans.append(view_trans)
             # ray transformer
@@ -353,6 +514,10 @@ class GNT_prop(nn.Module):
                 n_heads=4,
                 ff_dp_rate=0.1,
                 attn_dp_rate=0.1,
+                use_sdpa=args.attn_backend == "sdpa",
+                ray_attn_type=args.ray_attn_type,
+                window_size=args.ray_attn_window,
+                num_global_tokens=args.ray_attn_global_tokens,
             )
             self.view_selftrans.append(ray_trans)
             # mlp
@@ -392,6 +557,9 @@ class GNT_prop(nn.Module):
         self.aliasing_filter = args.aliasing_filter
         self.aliasing_filter_type = args.aliasing_filter_type
 
+        'LinGaoyuan_operation_20261018: number of transformer layers (counted from the input) that use activation checkpointing'
+        self.grad_checkpoint_layers = args.grad_checkpoint_layers
+
     def forward(self, rgb_feat, ray_diff, mask, pts, ray_d):
         # compute positional embeddings
         viewdirs = ray_d  # (N_rand, 63)
@@ -419,15 +587,21 @@ class GNT_prop(nn.Module):
             if self.aliasing_filter is True and i < 2:
                 aliasing_filter = True
 
-            q = crosstrans(q, rgb_feat, ray_diff, mask, aliasing_filter, self.aliasing_filter_type)  # (N_rand, N_samples, 64)
-            # embed positional information
-            if i % 2 == 0:
-                q = torch.cat((q, input_pts, input_views), dim=-1)  # (N_rand, N_samples, 190)  190 = 64+63+63
-                q = q_fc(q)  # (N_rand, N_samples, 64)
+            'LinGaoyuan_operation_20261018: the density only comes from the attention map of the last ray transformer'
+            ret_attn = self.ret_alpha and i == len(self.view_selftrans) - 1
+            use_checkpoint = use_block_checkpoint(i, self.grad_checkpoint_layers)
+
+            with profile_stage("view_transformer"):
+                q = run_block(crosstrans, q, rgb_feat, ray_diff, mask, aliasing_filter, self.aliasing_filter_type, use_checkpoint=use_checkpoint)  # (N_rand, N_samples, 64)
+                # embed positional information
+                if i % 2 == 0:
+                    q = torch.cat((q, input_pts, input_views), dim=-1)  # (N_rand, N_samples, 190)  190 = 64+63+63
+                    q = q_fc(q)  # (N_rand, N_samples, 64)
             # ray transformer
-            q = selftrans(q, ret_attn=self.ret_alpha)
+            with profile_stage("ray_transformer"):
+                q = run_block(selftrans, q, ret_attn=ret_attn, use_checkpoint=use_checkpoint)
             # 'learned' density
-            if self.ret_alpha:
+            if ret_attn:
                 q, attn = q
         # normalize & rgb
         h = self.norm(q)
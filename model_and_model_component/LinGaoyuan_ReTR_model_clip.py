@@ -5,6 +5,8 @@ from einops import (rearrange, reduce, repeat)
 
 from LinGaoyuan_function.ReTR_function.ReTR_grid_sample import grid_sample_2d, grid_sample_3d
 from LinGaoyuan_function.ReTR_function.ReTR_transformer import LocalFeatureTransformer
+from LinGaoyuan_function.ReTR_function.ReTR_feature_volume import sample_feature_volume
+from LinGaoyuan_function.gradient_checkpoint import use_block_checkpoint
 from LinGaoyuan_function.ReTR_function.ReTR_cnn2d import ResidualBlock
 import math
 
@@ -30,7 +32,7 @@ class LinGaoyuan_ReTR_model(nn.Module):
 
         if self.use_volume_feature and self.args.use_retr_feature_extractor:
             self.occu_transformer = LocalFeatureTransformer(d_model=self.in_feat_ch * 2 + self.PE_d_hid, nhead=8, layer_names=['self'],
-                                                            attention='full')
+                                                            attention=args.ray_attn_type, window_size=args.ray_attn_window)
 
             '''
             LinGaoyuan_20240930: add dimension of shape code, if the model is used for building and street, the self.dim_clip_shape_code = 0, 
@@ -60,7 +62,7 @@ class LinGaoyuan_ReTR_model(nn.Module):
             self.RadianceToken = ViewTokenNetwork(dim=self.in_feat_ch * 2 + self.PE_d_hid)
         else:
             self.occu_transformer = LocalFeatureTransformer(d_model=self.in_feat_ch + self.PE_d_hid, nhead=8, layer_names=['self'],
-                                                            attention='full')
+                                                            attention=args.ray_attn_type, window_size=args.ray_attn_window)
             '''
             LinGaoyuan_20240930: add dimension of shape code, if the model is used for building and street, the self.dim_clip_shape_code = 0, 
             and if model is used for car, self.dim_clip_shape_code = 128
@@ -89,29 +91,25 @@ class LinGaoyuan_ReTR_model(nn.Module):
 
         self.softmax = nn.Softmax(dim=-2)
 
-        self.div_term = torch.exp((torch.arange(0, self.PE_d_hid, 2, dtype=torch.float) *
-                            -(math.log(10000.0) / self.PE_d_hid)))
+        '''
+        LinGaoyuan_operation_20261018: div_term of the order positional encoding and the attention mask are (non-persistent)
+        buffers, they follow the model device and are not copied to the device in every forward
+        '''
+        self.register_buffer("div_term", torch.exp((torch.arange(0, self.PE_d_hid, 2, dtype=torch.float) *
+                            -(math.log(10000.0) / self.PE_d_hid))), persistent=False)
+        self.register_buffer("attn_mask", None, persistent=False)
+
+        'LinGaoyuan_operation_20261018: activation checkpointing of view_transformer (block 0) and occu_transformer (block 1)'
+        self.view_transformer.grad_checkpoint = use_block_checkpoint(0, args.grad_checkpoint_layers)
+        self.occu_transformer.grad_checkpoint = use_block_checkpoint(1, args.grad_checkpoint_layers)
 
-    def order_posenc(self, z_vals):
-        """
-        :param d_model: dimension of the model
-        :param length: length of positions
-        :return: length*d_model position matrix
-        """
-        if self.PE_d_hid  % 2 != 0:
-            raise ValueError("Cannot use sin/cos positional encoding with "
-                            "odd dim (got dim={:d})".format(self.PE_d_hid))
-        pe = torch.zeros(z_vals.shape[0],z_vals.shape[1], self.PE_d_hid).to(z_vals.device)
-        position = z_vals.unsqueeze(-1)
-        # div_term = torch.exp((torch.arange(0, d_model, 2, dtype=torch.float) *
-        #                     -(math.log(10000.0) / d_model))).to(z_vals.device)
-        pe[:, :, 0::2] = torch.sin(position.float() * self.div_term.to(z_vals.device))
-        pe[:, :, 1::2] = torch.cos(position.float() * self.div_term.to(z_vals.device))
-        return pe
     def get_attn_mask(self, num_points):
-        mask = (torch.triu(torch.ones(1, num_points+1, num_points+1)) == 1).transpose(1, 2)
-    #    mask[:,0, 1:] = 0
-        return mask
+        'the mask is cached in the attn_mask buffer and only rebuilt when num_points changes'
+        if self.attn_mask is None or self.attn_mask.shape[-1] != num_points + 1:
+            mask = (torch.triu(torch.ones(1, num_points+1, num_points+1, device=self.div_term.device)) == 1).transpose(1, 2)
+        #    mask[:,0, 1:] = 0
+            self.attn_mask = mask.float()
+        return self.attn_mask
     def order_posenc(self, z_vals):
         """
         :param d_model: dimension of the model
@@ -121,12 +119,12 @@ class LinGaoyuan_ReTR_model(nn.Module):
         if self.PE_d_hid  % 2 != 0:
             raise ValueError("Cannot use sin/cos positional encoding with "
                             "odd dim (got dim={:d})".format(self.PE_d_hid))
-        pe = torch.zeros(z_vals.shape[0],z_vals.shape[1], self.PE_d_hid).to(z_vals.device)
-        position = z_vals.unsqueeze(-1)
+        position = z_vals.unsqueeze(-1).float()
         # div_term = torch.exp((torch.arange(0, d_model, 2, dtype=torch.float) *
         #                     -(math.log(10000.0) / d_model))).to(z_vals.device)
-        pe[:, :, 0::2] = torch.sin(position.float() * self.div_term.to(z_vals.device))
-        pe[:, :, 1::2] = torch.cos(position.float() * self.div_term.to(z_vals.device))
+        'LinGaoyuan_operation_20261018: sin at the even and cos at the odd channels, written with one stack instead of into a zero tensor'
+        angle = position * self.div_term
+        pe = torch.stack([torch.sin(angle), torch.cos(angle)], dim=-1).flatten(-2)
         return pe
 
     'LinGaoyuan_20240930: retr model + model_and_model_component feature extractor or retr model + retr feature extractor'
@@ -172,7 +170,7 @@ class LinGaoyuan_ReTR_model(nn.Module):
         output_occ = self.occu_transformer(input_occ)
 
         output_ray = self.ray_transformer(output_occ[:,:1], output_occ[:,1:])
-        weight = self.ray_transformer.atten_weight.squeeze()
+        weight = self.ray_transformer.pop_atten_weight().squeeze()
 
         rgb = torch.sigmoid(self.RadianceMLP(output_ray))
 
@@ -242,7 +240,7 @@ class LinGaoyuan_ReTR_model(nn.Module):
             output_occ = torch.cat((output_occ,clip_shape_code), dim=-1)
             output_ray = self.ray_transformer(output_occ[:, :1], output_occ[:, 1:])
 
-        weight = self.ray_transformer.atten_weight.squeeze()
+        weight = self.ray_transformer.pop_atten_weight().squeeze()
 
         'LinGaoyuan_20240930: cat clip radiance code as the input of self.RadianceMLP()'
         clip_appearance_code = clip_appearance_code.repeat((output_ray.shape)[0], (output_ray.shape)[1], 1)
@@ -270,7 +268,7 @@ class LinGaoyuan_ReTR_model(nn.Module):
         dir_relative = ray_diff[:,:,:,:3]
 
         if fea_volume is not None:
-            fea_volume_feat = grid_sample_3d(fea_volume, point3D[None,None,...].float())
+            fea_volume_feat = sample_feature_volume(fea_volume, point3D[None,None,...].float())
             fea_volume_feat = rearrange(fea_volume_feat, "B C RN SN -> (B RN SN) C")
 
         # input_view = self.rgbfeat_fc(source_imgs_feat)  # LinGaoyuan_20240916: (N_rand, N_samples, n_views, 35) -> (N_rand, N_samples, n_views, 32)
@@ -310,7 +308,7 @@ class LinGaoyuan_ReTR_model(nn.Module):
         output_occ = self.occu_transformer(input_occ)  # output_occ: (N_rand, N_sample+1, 72), input_occ: (N_rand, N_sample+1, 72)
 
         output_ray = self.ray_transformer(output_occ[:,:1], output_occ[:,1:])  # output_ray: (N_rand, 1, 72)
-        weight = self.ray_transformer.atten_weight.squeeze()
+        weight = self.ray_transformer.pop_atten_weight().squeeze()
 
         rgb = torch.sigmoid(self.RadianceMLP(output_ray))
 
@@ -343,7 +341,7 @@ class LinGaoyuan_ReTR_model(nn.Module):
 
 
         if fea_volume is not None:
-            fea_volume_feat = grid_sample_3d(fea_volume, point3D[None,None,...].float())
+            fea_volume_feat = sample_feature_volume(fea_volume, point3D[None,None,...].float())
             fea_volume_feat = rearrange(fea_volume_feat, "B C RN SN -> (B RN SN) C")
 
         # input_view = self.rgbfeat_fc(source_imgs_feat)  # LinGaoyuan_20240916: (N_rand, N_samples, n_views, 35) -> (N_rand, N_samples, n_views, 32)
@@ -391,7 +389,7 @@ class LinGaoyuan_ReTR_model(nn.Module):
             output_occ = torch.cat((output_occ,clip_shape_code), dim=-1)
             output_ray = self.ray_transformer(output_occ[:, :1], output_occ[:, 1:])
 
-        weight = self.ray_transformer.atten_weight.squeeze()
+        weight = self.ray_transformer.pop_atten_weight().squeeze()
 
         'LinGaoyuan_20240930: cat clip radiance code as the input of self.RadianceMLP()'
         clip_appearance_code = clip_appearance_code.repeat((output_ray.shape)[0], (output_ray.shape)[1], 1)
@@ -434,7 +432,7 @@ class LinGaoyuan_ReTR_model(nn.Module):
 
 
         if fea_volume is not None:
-            fea_volume_feat = grid_sample_3d(fea_volume, point3D.unsqueeze(1).float())
+            fea_volume_feat = sample_feature_volume(fea_volume, point3D.unsqueeze(1).float())
             fea_volume_feat = rearrange(fea_volume_feat, "B C RN SN -> (B RN SN) C")
         # -------- project points to feature map
         # B NV RN SN CN DimXYZ
@@ -531,7 +529,7 @@ class LinGaoyuan_ReTR_model(nn.Module):
 
         # calculate weight using view transformers result
         x = self.ray_transformer(x[:, :1], x[:,1:])
-        weights = self.ray_transformer.atten_weight.squeeze()
+        weights = self.ray_transformer.pop_atten_weight().squeeze()
 
         rgb = torch.sigmoid(self.RadianceMLP(x))
 
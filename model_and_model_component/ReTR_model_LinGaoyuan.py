@@ -5,6 +5,9 @@ from einops import (rearrange, reduce, repeat)
 
 from LinGaoyuan_function.ReTR_function.ReTR_grid_sample import grid_sample_2d, grid_sample_3d
 from LinGaoyuan_function.ReTR_function.ReTR_transformer import LocalFeatureTransformer
+from LinGaoyuan_function.ReTR_function.ReTR_feature_volume import sample_feature_volume
+from LinGaoyuan_function.gradient_checkpoint import use_block_checkpoint
+from LinGaoyuan_function.step_profiler import profile_stage
 from LinGaoyuan_function.ReTR_function.ReTR_cnn2d import ResidualBlock
 import math
 
@@ -26,11 +29,12 @@ class LinGaoyuan_ReTR_model(nn.Module):
 
         'LinGaoyuan_20240915: 3 Transformer network in ReTR'
         self.view_transformer = LocalFeatureTransformer(d_model=self.in_feat_ch, nhead=8, layer_names=['self'],
-                                                        attention='linear')
+                                                        attention='linear',
+                                                        aliasing_filter_type=self.aliasing_filter_type if self.aliasing_filter is True else None)
 
         if self.use_volume_feature and self.args.use_retr_feature_extractor:
             self.occu_transformer = LocalFeatureTransformer(d_model=self.in_feat_ch * 2 + self.PE_d_hid, nhead=8, layer_names=['self'],
-                                                            attention='full')
+                                                            attention=args.ray_attn_type, window_size=args.ray_attn_window)
             self.ray_transformer = LocalFeatureTransformer(d_model=self.in_feat_ch * 2 + self.PE_d_hid, nhead=1, layer_names=['cross'],
                                                            attention='full')
 
@@ -50,7 +54,7 @@ class LinGaoyuan_ReTR_model(nn.Module):
             self.RadianceToken = ViewTokenNetwork(dim=self.in_feat_ch * 2 + self.PE_d_hid)
         else:
             self.occu_transformer = LocalFeatureTransformer(d_model=self.in_feat_ch + self.PE_d_hid, nhead=8, layer_names=['self'],
-                                                            attention='full')
+                                                            attention=args.ray_attn_type, window_size=args.ray_attn_window)
             self.ray_transformer = LocalFeatureTransformer(d_model=self.in_feat_ch + self.PE_d_hid, nhead=1, layer_names=['cross'],
                                                            attention='full')
 
@@ -74,29 +78,28 @@ class LinGaoyuan_ReTR_model(nn.Module):
 
         self.softmax = nn.Softmax(dim=-2)
 
-        self.div_term = torch.exp((torch.arange(0, self.PE_d_hid, 2, dtype=torch.float) *
-                            -(math.log(10000.0) / self.PE_d_hid)))
+        '''
+        LinGaoyuan_operation_20261018: div_term of the order positional encoding and the attention mask are (non-persistent)
+        buffers, they follow the model device and are not copied to the device in every forward
+        '''
+        self.register_buffer("div_term", torch.exp((torch.arange(0, self.PE_d_hid, 2, dtype=torch.float) *
+                            -(math.log(10000.0) / self.PE_d_hid))), persistent=False)
+        self.register_buffer("attn_mask", None, persistent=False)
+
+        '''
+        LinGaoyuan_operation_20261018: activation checkpointing, the blocks are counted from the input:
+        view_transformer is block 0 and occu_transformer is block 1, ray_transformer is not checkpointed
+        '''
+        self.view_transformer.grad_checkpoint = use_block_checkpoint(0, args.grad_checkpoint_layers)
+        self.occu_transformer.grad_checkpoint = use_block_checkpoint(1, args.grad_checkpoint_layers)
 
-    def order_posenc(self, z_vals):
-        """
-        :param d_model: dimension of the model
-        :param length: length of positions
-        :return: length*d_model position matrix
-        """
-        if self.PE_d_hid  % 2 != 0:
-            raise ValueError("Cannot use sin/cos positional encoding with "
-                            "odd dim (got dim={:d})".format(self.PE_d_hid))
-        pe = torch.zeros(z_vals.shape[0],z_vals.shape[1], self.PE_d_hid).to(z_vals.device)
-        position = z_vals.unsqueeze(-1)
-        # div_term = torch.exp((torch.arange(0, d_model, 2, dtype=torch.float) *
-        #                     -(math.log(10000.0) / d_model))).to(z_vals.device)
-        pe[:, :, 0::2] = torch.sin(position.float() * self.div_term.to(z_vals.device))
-        pe[:, :, 1::2] = torch.cos(position.float() * self.div_term.to(z_vals.device))
-        return pe
     def get_attn_mask(self, num_points):
-        mask = (torch.triu(torch.ones(1, num_points+1, num_points+1)) == 1).transpose(1, 2)
-    #    mask[:,0, 1:] = 0
-        return mask
+        'the mask is cached in the attn_mask buffer and only rebuilt when num_points changes'
+        if self.attn_mask is None or self.attn_mask.shape[-1] != num_points + 1:
+            mask = (torch.triu(torch.ones(1, num_points+1, num_points+1, device=self.div_term.device)) == 1).transpose(1, 2)
+        #    mask[:,0, 1:] = 0
+            self.attn_mask = mask.float()
+        return self.attn_mask
     def order_posenc(self, z_vals):
         """
         :param d_model: dimension of the model
@@ -106,12 +109,12 @@ class LinGaoyuan_ReTR_model(nn.Module):
         if self.PE_d_hid  % 2 != 0:
             raise ValueError("Cannot use sin/cos positional encoding with "
                             "odd dim (got dim={:d})".format(self.PE_d_hid))
-        pe = torch.zeros(z_vals.shape[0],z_vals.shape[1], self.PE_d_hid).to(z_vals.device)
-        position = z_vals.unsqueeze(-1)
+        position = z_vals.unsqueeze(-1).float()
         # div_term = torch.exp((torch.arange(0, d_model, 2, dtype=torch.float) *
         #                     -(math.log(10000.0) / d_model))).to(z_vals.device)
-        pe[:, :, 0::2] = torch.sin(position.float() * self.div_term.to(z_vals.device))
-        pe[:, :, 1::2] = torch.cos(position.float() * self.div_term.to(z_vals.device))
+        'LinGaoyuan_operation_20261018: sin at the even and cos at the odd channels, written with one stack instead of into a zero tensor'
+        angle = position * self.div_term
+        pe = torch.stack([torch.sin(angle), torch.cos(angle)], dim=-1).flatten(-2)
         return pe
 
     'LinGaoyuan_20240930: retr model + model_and_model_component feature extractor or retr model + retr feature extractor'
@@ -128,7 +131,8 @@ class LinGaoyuan_ReTR_model(nn.Module):
         input_view = img_feat_sampled  # LinGaoyuan_20240916: (N_rand, N_samples, n_views, 32)
         input_view = rearrange(input_view, 'N_rand N_samples n_views C -> (N_rand N_samples) n_views C')
 
-        output_view = self.view_transformer(input_view, aliasing_filter=self.aliasing_filter, aliasing_filter_type=self.aliasing_filter_type)
+        with profile_stage("view_transformer"):
+            output_view = self.view_transformer(input_view, aliasing_filter=self.aliasing_filter, aliasing_filter_type=self.aliasing_filter_type)
 
         # output_view = output_view.permute(2,0,1,3)  # LinGaoyuan_20240916: (N_rand, N_samples, n_views, 32) -> (n_views, N_rand, N_samples, 32)
 
@@ -154,10 +158,11 @@ class LinGaoyuan_ReTR_model(nn.Module):
         radiance_tokens = self.RadianceToken(input_occ).unsqueeze(1)
         input_occ = torch.cat((radiance_tokens, input_occ), dim=1)
 
-        output_occ = self.occu_transformer(input_occ)
+        with profile_stage("ray_transformer"):
+            output_occ = self.occu_transformer(input_occ)
 
-        output_ray = self.ray_transformer(output_occ[:,:1], output_occ[:,1:])
-        weight = self.ray_transformer.atten_weight.squeeze()
+            output_ray = self.ray_transformer(output_occ[:,:1], output_occ[:,1:])
+        weight = self.ray_transformer.pop_atten_weight().squeeze()
 
         rgb = torch.sigmoid(self.RadianceMLP(output_ray))
 
@@ -181,7 +186,7 @@ class LinGaoyuan_ReTR_model(nn.Module):
         dir_relative = ray_diff[:,:,:,:3]
 
         if fea_volume is not None:
-            fea_volume_feat = grid_sample_3d(fea_volume, point3D[None,None,...].float())
+            fea_volume_feat = sample_feature_volume(fea_volume, point3D[None,None,...].float())
             fea_volume_feat = rearrange(fea_volume_feat, "B C RN SN -> (B RN SN) C")
 
         # input_view = self.rgbfeat_fc(source_imgs_feat)  # LinGaoyuan_20240916: (N_rand, N_samples, n_views, 35) -> (N_rand, N_samples, n_views, 32)
@@ -191,7 +196,8 @@ class LinGaoyuan_ReTR_model(nn.Module):
         if fea_volume is not None:
             input_view = torch.cat((fea_volume_feat.unsqueeze(1), input_view), dim=1)
 
-        output_view = self.view_transformer(input_view, aliasing_filter=self.aliasing_filter, aliasing_filter_type=self.aliasing_filter_type)
+        with profile_stage("view_transformer"):
+            output_view = self.view_transformer(input_view, aliasing_filter=self.aliasing_filter, aliasing_filter_type=self.aliasing_filter_type)
 
         # output_view = output_view.permute(2,0,1,3)  # LinGaoyuan_20240916: (N_rand, N_samples, n_views, 32) -> (n_views, N_rand, N_samples, 32)
 
@@ -218,10 +224,11 @@ class LinGaoyuan_ReTR_model(nn.Module):
         radiance_tokens = self.RadianceToken(input_occ).unsqueeze(1)
         input_occ = torch.cat((radiance_tokens, input_occ), dim=1)
 
-        output_occ = self.occu_transformer(input_occ)
+        with profile_stage("ray_transformer"):
+            output_occ = self.occu_transformer(input_occ)
 
-        output_ray = self.ray_transformer(output_occ[:,:1], output_occ[:,1:])
-        weight = self.ray_transformer.atten_weight.squeeze()
+            output_ray = self.ray_transformer(output_occ[:,:1], output_occ[:,1:])
+        weight = self.ray_transformer.pop_atten_weight().squeeze()
 
         rgb = torch.sigmoid(self.RadianceMLP(output_ray))
 
@@ -260,7 +267,7 @@ class LinGaoyuan_ReTR_model(nn.Module):
 
 
         if fea_volume is not None:
-            fea_volume_feat = grid_sample_3d(fea_volume, point3D.unsqueeze(1).float())
+            fea_volume_feat = sample_feature_volume(fea_volume, point3D.unsqueeze(1).float())
             fea_volume_feat = rearrange(fea_volume_feat, "B C RN SN -> (B RN SN) C")
         # -------- project points to feature map
         # B NV RN SN CN DimXYZ
@@ -357,7 +364,7 @@ class LinGaoyuan_ReTR_model(nn.Module):
 
         # calculate weight using view transformers result
         x = self.ray_transformer(x[:, :1], x[:,1:])
-        weights = self.ray_transformer.atten_weight.squeeze()
+        weights = self.ray_transformer.pop_atten_weight().squeeze()
 
         rgb = torch.sigmoid(self.RadianceMLP(x))
 
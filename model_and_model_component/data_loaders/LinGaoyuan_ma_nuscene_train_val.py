@@ -280,6 +280,7 @@ class NusceneDataset_train_val(Dataset):
             "src_cameras": torch.from_numpy(src_cameras),
             "src_sky_masks": torch.from_numpy(src_sky_masks),
             "src_depth_values": torch.from_numpy(src_depth_values),
+            "src_ids": torch.from_numpy(np.array(nearest_pose_ids, dtype=np.int64)),
             "depth_range": depth_range,
             "idx": idx,
         }
@@ -0,0 +1,163 @@
+import os
+import numpy as np
+import torch
+
+
+########################################################################################################################
+# scene-level cache of source view feature maps for inference
+########################################################################################################################
+
+
+class SourceFeatureBank(object):
+    """
+    Per-scene feature bank: the feature extractor runs once per source frame and the resulting feature maps are
+    served by frame id to every target view that uses this frame as a source view. Consecutive target views share
+    most of their source frames, so rendering many views of one scene amortises the CNN almost completely.
+
+    The bank is only valid as long as the weights of the feature extractor do not change, it is meant to be used
+    in eval mode (eval_LinGaoyuan.py, render_ray_for_3d_vis, update_prior_depth_value). Call clear() after the
+    weights have been updated.
+    """
+
+    def __init__(self, args, model, half_precision=False, mmap_dir=None):
+        """
+        :param model: Model, the feature extractor (feature_net or retr_feature_extractor) is taken from it
+        :param half_precision: if True, the feature maps are stored as float16 and cast back to float32 when served
+        :param mmap_dir: if not None, the feature maps are written to .npy files in this directory and memory-mapped
+        """
+        self.args = args
+        self.model = model
+        self.storage_dtype = torch.float16 if half_precision else torch.float32
+        self.mmap_dir = mmap_dir
+        if self.mmap_dir is not None:
+            os.makedirs(self.mmap_dir, exist_ok=True)
+
+        # frame id -> list of stored levels, each level is [C, h, w]
+        self.frames = {}
+        # level_alias[l] = j means the extractor returned the same tensor for level l and level j (single_net)
+        self.level_alias = None
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, frame_id):
+        return frame_id in self.frames
+
+    def clear(self):
+        self.frames = {}
+        self.level_alias = None
+        self.num_hits = 0
+        self.num_misses = 0
+
+    @torch.no_grad()
+    def extract(self, src_rgbs):
+        """
+        :param src_rgbs: [n_views, h, w, 3]
+        :return: list of feature levels, each [n_views, C, h', w']
+        """
+        x = src_rgbs.permute(0, 3, 1, 2)
+        if self.args.use_retr_feature_extractor is True:
+            featmaps, fpn = self.model.retr_feature_extractor(x)
+            return [featmaps] + list(fpn)
+        return list(self.model.feature_net(x))
+
+    def _store(self, frame_id, levels):
+        stored = []
+        for l, level in enumerate(levels):
+            if self.level_alias[l] != l:
+                stored.append(None)
+                continue
+            level = level.detach().to(self.storage_dtype)
+            if self.mmap_dir is not None:
+                fpath = os.path.join(self.mmap_dir, "frame_{:06d}_level_{}.npy".format(frame_id, l))
+                np.save(fpath, level.cpu().numpy())
+                level = np.load(fpath, mmap_mode="r")
+            stored.append(level)
+        self.frames[frame_id] = stored
+
+    def _load(self, frame_id, level_idx, device):
+        level = self.frames[frame_id][level_idx]
+        if isinstance(level, np.ndarray):
+            level = torch.from_numpy(np.array(level))
+        return level.to(device=device, dtype=torch.float32)
+
+    def _pack(self, levels):
+        'same structure as the output of feature_net / retr_feature_extractor'
+        if self.args.use_retr_feature_extractor is True:
+            return levels[0], levels[1:]
+        return tuple(levels)
+
+    @torch.no_grad()
+    def featmaps(self, ray_batch):
+        """
+        :param ray_batch: must contain 'src_ids' [1, n_views] and 'src_rgbs' [1, n_views, h, w, 3]
+        :return: feature maps of the source views in the same format as the feature extractor output
+        """
+        src_rgbs = ray_batch["src_rgbs"].squeeze(0)
+
+        'the source images are rotated per target view when rectify_inplane_rotation is set, they can not be shared'
+        if self.args.rectify_inplane_rotation or ray_batch.get("src_ids") is None:
+            return self._pack(self.extract(src_rgbs))
+
+        src_ids = [int(i) for i in ray_batch["src_ids"].reshape(-1).tolist()]
+
+        missing = {}
+        for view_idx, frame_id in enumerate(src_ids):
+            if frame_id not in self.frames and frame_id not in missing:
+                missing[frame_id] = view_idx
+
+        if len(missing) > 0:
+            outputs = self.extract(src_rgbs[list(missing.values())])
+            if self.level_alias is None:
+                self.level_alias = [
+                    next(j for j in range(l + 1) if outputs[j] is outputs[l]) for l in range(len(outputs))
+                ]
+            for k, frame_id in enumerate(missing.keys()):
+                self._store(frame_id, [output[k] for output in outputs])
+
+        self.num_misses += len(missing)
+        self.num_hits += len(src_ids) - len(missing)
+
+        device = src_rgbs.device
+        levels = []
+        for l in range(len(self.level_alias)):
+            'keep the aliasing of the extractor output, e.g. coarse and fine maps are the same tensor for single_net'
+            if self.level_alias[l] != l:
+                levels.append(levels[self.level_alias[l]])
+            else:
+                levels.append(torch.stack([self._load(frame_id, l, device) for frame_id in src_ids], dim=0))
+        return self._pack(levels)
+
+    @torch.no_grad()
+    def lookup(self, ray_batch):
+        """
+        :return: featmaps, feature_volume (None if the volume feature of ReTR is not used)
+        """
+        featmaps = self.featmaps(ray_batch)
+        feature_volume = None
+        if self.args.use_retr_feature_extractor is True:
+            featmaps, fpn = featmaps
+            if self.args.use_volume_feature is True:
+                feature_volume = self.model.retr_feature_volume(fpn, ray_batch)
+        return featmaps, feature_volume
+
+
+def scene_feature_bank(args, model, feature_banks, data, split=""):
+    """
+    the frame ids of a bank (nearest_pose_ids) are indices into the pose list of one scene, so every scene gets its own
+    bank. The scene of a batch is the directory two levels above its rgb_path.
+    :param feature_banks: dict scene -> SourceFeatureBank, the bank of a new scene is added to it
+    :param split: subdirectory of the memory-mapped files, for banks of several splits of the same scene
+    """
+    scene = os.path.dirname(os.path.dirname(data["rgb_path"][0]))
+    if scene not in feature_banks:
+        mmap_dir = None
+        if args.feature_bank_dir is not None:
+            mmap_dir = os.path.join(args.feature_bank_dir, os.path.basename(scene), split)
+        feature_banks[scene] = SourceFeatureBank(
+            args, model, half_precision=args.feature_bank_half, mmap_dir=mmap_dir
+        )
+    return feature_banks[scene]
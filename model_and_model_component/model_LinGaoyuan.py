@@ -5,7 +5,8 @@ from model_and_model_component.GNT_feature_extractor import ResUNet
 
 from model_and_model_component.ReTR_model_LinGaoyuan import LinGaoyuan_ReTR_model
 from LinGaoyuan_function.ReTR_function.ReTR_feature_extractor import FPN_FeatureExtractor
-from LinGaoyuan_function.ReTR_function.ReTR_feature_volume import FeatureVolume
+from LinGaoyuan_function.ReTR_function.ReTR_feature_volume import build_feature_volume
+from LinGaoyuan_function.checkpoint_manifest import latest_checkpoint, checkpoint_step, load_checkpoint, skipped_state_keys
 
 
 def de_parallel(model):
@@ -18,7 +19,11 @@ def de_parallel(model):
 
 
 class Model(object):
-    def __init__(self, args, load_opt=True, load_scheduler=True):
+    def __init__(self, args, load_opt=True, load_scheduler=True, ddp_wrap=True):
+        '''
+        :param ddp_wrap: wrap every network in DistributedDataParallel if args.distributed, False if the networks are
+        wrapped together with the sky model (JointTrainingModule)
+        '''
         self.args = args
         device = torch.device("cuda:{}".format(args.local_rank))
 
@@ -67,7 +72,7 @@ class Model(object):
             ).to(device)
 
         if self.args.use_volume_feature is True and self.args.use_retr_feature_extractor is True:
-            self.retr_feature_volume = FeatureVolume(volume_reso=100).to(device)
+            self.retr_feature_volume = build_feature_volume(args, volume_reso=100).to(device)
 
         test_a = hasattr(self, 'retr_feature_volume')
 
@@ -148,7 +153,7 @@ class Model(object):
             out_folder, load_opt=load_opt, load_scheduler=load_scheduler
         )
 
-        if args.distributed:
+        if args.distributed and ddp_wrap:
             self.net_coarse = torch.nn.parallel.DistributedDataParallel(
                 self.net_coarse, device_ids=[args.local_rank], output_device=args.local_rank
             )
@@ -210,7 +215,10 @@ class Model(object):
         if hasattr(self, 'net_fine') and self.net_fine is not None:
             self.net_fine.train()
 
-    def save_model(self, filename):
+    def save_model(self, filename, checkpoint_writer=None):
+        '''
+        :param checkpoint_writer: CheckpointWriter, if not None the file is written in its background thread
+        '''
         ''
         # to_save = {
         #     "optimizer": self.optimizer.state_dict(),
@@ -261,13 +269,14 @@ class Model(object):
                 "feature_net": de_parallel(self.feature_net).state_dict(),
             }
 
-        torch.save(to_save, filename)
+        if checkpoint_writer is not None:
+            checkpoint_writer.save(to_save, filename)
+        else:
+            torch.save(to_save, filename)
 
     def load_model(self, filename, load_opt=True, load_scheduler=True):
-        if self.args.distributed:
-            to_load = torch.load(filename, map_location="cuda:{}".format(self.args.local_rank))
-        else:
-            to_load = torch.load(filename)
+        'LinGaoyuan_operation_20261018: memory-mapped load, the optimizer / scheduler state is not read if it is not used'
+        to_load = load_checkpoint(filename, skip_keys=skipped_state_keys(load_opt, load_scheduler))
         # print(to_load["net_coarse"].keys())
         # exit()
         if load_opt:
@@ -315,30 +324,16 @@ class Model(object):
         :return: the current starting step
         """
 
-        # all existing ckpts
-        ckpts = []
-        if os.path.exists(out_folder):
-            ckpts = [
-                os.path.join(out_folder, f)
-                for f in sorted(os.listdir(out_folder))
-                if f.endswith(".pth")
-            ]
-
-        'LinGaoyuan code: remove all the elements in ckpts which name contains sky_model'
-        ckpts_copy = ckpts.copy()
-        for i in ckpts:
-            if i.split("/")[-1].find('sky_model') == 0:
-                ckpts_copy.remove(i)
-        ckpts = ckpts_copy
+        'LinGaoyuan_operation_20261018: latest model_*.pth from the ckpt manifest (or the numbered files of the folder)'
+        fpath = latest_checkpoint(out_folder, "model")
 
         if self.args.ckpt_path is not None and not force_latest_ckpt:
             if os.path.isfile(self.args.ckpt_path):  # load the specified ckpt
-                ckpts = [self.args.ckpt_path]
+                fpath = self.args.ckpt_path
 
-        if len(ckpts) > 0 and not self.args.no_reload:
-            fpath = ckpts[-1]
+        if fpath is not None and not self.args.no_reload:
             self.load_model(fpath, load_opt, load_scheduler)
-            step = int(fpath[-10:-4])
+            step = checkpoint_step(fpath)
             print("Reloading from {}, starting at step={}".format(fpath, step))
         else:
             print("No ckpts found, training from scratch...")
@@ -5,7 +5,7 @@ from model_and_model_component.GNT_feature_extractor import ResUNet
 
 from model_and_model_component.LinGaoyuan_ReTR_model_clip import LinGaoyuan_ReTR_model
 from LinGaoyuan_function.ReTR_function.ReTR_feature_extractor import FPN_FeatureExtractor
-from LinGaoyuan_function.ReTR_function.ReTR_feature_volume import FeatureVolume
+from LinGaoyuan_function.ReTR_function.ReTR_feature_volume import build_feature_volume
 
 
 def de_parallel(model):
@@ -74,7 +74,7 @@ class GNTModel(object):
             ).to(device)
 
         if self.args.use_volume_feature is True and self.args.use_retr_feature_extractor is True:
-            self.retr_feature_volume = FeatureVolume(volume_reso=100).to(device)
+            self.retr_feature_volume = build_feature_volume(args, volume_reso=100).to(device)
 
         test_a = hasattr(self, 'retr_feature_volume')
 
@@ -1,10 +1,20 @@
 import torch
 import torch.nn.functional as F
 
+from model_and_model_component.GNT_feature_extractor import build_feature_pyramid
+from LinGaoyuan_function.step_profiler import profiled
+
 
 class Projector:
-    def __init__(self, device):
+    def __init__(self, device, mip_levels=1):
+        """
+        :param mip_levels: number of levels of the feature pyramid, if > 1 the features are sampled from the pyramid
+        level that matches the projected pixel footprint of each sample (cone-traced anti-aliasing)
+        """
         self.device = device
+        self.mip_levels = mip_levels
+        # the pyramid of the last featmaps in inference (no grad), featmaps stay the same for all chunks of an image
+        self._pyramid_cache = (None, None)
 
     def inbound(self, pixel_locations, h, w):
         """
@@ -28,11 +38,12 @@ class Projector:
         )  # [n_views, n_points, 2]
         return normalized_pixel_locations
 
-    def compute_projections(self, xyz, train_cameras):
+    def compute_projections(self, xyz, train_cameras, ret_depth=False):
         """
         project 3D points into cameras
         :param xyz: [..., 3]
         :param train_cameras: [n_views, 34], 34 = img_size(2) + intrinsics(16) + extrinsics(16)
+        :param ret_depth: if True, also return the depth of the points in each camera [n_views, ...]
         :return: pixel locations [..., 2], mask [...]
         """
         original_shape = xyz.shape[:2]
@@ -53,10 +64,81 @@ class Projector:
         )  # [n_views, n_points, 2]
         pixel_locations = torch.clamp(pixel_locations, min=-1e6, max=1e6)
         mask = projections[..., 2] > 0  # a point is invalid if behind the camera
+        if ret_depth:
+            return (
+                pixel_locations.reshape((num_views,) + original_shape + (2,)),
+                mask.reshape((num_views,) + original_shape),
+                projections[..., 2].reshape((num_views,) + original_shape),
+            )
         return pixel_locations.reshape((num_views,) + original_shape + (2,)), mask.reshape(
             (num_views,) + original_shape
         )
 
+    def compute_mip_level(self, xyz, query_camera, train_cameras, src_depth, feat_w, w):
+        """
+        estimate the pyramid level of each sample from its projected pixel footprint:
+        a pixel of the query camera covers a cone, its radius at the sample is z_query / f_query,
+        seen from a source camera this radius covers f_src * z_query / (f_query * z_src) source pixels
+        :param xyz: [n_rays, n_samples, 3]
+        :param query_camera: [34, ]
+        :param train_cameras: [n_views, 34]
+        :param src_depth: [n_views, n_rays, n_samples], depth of the samples in the source cameras
+        :param feat_w: width of the full resolution feature map
+        :param w: width of the source image
+        :return: continuous mip level, [n_views, n_rays, n_samples], >= 0
+        """
+        query_intrinsics = query_camera[2:18].reshape(4, 4)
+        query_pose = query_camera[-16:].reshape(4, 4)
+        train_focal = train_cameras[:, 2:18].reshape(-1, 4, 4)[:, 0, 0]  # [n_views, ]
+
+        query_depth = ((xyz - query_pose[:3, 3]) * query_pose[:3, 2]).sum(dim=-1)  # [n_rays, n_samples]
+        footprint = (
+            train_focal[:, None, None] * query_depth.abs()[None] / query_intrinsics[0, 0]
+        ) / torch.clamp(src_depth, min=1e-6)  # [n_views, n_rays, n_samples], in source image pixels
+        footprint = footprint * feat_w / w  # in feature map pixels
+        return torch.log2(torch.clamp(footprint, min=1.0))
+
+    def feature_pyramid(self, featmaps):
+        if isinstance(featmaps, (list, tuple)):
+            return featmaps
+        if torch.is_grad_enabled():
+            'in training the cache would keep the featmaps and the pyramid of the last step alive until the next one'
+            return build_feature_pyramid(featmaps, self.mip_levels)
+        if self._pyramid_cache[0] is not featmaps:
+            self._pyramid_cache = (featmaps, build_feature_pyramid(featmaps, self.mip_levels))
+        return self._pyramid_cache[1]
+
+    def sample_feature_pyramid(self, pyramid, normalized_pixel_locations, mip_level):
+        """
+        blend the bilinear samples of the two pyramid levels around the mip level of each sample
+        :param pyramid: list of [n_views, d, h_l, w_l]
+        :param normalized_pixel_locations: [n_views, n_rays, n_samples, 2], align_corners=True coordinates of level 0
+        :param mip_level: [n_views, n_rays, n_samples]
+        :return: [n_views, d, n_rays, n_samples]
+        """
+        'texel i of level 0 is centred at fine pixel i, texel j of level l at fine pixel 2^l * j + (2^l - 1) / 2'
+        fine_size = normalized_pixel_locations.new_tensor([pyramid[0].shape[-1], pyramid[0].shape[-2]])  # (w, h)
+        fine_pixel_locations = (normalized_pixel_locations + 1.0) / 2.0 * (fine_size - 1.0)
+
+        feat_sampled = 0
+        for l, featmaps in enumerate(pyramid):
+            level_weight = torch.clamp(1.0 - torch.abs(mip_level - l), min=0.0)  # [n_views, n_rays, n_samples]
+            if l == 0:
+                grid, align_corners = normalized_pixel_locations, True
+            else:
+                """
+                with align_corners=False the grid spans the texel edges, level l covers 2^l * w_l fine pixels (with
+                ceil_mode, w_l = ceil(w / 2^l)), so the texel centres of all levels line up with the fine pixels
+                """
+                level_extent = normalized_pixel_locations.new_tensor(
+                    [featmaps.shape[-1] * 2 ** l, featmaps.shape[-2] * 2 ** l]
+                )
+                grid, align_corners = (fine_pixel_locations + 0.5) * 2.0 / level_extent - 1.0, False
+            feat_sampled = feat_sampled + level_weight[:, None] * F.grid_sample(
+                featmaps, grid, align_corners=align_corners
+            )
+        return feat_sampled
+
     def compute_angle(self, xyz, query_camera, train_cameras):
         """
         :param xyz: [..., 3]
@@ -84,6 +166,7 @@ class Projector:
         ray_diff = ray_diff.reshape((num_views,) + original_shape + (4,))
         return ray_diff
 
+    @profiled("projection")
     def compute(self, xyz, query_camera, train_imgs, train_cameras, featmaps):
         """
         :param xyz: [n_rays, n_samples, 3]
@@ -109,8 +192,15 @@ class Projector:
 
         h, w = train_cameras[0][:2]
 
+        use_mip = self.mip_levels > 1 or isinstance(featmaps, (list, tuple))
+
         # compute the projection of the query points to each reference image
-        pixel_locations, mask_in_front = self.compute_projections(xyz, train_cameras)
+        if use_mip:
+            pixel_locations, mask_in_front, src_depth = self.compute_projections(
+                xyz, train_cameras, ret_depth=True
+            )
+        else:
+            pixel_locations, mask_in_front = self.compute_projections(xyz, train_cameras)
         normalized_pixel_locations = self.normalize(
             pixel_locations, h, w
         )  # [n_views, n_rays, n_samples, 2]
@@ -120,7 +210,16 @@ class Projector:
         rgb_sampled = rgbs_sampled.permute(2, 3, 0, 1)  # [n_rays, n_samples, n_views, 3]
 
         # deep feature sampling
-        feat_sampled = F.grid_sample(featmaps, normalized_pixel_locations, align_corners=True)
+        if use_mip:
+            'LinGaoyuan_operation_20261018: sample the feature pyramid level that matches the footprint of each sample'
+            pyramid = self.feature_pyramid(featmaps)
+            mip_level = self.compute_mip_level(
+                xyz, query_camera, train_cameras, src_depth, pyramid[0].shape[-1], w
+            )
+            mip_level = torch.clamp(mip_level, max=len(pyramid) - 1)
+            feat_sampled = self.sample_feature_pyramid(pyramid, normalized_pixel_locations, mip_level)
+        else:
+            feat_sampled = F.grid_sample(featmaps, normalized_pixel_locations, align_corners=True)
         feat_sampled = feat_sampled.permute(2, 3, 0, 1)  # [n_rays, n_samples, n_views, d]
         rgb_feat_sampled = torch.cat(
             [rgb_sampled, feat_sampled], dim=-1
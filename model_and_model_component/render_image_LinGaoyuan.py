@@ -1,6 +1,7 @@
 import torch
 from collections import OrderedDict
 from model_and_model_component.render_ray_LinGaoyuan import render_rays
+from LinGaoyuan_function.mixed_precision import autocast, _to_float32
 
 
 def render_single_image(
@@ -27,6 +28,7 @@ def render_single_image(
     use_updated_prior_depth=False,
     train_depth_prior=None,
     data_mode=None,
+    feature_bank=None,
 ):
     """
     :param ray_sampler: RaySamplingSingleImage for this view
@@ -37,17 +39,31 @@ def render_single_image(
     :param N_importance: additional samples along each ray produced by importance sampling (for fine model)
     :param ret_alpha: if True, will return learned 'density' values inferred from the attention maps
     :param single_net: if True, will use single network, can be cued with both coarse and fine points
+    :param feature_bank: SourceFeatureBank, serves featmaps (and feature_volume) by source frame id if featmaps is None
     :return: {'outputs_coarse': {'rgb': numpy, 'depth': numpy, ...}, 'outputs_fine': {}}
     """
 
     all_ret = OrderedDict([("outputs_coarse", OrderedDict()), ("outputs_fine", OrderedDict())])
 
+    if featmaps is None and feature_bank is not None:
+        featmaps, feature_volume = feature_bank.lookup(ray_batch)
+
     N_rays = ray_batch["ray_o"].shape[0]  # 360000 in train, 1440000 in eval
 
+    'LinGaoyuan_operation_20261018: the sky style mapping (or the baked sky texture) is shared by all chunks of the image'
+    sky_style = None
+    sky_texture = None
+    if sky_model is not None and sky_style_code is not None:
+        if args.sky_texture_resolution > 0 and hasattr(sky_model, 'get_sky_texture'):
+            sky_texture = sky_model.get_sky_texture(sky_style_code.to(ray_batch["ray_o"].device))
+        elif hasattr(sky_model, 'map_style'):
+            with autocast(args, ray_batch["ray_o"].device):
+                sky_style = sky_model.map_style(sky_style_code.to(ray_batch["ray_o"].device))
+
     for i in range(0, N_rays, chunk_size):
         chunk = OrderedDict()
         for k in ray_batch:
-            if k in ["camera", "depth_range", "src_rgbs", "src_cameras"]:
+            if k in ["camera", "depth_range", "src_rgbs", "src_cameras", "src_ids"]:
                 chunk[k] = ray_batch[k]
             elif ray_batch[k] is not None:
                 chunk[k] = ray_batch[k][i : i + chunk_size]
@@ -63,28 +79,31 @@ def render_single_image(
         else:
             train_depth_prior_chunk = None
 
-        ret, _ = render_rays(
-            args,
-            chunk,
-            model,
-            featmaps,
-            projector=projector,
-            N_samples=N_samples,
-            inv_uniform=inv_uniform,
-            N_importance=N_importance,
-            det=det,
-            white_bkgd=white_bkgd,
-            ret_alpha=ret_alpha,
-            single_net=single_net,
-            sky_style_code=sky_style_code,
-            # sky_style_model=sky_style_model,
-            sky_model=sky_model,
-            mode = 'val',
-            feature_volume=feature_volume,
-            use_updated_prior_depth=use_updated_prior_depth,
-            train_depth_prior=train_depth_prior_chunk,
-            data_mode = data_mode,
-        )
+        with autocast(args, ray_batch["ray_o"].device):
+            ret, _ = render_rays(
+                args,
+                chunk,
+                model,
+                featmaps,
+                projector=projector,
+                N_samples=N_samples,
+                inv_uniform=inv_uniform,
+                N_importance=N_importance,
+                det=det,
+                white_bkgd=white_bkgd,
+                ret_alpha=ret_alpha,
+                single_net=single_net,
+                sky_style_code=sky_style_code,
+                # sky_style_model=sky_style_model,
+                sky_model=sky_model,
+                sky_style=sky_style,
+                sky_texture=sky_texture,
+                mode = 'val',
+                feature_volume=feature_volume,
+                use_updated_prior_depth=use_updated_prior_depth,
+                train_depth_prior=train_depth_prior_chunk,
+                data_mode = data_mode,
+            )
 
         # handle both coarse and fine outputs
         # cache chunk results on cpu
@@ -100,14 +119,15 @@ def render_single_image(
                     if ret["outputs_fine"][k] is not None:
                         all_ret["outputs_fine"][k] = []
 
+        'outputs of the --amp mode can be float16 / bfloat16, they are cached as float32'
         for k in ret["outputs_coarse"]:
             if ret["outputs_coarse"][k] is not None:
-                all_ret["outputs_coarse"][k].append(ret["outputs_coarse"][k].cpu())
+                all_ret["outputs_coarse"][k].append(_to_float32(ret["outputs_coarse"][k]).cpu())
 
         if ret["outputs_fine"] is not None:
             for k in ret["outputs_fine"]:
                 if ret["outputs_fine"][k] is not None:
-                    all_ret["outputs_fine"][k].append(ret["outputs_fine"][k].cpu())
+                    all_ret["outputs_fine"][k].append(_to_float32(ret["outputs_fine"][k]).cpu())
 
     rgb_strided = torch.ones(ray_sampler.H, ray_sampler.W, 3)[::render_stride, ::render_stride, :]
     # merge chunk results and reshape
@@ -1,8 +1,11 @@
+import types
 import torch
 from collections import OrderedDict
 from LinGaoyuan_function.unbounded2bounded import (SceneContraction, contract_to_unisphere_LinGaoyuan,
-                                                   contract_to_unisphere_LinGaoyuan_xuyan)
+                                                   contract_to_unisphere_LinGaoyuan_xuyan, contract_points)
 from model_and_model_component.ReTR_model_LinGaoyuan import LinGaoyuan_ReTR_model
+from LinGaoyuan_function.mixed_precision import autocast_disabled, float32_function
+from LinGaoyuan_function.step_profiler import profile_stage
 # import imaginaire.model_utils.gancraft.voxlib as voxlib
 
 ########################################################################################################################
@@ -10,6 +13,7 @@ from model_and_model_component.ReTR_model_LinGaoyuan import LinGaoyuan_ReTR_mode
 ########################################################################################################################
 
 
+@float32_function
 def sample_pdf(bins, weights, N_samples, det=False):
     """
     :param bins: tensor of shape [N_rays, M+1], M is the number of bins
@@ -112,7 +116,7 @@ def sample_prior_depth_perturb(ray_o, ray_d, depth_prior, depth_offset_ratio = 0
     lowers = mids*(1-depth_offset_ratio)
 
     batch_size = depth_prior.size(0)
-    z_vals = torch.zeros((batch_size, N_samples_d)).cuda()
+    z_vals = torch.zeros((batch_size, N_samples_d), device=depth_prior.device)
 
     for i in range(batch_size):
         upper = uppers[i, 0]
@@ -155,6 +159,7 @@ def sample_pts_with_z_vals(ray_o, ray_d, z_vals):
 ########################################################################################################################
 
 
+@float32_function
 def raw2outputs(raw, z_vals, mask, white_bkgd=False):
     """
     :param raw: raw network output; tensor of shape [N_rays, N_samples, 4]
@@ -239,6 +244,158 @@ def sample_fine_pts(inv_uniform, N_importance, det, N_samples, ray_batch, weight
     return pts, z_vals
 
 
+def render_core(args, model, projector, pts, z_vals, ray_d, ray_batch, featmaps, feature_volume=None, ret_alpha=False):
+    """
+    LinGaoyuan_operation_20261018: the tensor-only core of render_rays (contraction, projection, network and depth
+    accumulation), split out so that it can be compiled, see get_render_core()
+    :param pts: [N_rays, N_samples, 3]
+    :param z_vals: [N_rays, N_samples]
+    :param ray_batch: {'camera': [1, 34], 'src_rgbs': [1, n_views, H, W, 3], 'src_cameras': [1, n_views, 34]}
+    :return: rgb [N_rays, 3], weights [N_rays, N_samples], depth_map [N_rays,], depth_cov, None if ret_alpha is False
+    """
+    'the unbounded function should be used for the pts after pts is generated from sample_along_camera_ray()'
+    contraction_type = args.contraction_type  # 'zhengzhisheng' of 'nerfstudio'
+
+    'LinGaoyuan_operation_20261018: the contraction is always computed in float32, also in --amp mode'
+    with autocast_disabled():
+        pts = contract_points(pts.float(), contraction_type)
+
+    if args.use_retr_model is True:
+        if args.use_retr_feature_extractor is True:
+            if args.use_volume_feature is not True:
+                'LinGaoyuan_20240930: retr model + retr feature extractor'
+                rgb_feat, ray_diff, mask = projector.compute(
+                    pts,
+                    ray_batch["camera"],
+                    ray_batch["src_rgbs"],
+                    ray_batch["src_cameras"],
+                    featmaps=featmaps,
+                )
+                rgb = model.net_coarse(pts, ray_batch, rgb_feat, z_vals, mask, ray_d, ray_diff, ret_alpha=ret_alpha)
+
+                # rgb = model.net_coarse.forward_retr(pts, ray_batch, featmaps, z_vals, ret_alpha=ret_alpha)
+            else:
+                'LinGaoyuan_20240930: retr model + retr feature extractor + feature volume'
+                rgb_feat, ray_diff, mask = projector.compute(
+                    pts,
+                    ray_batch["camera"],
+                    ray_batch["src_rgbs"],
+                    ray_batch["src_cameras"],
+                    featmaps=featmaps,
+                )
+                rgb = model.net_coarse.forward_retr(pts, ray_batch, rgb_feat, z_vals, mask, ray_d, ray_diff, ret_alpha=ret_alpha, fea_volume=feature_volume)
+                # rgb = model.net_coarse.forward_retr(pts, ray_batch, featmaps, z_vals, fea_volume=feature_volume, ret_alpha=ret_alpha)
+        else:
+            'LinGaoyuan_20240930: retr model + model_and_model_component feature extractor'
+            rgb_feat, ray_diff, mask = projector.compute(
+                pts,
+                ray_batch["camera"],
+                ray_batch["src_rgbs"],
+                ray_batch["src_cameras"],
+                featmaps=featmaps[0],
+            )  # [N_rays, N_samples, N_views, x]
+            # TODO: include pixel mask in ray transformer
+            # pixel_mask = (
+            #     mask[..., 0].sum(dim=2) > 1
+            # )  # [N_rays, N_samples], should at least have 2 observations
+
+            rgb = model.net_coarse(pts, ray_batch, rgb_feat, z_vals, mask, ray_d, ray_diff, ret_alpha=ret_alpha)
+    else:
+        'LinGaoyuan_20240930: model_and_model_component model + model_and_model_component feature extractor'
+        rgb_feat, ray_diff, mask = projector.compute(
+            pts,
+            ray_batch["camera"],
+            ray_batch["src_rgbs"],
+            ray_batch["src_cameras"],
+            featmaps=featmaps[0],
+        )
+        rgb = model.net_coarse(rgb_feat, ray_diff, mask, pts, ray_d)
+
+    if ret_alpha:
+        'LinGaoyuan_operation_20261018: the depth accumulation is always computed in float32, also in --amp mode'
+        with autocast_disabled():
+            rgb, weights = rgb[:, 0:3].float(), rgb[:, 3:].float()
+            depth_map = torch.sum(weights * z_vals, dim=-1)
+
+            'LinGaoyuan_operation_20240906: add cov of depth prediction based on Uncle SLAM formular 5'
+            depth_pred = depth_map[..., None]
+            depth_cov = torch.sqrt(torch.sum(weights*(z_vals-depth_pred)*(z_vals-depth_pred)))
+    else:
+        weights = None
+        depth_map = None
+        depth_cov = None
+
+    return rgb, weights, depth_map, depth_cov
+
+
+def _compile_errors():
+    'the errors of dynamo / the compiler backend, errors of the rendering itself are not caught'
+    from torch._dynamo.exc import BackendCompilerFailed, Unsupported
+    return (BackendCompilerFailed, Unsupported)
+
+
+def _render_core_copy(key):
+    """
+    :return: copy of render_core with its own code object. Dynamo keeps its cache (guards, compiled graphs) on the
+    code object, so every key gets its own cache entries and its own cache_size_limit for the frame of render_core.
+    The functions render_core calls (networks, projector, ...) keep their code objects: when dynamo traces them as
+    separate frames (after a graph break) their cache entries are still shared by all keys.
+    """
+    code = render_core.__code__.replace(co_name="render_core_{}".format("_".join(str(k) for k in key)))
+    core = types.FunctionType(code, render_core.__globals__, code.co_name, render_core.__defaults__,
+                              render_core.__closure__)
+    core.__kwdefaults__ = render_core.__kwdefaults__
+    return core
+
+
+class CompiledRenderCore(object):
+    """
+    LinGaoyuan_operation_20261018: torch.compile version of render_core for one (N_samples, num_source_views, model type),
+    compiled from a per-key copy of render_core (see _render_core_copy). If dynamo or the compiler backend fails, the
+    eager render_core is used for the rest of the run, other errors are raised.
+    """
+    def __init__(self, key, mode="default"):
+        self.key = key
+        self.compiled = torch.compile(_render_core_copy(key), mode=mode)
+        self.failed = False
+
+    def __call__(self, *args, **kwargs):
+        if not self.failed:
+            try:
+                return self.compiled(*args, **kwargs)
+            except _compile_errors() as e:
+                print("compiling render_rays failed for {}, fall back to eager mode: {}".format(self.key, e))
+                self.failed = True
+        return render_core(*args, **kwargs)
+
+
+# compiled variants of render_core, key: (N_samples, num_source_views, model type)
+_compiled_render_cores = {}
+
+
+def render_model_type(args):
+    if args.use_retr_model is not True:
+        return 'gnt'
+    if args.use_retr_feature_extractor is not True:
+        return 'retr+gnt_feature'
+    if args.use_volume_feature is True:
+        return 'retr+volume'
+    return 'retr'
+
+
+def get_render_core(args, N_samples, num_source_views):
+    """
+    :return: render_core, or its compiled variant for (N_samples, num_source_views, model type) if args.compile_render
+    """
+    if not getattr(args, "compile_render", False) or not hasattr(torch, "compile"):
+        return render_core
+
+    key = (N_samples, num_source_views, render_model_type(args))
+    if key not in _compiled_render_cores:
+        _compiled_render_cores[key] = CompiledRenderCore(key, mode=args.compile_mode)
+    return _compiled_render_cores[key]
+
+
 def render_rays(
     args,
     ray_batch,
@@ -260,6 +417,8 @@ def render_rays(
     train_depth_prior = None,
     feature_volume = None,
     data_mode = None,
+    sky_style = None,
+    sky_texture = None,
     # retr_model = None,
 ):
     """
@@ -271,6 +430,9 @@ def render_rays(
     :param det: if True, will deterministicly sample depths
     :param ret_alpha: if True, will return learned 'density' values inferred from the attention maps
     :param single_net: if True, will use single network, can be cued with both coarse and fine points
+    :param sky_style: sky_model.map_style(sky_style_code) computed once by the caller, if None it is computed here
+    :param sky_texture: sky_model.get_sky_texture(sky_style_code) resolved once per image by the caller (not in train
+    mode), if None and --sky_texture_resolution > 0 it is resolved here
     :return: {'outputs_coarse': {}, 'outputs_fine': {}}
     """
 
@@ -316,91 +478,27 @@ def render_rays(
         # z_vals = z_vals_total
 
 
-    'the unbounded function should be used for the pts after pts is generated from sample_along_camera_ray()'
-    contraction_type = args.contraction_type  # 'zhengzhisheng' of 'nerfstudio'
-
-    if contraction_type == 'nerfstudio':
-        scene_contraction = SceneContraction(order=float("inf"))
-        pts = scene_contraction(pts)
-    elif contraction_type == 'zhengzhisheng':
-        pts = contract_to_unisphere_LinGaoyuan(pts)
-    elif contraction_type == 'xuyan':
-        pts = contract_to_unisphere_LinGaoyuan_xuyan(pts)
+    'LinGaoyuan_operation_20261018: contraction, projection, network and depth accumulation, optionally compiled'
+    core_batch = {k: ray_batch[k] for k in ["camera", "src_rgbs", "src_cameras"]}
+    core = get_render_core(args, N_samples=pts.shape[1], num_source_views=ray_batch["src_rgbs"].shape[1])
+    rgb, weights, depth_map, depth_cov = core(
+        args, model, projector, pts, z_vals, ray_d, core_batch, featmaps, feature_volume, ret_alpha
+    )
 
     N_rays, N_samples = pts.shape[:2]
-
-    if args.use_retr_model is True:
-        if args.use_retr_feature_extractor is True:
-            if args.use_volume_feature is not True:
-                'LinGaoyuan_20240930: retr model + retr feature extractor'
-                rgb_feat, ray_diff, mask = projector.compute(
-                    pts,
-                    ray_batch["camera"],
-                    ray_batch["src_rgbs"],
-                    ray_batch["src_cameras"],
-                    featmaps=featmaps,
-                )
-                rgb = model.net_coarse(pts, ray_batch, rgb_feat, z_vals, mask, ray_d, ray_diff, ret_alpha=ret_alpha)
-
-                # rgb = model.net_coarse.forward_retr(pts, ray_batch, featmaps, z_vals, ret_alpha=ret_alpha)
-            else:
-                'LinGaoyuan_20240930: retr model + retr feature extractor + feature volume'
-                rgb_feat, ray_diff, mask = projector.compute(
-                    pts,
-                    ray_batch["camera"],
-                    ray_batch["src_rgbs"],
-                    ray_batch["src_cameras"],
-                    featmaps=featmaps,
-                )
-                rgb = model.net_coarse.forward_retr(pts, ray_batch, rgb_feat, z_vals, mask, ray_d, ray_diff, ret_alpha=ret_alpha, fea_volume=feature_volume)
-                # rgb = model.net_coarse.forward_retr(pts, ray_batch, featmaps, z_vals, fea_volume=feature_volume, ret_alpha=ret_alpha)
-        else:
-            'LinGaoyuan_20240930: retr model + model_and_model_component feature extractor'
-            rgb_feat, ray_diff, mask = projector.compute(
-                pts,
-                ray_batch["camera"],
-                ray_batch["src_rgbs"],
-                ray_batch["src_cameras"],
-                featmaps=featmaps[0],
-            )  # [N_rays, N_samples, N_views, x]
-            # TODO: include pixel mask in ray transformer
-            # pixel_mask = (
-            #     mask[..., 0].sum(dim=2) > 1
-            # )  # [N_rays, N_samples], should at least have 2 observations
-
-            rgb = model.net_coarse(pts, ray_batch, rgb_feat, z_vals, mask, ray_d, ray_diff, ret_alpha=ret_alpha)
-    else:
-        'LinGaoyuan_20240930: model_and_model_component model + model_and_model_component feature extractor'
-        rgb_feat, ray_diff, mask = projector.compute(
-            pts,
-            ray_batch["camera"],
-            ray_batch["src_rgbs"],
-            ray_batch["src_cameras"],
-            featmaps=featmaps[0],
-        )
-        rgb = model.net_coarse(rgb_feat, ray_diff, mask, pts, ray_d)
-
-    if ret_alpha:
-        rgb, weights = rgb[:, 0:3], rgb[:, 3:]
-        depth_map = torch.sum(weights * z_vals, dim=-1)
-
-        'LinGaoyuan_operation_20240906: add cov of depth prediction based on Uncle SLAM formular 5'
-        depth_pred = depth_map[..., None]
-        depth_cov = torch.sqrt(torch.sum(weights*(z_vals-depth_pred)*(z_vals-depth_pred)))
-
-        # depth_img = (depth_map - depth_map.min()) / (depth_map.max() - depth_map.min()) * 255.0
-
-        # depth_sky = depth_map*(1-sky_mask)
-        depth_sky = None
-    else:
-        weights = None
-        depth_map = None
-
-        depth_cov = None
-        depth_sky = None
+    depth_sky = None
 
     'operation of sky'
-    rgb_sky, sky_style_code = sky_model(ray_d, sky_style_code.cuda(), sky_mask)
+    with profile_stage("sky_model"):
+        if sky_texture is None and mode != 'train' and args.sky_texture_resolution > 0 and hasattr(sky_model, 'get_sky_texture'):
+            sky_texture = sky_model.get_sky_texture(sky_style_code.to(ray_d.device))
+        if sky_texture is not None:
+            'LinGaoyuan_operation_20261018: at inference the sky color only depends on ray_d, it is looked up in a baked texture'
+            rgb_sky, sky_style_code = sky_texture(ray_d, sky_mask), sky_texture.style_code
+        elif sky_style is not None:
+            rgb_sky, sky_style_code = sky_model.render(ray_d, sky_style, sky_mask), sky_style
+        else:
+            rgb_sky, sky_style_code = sky_model(ray_d, sky_style_code.to(ray_d.device), sky_mask)
 
     z = sky_style_code.detach()
 
@@ -455,8 +553,9 @@ def render_rays(
             rgb = model.net_coarse(rgb_feat_sampled, ray_diff, mask, pts, ray_d)
         else:
             rgb = model.net_fine(rgb_feat_sampled, ray_diff, mask, pts, ray_d)
-        rgb, weights = rgb[:, 0:3], rgb[:, 3:]
-        depth_map = torch.sum(weights * z_vals, dim=-1)
+        with autocast_disabled():
+            rgb, weights = rgb[:, 0:3].float(), rgb[:, 3:].float()
+            depth_map = torch.sum(weights * z_vals, dim=-1)
         ret["outputs_fine"] = {"rgb": rgb, "weights": weights, "depth": depth_map}
 
     return ret, z
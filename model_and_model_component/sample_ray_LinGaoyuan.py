@@ -85,6 +85,9 @@ class RaySamplerSingleImage(object):
         else:
             self.src_sky_masks = None
 
+        'frame ids of the source views, used as key of the source feature bank'
+        self.src_ids = data["src_ids"] if "src_ids" in data.keys() else None
+
     def get_rays_single_image(self, H, W, intrinsics, c2w):
         """
         :param H: image height
@@ -124,6 +127,7 @@ class RaySamplerSingleImage(object):
             "src_cameras": self.src_cameras.cuda() if self.src_cameras is not None else None,
             "sky_mask": self.sky_mask.cuda() if self.sky_mask is not None else None,
             "src_sky_mask": self.src_sky_masks.cuda() if self.src_sky_masks is not None else None,
+            "src_ids": self.src_ids,
             "idx": self.idx.cuda() if self.idx is not None else None,
         }
         return ret
@@ -188,6 +192,7 @@ class RaySamplerSingleImage(object):
             "selected_inds": select_inds,
             "sky_mask": sky_mask.cuda(),
             "depth_value": depth_value.cuda(),
+            "src_ids": self.src_ids,
             "idx": self.idx.cuda() if self.idx is not None else None,
         }
         return ret
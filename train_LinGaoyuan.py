@@ -2,6 +2,7 @@ import os
 import time
 import numpy as np
 import shutil
+import functools
 import torch
 import torch.utils.data.distributed
 
@@ -30,6 +31,13 @@ from LinGaoyuan_function.sky_network import SKYMLP, StyleMLP, SkyModel
 from LinGaoyuan_function.sky_transformer_network import SkyTransformer, SkyTransformerModel
 from LinGaoyuan_function.update_prior_depth_value import update_prior_depth_value
 from LinGaoyuan_function.image_resize import resize_img
+from LinGaoyuan_function.mixed_precision import autocast, make_grad_scaler
+from LinGaoyuan_function.joint_training import wrap_joint_module, JointOptimizer, sky_optimizers, sky_schedulers, set_grad_sync, SCENE_NETS, sky_networks
+from LinGaoyuan_function.checkpoint_writer import CheckpointWriter
+from LinGaoyuan_function.step_profiler import StepProfiler, set_profiler, profile_stage
+from LinGaoyuan_function.metric_logger import MetricAccumulator, MetricSink
+from LinGaoyuan_function.async_validation import AsyncValidation
+from LinGaoyuan_function.multi_target_batch import split_target_views, stack_source_views, select_source_views
 
 from utils import img2mse
 import json
@@ -57,6 +65,63 @@ def synchronize():
     dist.barrier()
 
 
+def train_forward(args, model, projector, sky_model, ray_batches, sky_style_code, ret_alpha, use_updated_prior_depth,
+                  train_depth_priors):
+    '''
+    LinGaoyuan_operation_20261018: forward pass of one training step, feature extraction and rendering run in autocast
+    if --amp is set
+    :param ray_batches: list of ray batches, one per target view
+    :param train_depth_priors: list of prior depths, one per target view
+    :return: list of (ret, z) of render_rays(), one per target view
+    '''
+    device = ray_batches[0]["ray_o"].device
+    outputs = []
+    with autocast(args, device):
+        'the source views of all target views go through the feature extractor in one call'
+        with profile_stage("feature_extraction"):
+            src_rgbs = stack_source_views(ray_batches)
+            if args.use_retr_feature_extractor is False:
+                all_featmaps = model.feature_net(src_rgbs)
+            else:
+                all_featmaps = model.retr_feature_extractor(src_rgbs)
+
+        start = 0
+        for ray_batch, train_depth_prior in zip(ray_batches, train_depth_priors):
+            end = start + ray_batch["src_rgbs"].shape[1]
+            if args.use_retr_feature_extractor is False:
+                featmaps = select_source_views(all_featmaps, start, end)
+            else:
+                featmaps, fpn = select_source_views(all_featmaps, start, end)
+            start = end
+            if args.use_volume_feature is True and args.use_retr_feature_extractor is True:
+                feature_volume = model.retr_feature_volume(fpn, ray_batch)
+            else:
+                feature_volume = None
+
+            outputs.append(render_rays(
+                args = args,
+                ray_batch=ray_batch,
+                model=model,
+                projector=projector,
+                featmaps=featmaps,
+                N_samples=args.N_samples,
+                inv_uniform=args.inv_uniform,
+                N_importance=args.N_importance,
+                det=args.det,
+                white_bkgd=args.white_bkgd,
+                # ret_alpha=args.N_importance > 0,
+                ret_alpha=ret_alpha,
+                single_net=args.single_net,
+                sky_style_code=sky_style_code,
+                # sky_style_model = sky_style_model,
+                sky_model=sky_model,
+                use_updated_prior_depth=use_updated_prior_depth,
+                train_depth_prior=train_depth_prior,
+                feature_volume=feature_volume,
+            ))
+    return outputs
+
+
 def train(args):
 
     device = "cuda:{}".format(args.local_rank)
@@ -78,11 +143,11 @@ def train(args):
 
     # create training dataset
     train_dataset, train_sampler = create_training_dataset(args)
-    # currently only support batch_size=1 (i.e., one set of target and source views) for each GPU node
-    # please use distributed parallel on multiple GPUs to train multiple target views per batch
+    'LinGaoyuan_operation_20261018: a batch holds --num_target_views target views, each with its own source views'
     train_loader = torch.utils.data.DataLoader(
         train_dataset,
-        batch_size=1,
+        batch_size=args.num_target_views,
+        drop_last=args.num_target_views > 1,
         worker_init_fn=lambda _: np.random.seed(),
         num_workers=args.workers,
         pin_memory=True,
@@ -94,9 +159,9 @@ def train(args):
     'LinGaoyuan_operation_20240905: create a tensor array that save the prior depth value of all training image'
     if args.resize_image is True:
         image_resizer = torchvision.transforms.Resize((args.image_resize_H, args.image_resize_W))
-        train_prior_depth_values = torch.zeros((len(train_loader), args.image_resize_H, args.image_resize_W)).cuda()
+        train_prior_depth_values = torch.zeros((len(train_dataset), args.image_resize_H, args.image_resize_W)).cuda()
     else:
-        train_prior_depth_values = torch.zeros((len(train_loader), args.image_H, args.image_W)).cuda()
+        train_prior_depth_values = torch.zeros((len(train_dataset), args.image_H, args.image_W)).cuda()
 
     '''
     LinGaoyuan_operation_20240920: if exit a saved train_prior_depth_values.pt file in actual out_folder, load it as train_prior_depth_values
@@ -147,7 +212,8 @@ def train(args):
     LinGaoyuan_operation_20240918: now the model can contain retr model according to the indicator of args
     '''
     model = Model(
-        args, load_opt=not args.no_load_opt, load_scheduler=not args.no_load_scheduler
+        args, load_opt=not args.no_load_opt, load_scheduler=not args.no_load_scheduler,
+        ddp_wrap=args.no_joint_training,
     )
 
     # # # create ReTR model
@@ -160,23 +226,61 @@ def train(args):
 
 
     # create projector
-    projector = Projector(device=device)
+    projector = Projector(device=device, mip_levels=args.feature_mip_levels)
+
+    'LinGaoyuan_operation_20261018: loss scaling for --amp fp16'
+    grad_scaler = make_grad_scaler(args, device)
 
     # Create criterion
     criterion = Criterion()
     scalars_to_log = {}
 
+    'LinGaoyuan_operation_20261018: the metrics stay on the device until i_print and are written in a thread (--metrics_sink)'
+    metrics = MetricAccumulator()
+    metric_sink = None
+    if args.local_rank == 0:
+        metric_sink = MetricSink(out_folder, sink=args.metrics_sink, prefix="{} ".format(args.expname))
+
     global_step = model.start_step + 1
     epoch = 0
 
+    'LinGaoyuan_operation_20261018: atomic ckpt writes in a background thread, with retention of --keep_checkpoints'
+    checkpoint_writer = CheckpointWriter(
+        out_folder, keep_last=args.keep_checkpoints, background=not args.no_async_checkpoint
+    )
+
+    'LinGaoyuan_operation_20261018: per-stage timing of the step (--profile_stages) and torch.profiler trace window'
+    step_profiler = StepProfiler(
+        device, enabled=args.profile_stages, trace_start=args.profile_trace_start,
+        trace_steps=args.profile_trace_steps, trace_dir=os.path.join(out_folder, "profiler"),
+    )
+    set_profiler(step_profiler)
+
     'model for sky color'
 
     if args.sky_model_type == 'mlp':
-        sky_model = SkyModel(args, load_opt=not args.no_load_opt, load_scheduler=not args.no_load_scheduler)
+        sky_model = SkyModel(args, load_opt=not args.no_load_opt, load_scheduler=not args.no_load_scheduler,
+                             ddp_wrap=args.no_joint_training)
     else:
         sky_model = SkyTransformerModel(args, ray_d_input=3, style_dim=128, dim_embed=256, num_head=2, input_embedding=False,
                                    dropout=0.05, num_layers=5).to(device)
 
+    'LinGaoyuan_operation_20261018: scene and sky networks are trained with one DDP module and one optimizer'
+    if not args.no_joint_training:
+        joint_module = wrap_joint_module(args, model, sky_model)
+        joint_optimizer = JointOptimizer([model.optimizer] + sky_optimizers(args, sky_model))
+    else:
+        'the networks of Model and of the sky model are wrapped in DDP one by one'
+        separate_ddp_networks = [getattr(model, name) for name in SCENE_NETS if getattr(model, name, None) is not None]
+        separate_ddp_networks += [getattr(sky_model, name) for name in sky_networks(args)]
+
+    'LinGaoyuan_operation_20261018: the validation views are rendered from a copy of the weights in a thread'
+    async_validation = None
+    if args.local_rank == 0 and not args.no_async_validation:
+        async_validation = AsyncValidation(model, sky_model, SCENE_NETS, sky_networks(args))
+    'the projector caches the feature pyramid of the last featmaps, the validation thread needs its own'
+    val_projector = projector if async_validation is None else Projector(device=device, mip_levels=args.feature_mip_levels)
+
     # 'two model for sky color'
     # style_dims = 128
     # # batch_size = args.num_source_views
@@ -212,20 +316,22 @@ def train(args):
         print('create initial sky style code')
         z = torch.randn(batch_size, style_dims, dtype=torch.float32, device=device)
 
+    'LinGaoyuan_operation_20261018: the micro-batches of one optimizer step may span the end of an epoch'
+    accum_step = 0
+
     # while global_step < model.start_step + args.n_iters + 1:
     for epoch in range(args.max_epochs):
         np.random.seed()
 
         'LinGaoyuan_operation_20240920: calculate right epoch when load ckpt'
-        load_epoch = int(global_step/len(train_loader))
+        'LinGaoyuan_operation_20261018: one step consumes grad_accum_steps batches of the loader'
+        load_epoch = int(global_step * args.grad_accum_steps / len(train_loader))
 
         print('----------------------------------The {}st epoch begin----------------------------------'.format(epoch))
 
         epoch_step = 0
 
-        for train_data in train_loader:
-
-            time0 = time.time()
+        for train_data in step_profiler.iterate("data", train_loader):
 
             if args.distributed:
                 train_sampler.set_epoch(epoch)
@@ -234,24 +340,20 @@ def train(args):
 
             'render_stride is not used during training'
             # load training rays
-            ray_sampler = RaySamplerSingleImage(train_data, device)
-            N_rand = int(
-                1.0 * args.N_rand * args.num_source_views / train_data["src_rgbs"][0].shape[0]
-            )
-            ray_batch = ray_sampler.random_sample(
-                N_rand,
-                sample_mode=args.sample_mode,
-                center_ratio=args.center_ratio,
-            )
-
-            if args.use_retr_feature_extractor is False:
-                featmaps = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
-            else:
-                featmaps, fpn = model.retr_feature_extractor(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
-            if args.use_volume_feature is True and args.use_retr_feature_extractor is True:
-                feature_volume = model.retr_feature_volume(fpn, ray_batch)
-            else:
-                feature_volume = None
+            'LinGaoyuan_operation_20261018: the N_rand rays are split among the target views of the batch'
+            with profile_stage("ray_sampling"):
+                train_views = split_target_views(train_data)
+                ray_batches = []
+                for view_data in train_views:
+                    ray_sampler = RaySamplerSingleImage(view_data, device)
+                    N_rand = int(
+                        1.0 * args.N_rand * args.num_source_views / view_data["src_rgbs"][0].shape[0] / len(train_views)
+                    )
+                    ray_batches.append(ray_sampler.random_sample(
+                        N_rand,
+                        sample_mode=args.sample_mode,
+                        center_ratio=args.center_ratio,
+                    ))
 
             'LinGaoyuan_operation_20240830: set self.ret_alpha = True in order to always return depth prediction'
 
@@ -267,159 +369,205 @@ def train(args):
             # if epoch >= args.update_prior_depth_epochs:
             if load_epoch >= args.update_prior_depth_epochs:
                 use_updated_prior_depth = True
-                train_depth_prior = (train_prior_depth_values[ray_batch["idx"], ...]).reshape(-1, 1)
+                train_depth_priors = [
+                    (train_prior_depth_values[ray_batch["idx"], ...]).reshape(-1, 1) for ray_batch in ray_batches
+                ]
             else:
                 use_updated_prior_depth = False
-                train_depth_prior = None
+                train_depth_priors = [None] * len(ray_batches)
 
             if epoch == args.update_prior_depth_epochs and epoch_step == 0:
                 print('The updating process of prior depth process will begin at epoch: {}'.format(epoch), 'step: {}'.format(global_step) )
 
-            ret, z = render_rays(
-                args = args,
-                ray_batch=ray_batch,
-                model=model,
-                projector=projector,
-                featmaps=featmaps,
-                N_samples=args.N_samples,
-                inv_uniform=args.inv_uniform,
-                N_importance=args.N_importance,
-                det=args.det,
-                white_bkgd=args.white_bkgd,
-                # ret_alpha=args.N_importance > 0,
-                ret_alpha=ret_alpha,
-                single_net=args.single_net,
-                sky_style_code=z,
-                # sky_style_model = sky_style_model,
-                sky_model=sky_model,
-                use_updated_prior_depth=use_updated_prior_depth,
-                train_depth_prior=train_depth_prior,
-                feature_volume=feature_volume,
-            )
-
+            'LinGaoyuan_operation_20261018: gradient accumulation, the gradients are only reduced for the last micro-batch'
+            last_micro_step = accum_step == args.grad_accum_steps - 1
 
-            'LinGaoyuan_operation_20240906: (optional) use cov of depth from Uncle SLAM formular 5 to determine whether update depth prior or not'
-            if args.cov_criteria is True:
-                pred_depth_cov = ret["outputs_coarse"]["depth_cov"]
-                if pred_depth_cov < args.preset_depth_cov:
-                    use_updated_prior_depth = True
+            'LinGaoyuan_operation_20261018: in joint training the forward pass runs inside the DDP module of all networks'
+            with profile_stage("forward"):
+                if args.no_joint_training:
+                    for net in separate_ddp_networks:
+                        set_grad_sync(net, last_micro_step)
+                    outputs = train_forward(args, model, projector, sky_model, ray_batches, z, ret_alpha,
+                                            use_updated_prior_depth, train_depth_priors)
+                else:
+                    set_grad_sync(joint_module, last_micro_step)
+                    outputs = joint_module(train_forward, args, model, projector, sky_model, ray_batches, z, ret_alpha,
+                                           use_updated_prior_depth, train_depth_priors)
 
             # compute loss
-            model.optimizer.zero_grad()
-
-            'set sky model and style model to zero_grad'
-            if args.sky_model_type == 'mlp':
-                sky_model.sky_optimizer.zero_grad()
-                sky_model.sky_style_optimizer.zero_grad()
-            else:
-                sky_model.optimizer.zero_grad()
+            if accum_step == 0:
+                if not args.no_joint_training:
+                    joint_optimizer.zero_grad()
+                else:
+                    model.optimizer.zero_grad()
+
+                    'set sky model and style model to zero_grad'
+                    if args.sky_model_type == 'mlp':
+                        sky_model.sky_optimizer.zero_grad()
+                        sky_model.sky_style_optimizer.zero_grad()
+                    else:
+                        sky_model.optimizer.zero_grad()
             # sky_optimizer.zero_grad()
             # sky_style_optimizer.zero_grad()
 
-            loss, scalars_to_log = criterion(ret["outputs_coarse"], ray_batch, scalars_to_log)
-
-            'loss of sky area, add by LinGaoyuan'
-            loss_sky_rgb = criterion.sky_loss_rgb(ret["outputs_coarse"], ray_batch)
-
-            'LinGaoyuan_operation_20240907: the depth loss will not be added to total loss after epoch reach a preset value'
-            if ret_alpha is True:
-                loss_depth_value = criterion.depth_loss(ret["outputs_coarse"], ray_batch, train_depth_prior)
-                if epoch < args.update_prior_depth_epochs:
-                    loss = args.lambda_rgb * loss + args.lambda_depth * loss_depth_value
-
-            'LinGaoyuan_operation_20240920: (optional) use depth loss to determine whether update depth prior or not'
-            if args.depth_loss_criteria is True:
-                if loss_depth_value < args.preset_depth_loss:
-                    use_updated_prior_depth = True
-
-            if ret["outputs_fine"] is not None:
-                fine_loss, scalars_to_log = criterion(
-                    ret["outputs_fine"], ray_batch, scalars_to_log
-                )
-                loss += fine_loss
-
-            'LinGaoyuan_operation_20240905: update prior depth with depth prediction if epoch reach preset value'
-            'LinGaoyuan_operation_20240920: add a indicator(args.update_prior_depth) to determine whether update depth prior or not'
-            if use_updated_prior_depth and args.update_prior_depth is True:
-                train_depth_pred = ret["outputs_coarse"]["depth"].detach()
-                train_depth_prior[ray_batch["selected_inds"]] = train_depth_pred[...,None]
-                if args.resize_image is True:
-                    train_depth_prior = train_depth_prior.reshape(1, args.image_resize_H, args.image_resize_W)
-                else:
-                    train_depth_prior = train_depth_prior.reshape(1,args.image_H, args.image_W)
-                train_prior_depth_values[ray_batch["idx"], ...] = train_depth_prior
-                # print('finish update train prior depth value in epoch: {}'.format(epoch), 'step: {}'.format(global_step))
-
-            loss.backward()
-            scalars_to_log["loss"] = loss.item()
-            model.optimizer.step()
-            model.scheduler.step()
-
-            loss_sky_rgb.backward()
-            if args.sky_model_type == 'mlp':
-                sky_model.sky_optimizer.step()
-                sky_model.sky_scheduler.step()
+            'LinGaoyuan_operation_20261018: the losses are averaged over the target views and the accumulated micro-batches'
+            loss_weight = 1.0 / (len(ray_batches) * args.grad_accum_steps)
+            with profile_stage("loss"):
+                step_loss, step_loss_sky_rgb = 0, 0
+                for ray_batch, train_depth_prior, (ret, z) in zip(ray_batches, train_depth_priors, outputs):
+
+                    'LinGaoyuan_operation_20240906: (optional) use cov of depth from Uncle SLAM formular 5 to determine whether update depth prior or not'
+                    if args.cov_criteria is True:
+                        pred_depth_cov = ret["outputs_coarse"]["depth_cov"]
+                        if pred_depth_cov < args.preset_depth_cov:
+                            use_updated_prior_depth = True
+
+                    loss, scalars_to_log = criterion(ret["outputs_coarse"], ray_batch, scalars_to_log)
+                    metrics.add("train/coarse-loss", loss)
+
+                    'loss of sky area, add by LinGaoyuan'
+                    loss_sky_rgb = criterion.sky_loss_rgb(ret["outputs_coarse"], ray_batch)
+                    metrics.add("train/sky-loss", loss_sky_rgb)
+
+                    'LinGaoyuan_operation_20240907: the depth loss will not be added to total loss after epoch reach a preset value'
+                    if ret_alpha is True:
+                        loss_depth_value = criterion.depth_loss(ret["outputs_coarse"], ray_batch, train_depth_prior)
+                        metrics.add("train/depth-loss", loss_depth_value)
+                        metrics.add("train/depth-cov", ret["outputs_coarse"]["depth_cov"])
+                        if epoch < args.update_prior_depth_epochs:
+                            loss = args.lambda_rgb * loss + args.lambda_depth * loss_depth_value
+
+                    'LinGaoyuan_operation_20240920: (optional) use depth loss to determine whether update depth prior or not'
+                    if args.depth_loss_criteria is True:
+                        if loss_depth_value < args.preset_depth_loss:
+                            use_updated_prior_depth = True
+
+                    if ret["outputs_fine"] is not None:
+                        fine_loss, scalars_to_log = criterion(
+                            ret["outputs_fine"], ray_batch, scalars_to_log
+                        )
+                        metrics.add("train/fine-loss", fine_loss)
+                        loss += fine_loss
+
+                    'the number of rays and samples is known from the shapes, no synchronization'
+                    metrics.count("rays", ray_batch["ray_o"].shape[0])
+                    metrics.count("samples", ret["outputs_coarse"]["weights"].numel())
+                    if ret["outputs_fine"] is not None:
+                        metrics.count("samples", ret["outputs_fine"]["weights"].numel())
+
+                    'LinGaoyuan_operation_20240905: update prior depth with depth prediction if epoch reach preset value'
+                    'LinGaoyuan_operation_20240920: add a indicator(args.update_prior_depth) to determine whether update depth prior or not'
+                    if use_updated_prior_depth and args.update_prior_depth is True:
+                        train_depth_pred = ret["outputs_coarse"]["depth"].detach()
+                        train_depth_prior[ray_batch["selected_inds"]] = train_depth_pred[...,None]
+                        if args.resize_image is True:
+                            train_depth_prior = train_depth_prior.reshape(1, args.image_resize_H, args.image_resize_W)
+                        else:
+                            train_depth_prior = train_depth_prior.reshape(1,args.image_H, args.image_W)
+                        train_prior_depth_values[ray_batch["idx"], ...] = train_depth_prior
+                        # print('finish update train prior depth value in epoch: {}'.format(epoch), 'step: {}'.format(global_step))
+
+                    step_loss = step_loss + loss_weight * loss
+                    step_loss_sky_rgb = step_loss_sky_rgb + loss_weight * loss_sky_rgb
+
+            'LinGaoyuan_operation_20261018: the grad scaler is a pass-through unless --amp fp16 is used on cuda'
+            if not args.no_joint_training:
+                '''
+                LinGaoyuan_operation_20261018: the scene loss and the sky loss do not share parameters, the backward pass
+                of their weighted sum gives the same gradients as two backward passes, with one autograd traversal and
+                one gradient allreduce
+                '''
+                with profile_stage("backward"):
+                    grad_scaler.scale(step_loss + args.lambda_sky_rgb * step_loss_sky_rgb).backward()
             else:
-                sky_model.optimizer.step()
-                sky_model.scheduler.step()
-            # sky_optimizer.step()
-            # sky_scheduler.step()
-
-            if args.sky_model_type == 'mlp':
-                sky_model.sky_style_optimizer.step()
-                sky_model.sky_style_scheduler.step()
+                with profile_stage("backward"):
+                    grad_scaler.scale(step_loss).backward()
+                    grad_scaler.scale(args.lambda_sky_rgb * step_loss_sky_rgb).backward()
+            metrics.add("train/loss", step_loss * args.grad_accum_steps)
+
+            accum_step = (accum_step + 1) % args.grad_accum_steps
+            if accum_step != 0:
+                'LinGaoyuan_operation_20261018: the optimizer step is made after the last accumulated micro-batch'
+                continue
+
+            with profile_stage("optimizer"):
+                if not args.no_joint_training:
+                    joint_optimizer.step(grad_scaler)
+                    model.scheduler.step()
+                    for scheduler in sky_schedulers(args, sky_model):
+                        scheduler.step()
+                else:
+                    grad_scaler.step(model.optimizer)
+                    model.scheduler.step()
+
+                    if args.sky_model_type == 'mlp':
+                        grad_scaler.step(sky_model.sky_optimizer)
+                        sky_model.sky_scheduler.step()
+                    else:
+                        grad_scaler.step(sky_model.optimizer)
+                        sky_model.scheduler.step()
+                    # sky_optimizer.step()
+                    # sky_scheduler.step()
+
+                    if args.sky_model_type == 'mlp':
+                        grad_scaler.step(sky_model.sky_style_optimizer)
+                        sky_model.sky_style_scheduler.step()
+                grad_scaler.update()
+            step_profiler.step()
+            metrics.step()
             # sky_style_optimizer.step()
             # sky_style_scheduler.step()
 
-            scalars_to_log["lr"] = model.scheduler.get_last_lr()[0]
             # end of core optimization loop
-            dt = time.time() - time0
 
-            if args.sky_model_type == 'mlp':
-                sky_model_lr = sky_model.sky_scheduler.get_last_lr()[0]
-                sky_style_lr = sky_model.sky_style_scheduler.get_last_lr()[0]
-            else:
-                sky_model_lr = sky_model.scheduler.get_last_lr()[0]
-                sky_style_lr = sky_model.scheduler.get_last_lr()[1]
+            'LinGaoyuan_operation_20261018: the learning rates are only read for the steps that are logged'
+            if global_step % args.i_print == 0 or global_step < 10:
+                if args.local_rank == 0:
+                    metrics.add("lr", model.scheduler.get_last_lr()[0])
+                    if args.sky_model_type == 'mlp':
+                        metrics.add("sky_model_lr", sky_model.sky_scheduler.get_last_lr()[0])
+                        metrics.add("sky_style_lr", sky_model.sky_style_scheduler.get_last_lr()[0])
+                    else:
+                        metrics.add("sky_model_lr", sky_model.scheduler.get_last_lr()[0])
+                        metrics.add("sky_style_lr", sky_model.scheduler.get_last_lr()[1])
+                    metric_sink.write(metrics.flush(global_step, epoch=epoch))
+                else:
+                    metrics.reset()
             # sky_model_lr = sky_scheduler.get_last_lr()[0]
             # sky_style_lr = sky_style_scheduler.get_last_lr()[0]
 
+            'LinGaoyuan_operation_20261018: the stage timers are reset on every rank, only rank 0 prints them'
+            if args.profile_stages and (global_step % args.i_print == 0 or global_step < 10):
+                stage_summary = step_profiler.summary()
+
             # Rest is logging
             if args.local_rank == 0:
                 if global_step % args.i_print == 0 or global_step < 10:
-                    # write mse and psnr stats
-                    mse_error = img2mse(ret["outputs_coarse"]["rgb"], ray_batch["rgb"]).item()
-                    scalars_to_log["train/coarse-loss"] = mse_error
-                    scalars_to_log["train/coarse-psnr-training-batch"] = mse2psnr(mse_error)
-                    if ret["outputs_fine"] is not None:
-                        mse_error = img2mse(ret["outputs_fine"]["rgb"], ray_batch["rgb"]).item()
-                        scalars_to_log["train/fine-loss"] = mse_error
-                        scalars_to_log["train/fine-psnr-training-batch"] = mse2psnr(mse_error)
-
-                    logstr = "{} Epoch: {}  step: {} ".format(args.expname, epoch, global_step)
-                    for k in scalars_to_log.keys():
-                        logstr += " {}: {:.6f}".format(k, scalars_to_log[k])
-                    print(logstr)
-
-                    print("depth loss: {}".format(loss_depth_value), "depth cov: {}".format(ret["outputs_coarse"]["depth_cov"]))
-
-                    print("sky model lr: {}".format(sky_model_lr), "sky_style_lr: {}".format(sky_style_lr), "sky_loss: {}".format(loss_sky_rgb))
-                    print("each iter time {:.05f} seconds".format(dt))
+                    'LinGaoyuan_operation_20261018: losses, psnr, lr, rays/sec and samples/sec are printed by metric_sink'
+                    if args.profile_stages:
+                        print("stage breakdown (ms per step): {}".format(StepProfiler.format(stage_summary)))
+                    if torch.cuda.is_available():
+                        'LinGaoyuan_operation_20261018: peak memory of the step, to compare the --grad_checkpoint_layers settings'
+                        print("peak memory since last print {:.1f} MB, grad_checkpoint_layers: {}".format(
+                            torch.cuda.max_memory_allocated() / 1024 ** 2, args.grad_checkpoint_layers))
+                        torch.cuda.reset_peak_memory_stats()
 
                 if global_step % args.i_weights == 0:
+                    if not args.no_joint_training:
+                        joint_optimizer.sync_state()
                     print("Saving checkpoints at {} to {}...".format(global_step, out_folder))
                     fpath = os.path.join(out_folder, "model_{:06d}.pth".format(global_step))
-                    model.save_model(fpath)
+                    model.save_model(fpath, checkpoint_writer=checkpoint_writer)
 
                     print("Saving checkpoints of sky model at {} to {}...".format(global_step, out_folder))
                     fpath = os.path.join(out_folder, "sky_model_{:06d}.pth".format(global_step))
-                    sky_model.save_model(fpath)
+                    sky_model.save_model(fpath, checkpoint_writer=checkpoint_writer)
 
                     'LinGaoyuan_operation_20240920: save train_prior_depth_values as .pt file when args.save_prior_depth is True'
                     if args.save_prior_depth is True:
                         print("Saving train_prior_depth_values at {} to {}...".format(global_step, out_folder))
                         fpath = os.path.join(out_folder, "train_prior_depth_values.pt")
-                        torch.save(train_prior_depth_values, fpath)
+                        checkpoint_writer.save(train_prior_depth_values, fpath)
 
 
 
@@ -478,30 +626,29 @@ def train(args):
 
                     'LinGaoyuan_operation_20240830: set create depth image by default even N_inportance is 0 in order to create depth image'
                     'LinGaoyuan_operation_20240920: set data_mode to val when use val dataset in val process'
-                    log_view(
+                    'LinGaoyuan_operation_20261018: the style code is cloned, the train loop may update it in place'
+                    val_view = functools.partial(
+                        log_view,
                         global_step,
                         args,
-                        model,
-                        tmp_ray_sampler,
-                        projector,
-                        gt_img,
+                        ray_sampler=tmp_ray_sampler,
+                        projector=val_projector,
+                        gt_img=gt_img,
                         render_stride=args.render_stride,
                         prefix="val/",
                         out_folder=out_folder,
                         # ret_alpha=args.N_importance > 0,
                         ret_alpha=ret_alpha,
                         single_net=args.single_net,
-                        sky_style_code=z,
+                        sky_style_code=z.detach().clone(),
                         # sky_style_model=sky_style_model,
-                        sky_model=sky_model,
                         use_updated_prior_depth=use_updated_prior_depth,
                         data_mode='val',
                     )
-                    torch.cuda.empty_cache()
 
                     print("Logging current training view...")
                     tmp_ray_train_sampler = RaySamplerSingleImage(
-                        train_data, device, render_stride=1
+                        train_views[0], device, render_stride=args.train_view_render_stride
                     )
                     H, W = tmp_ray_train_sampler.H, tmp_ray_train_sampler.W
                     gt_img = tmp_ray_train_sampler.rgb.reshape(H, W, 3)
@@ -514,26 +661,40 @@ def train(args):
                     LinGaoyuan_operation_20240918: use updated prior depth if use train sampler and use_updated_prior_depth is True. 
                     set data_mode=train in this situation
                     '''
-                    log_view(
+                    'LinGaoyuan_operation_20261018: only the prior depth of this view is passed (a copy), not the whole buffer'
+                    train_depth_prior = None
+                    if use_updated_prior_depth is True:
+                        train_depth_prior = train_prior_depth_values[
+                            tmp_ray_train_sampler.idx.to(train_prior_depth_values.device), ...
+                        ].reshape(-1, 1).clone()
+                    train_view = functools.partial(
+                        log_view,
                         global_step,
                         args,
-                        model,
-                        tmp_ray_train_sampler,
-                        projector,
-                        gt_img,
-                        render_stride=1,
+                        ray_sampler=tmp_ray_train_sampler,
+                        projector=val_projector,
+                        gt_img=gt_img,
+                        render_stride=args.train_view_render_stride,
                         prefix="train/",
                         out_folder=out_folder,
                         # ret_alpha=args.N_importance > 0,
                         ret_alpha=ret_alpha,
                         single_net=args.single_net,
-                        sky_style_code=z,
+                        sky_style_code=z.detach().clone(),
                         # sky_style_model=sky_style_model,
-                        sky_model=sky_model,
                         data_mode='train',
-                        train_prior_depth_values=train_prior_depth_values,
+                        train_depth_prior=train_depth_prior,
                         use_updated_prior_depth=use_updated_prior_depth,
                     )
+
+                    'LinGaoyuan_operation_20261018: the validation rendering is not part of the stage timing and of rays/sec'
+                    if async_validation is not None:
+                        async_validation.submit([val_view, train_view], step=global_step)
+                    else:
+                        with step_profiler.paused(), metrics.paused():
+                            val_view(model=model, sky_model=sky_model)
+                            torch.cuda.empty_cache()
+                            train_view(model=model, sky_model=sky_model)
             global_step += 1
 
             epoch_step += 1
@@ -542,6 +703,13 @@ def train(args):
                 break
         # epoch += 1
 
+    'the ckpts that are still queued are written before the process exits'
+    checkpoint_writer.close()
+    if async_validation is not None:
+        async_validation.close()
+    if metric_sink is not None:
+        metric_sink.close()
+
 
 @torch.no_grad()
 def log_view(
@@ -562,8 +730,15 @@ def log_view(
     data_mode=None,
     train_prior_depth_values=None,
     use_updated_prior_depth=False,
+    train_depth_prior=None,
 ):
+    '''
+    :param train_depth_prior: prior depth of the view [H*W, 1], used instead of the entry of train_prior_depth_values
+    '''
     model.switch_to_eval()
+    'LinGaoyuan_operation_20261018: the weights changed since the last validation, the baked sky texture is outdated'
+    if hasattr(sky_model, "sky_texture"):
+        sky_model.sky_texture = None
     with torch.no_grad():
         ray_batch = ray_sampler.get_all()
 
@@ -578,7 +753,8 @@ def log_view(
         '''
         if data_mode == 'train' and use_updated_prior_depth is True:
             print('use updated prior depth for training dataset in val process')
-            train_depth_prior = (train_prior_depth_values[ray_batch["idx"], ...]).reshape(-1, 1)
+            if train_depth_prior is None:
+                train_depth_prior = (train_prior_depth_values[ray_batch["idx"], ...]).reshape(-1, 1)
         else:
             train_depth_prior = None
 
@@ -628,7 +804,7 @@ def log_view(
     # plt.imshow(depth_value)
     # plt.show()
 
-    if args.render_stride != 1:
+    if render_stride != 1:
         print(gt_img.shape)
         gt_img = gt_img[::render_stride, ::render_stride]
         average_im = average_im[::render_stride, ::render_stride]
@@ -767,7 +943,7 @@ def log_view(
     print(prefix + "psnr_image: ", psnr_curr_img)
 
     'LinGaoyuan_operation_20240927: calculate psnr of depth image'
-    depth_value_gt = ray_batch['depth_value'].reshape(H,W,1).squeeze().cpu()
+    depth_value_gt = ray_batch['depth_value'].reshape(H,W,1).squeeze().cpu()[::render_stride, ::render_stride]
     depth_gt_replace_sky = (depth_value_gt * sky_mask + depth_sky * (1 - sky_mask)).squeeze()
     depth_img_gt_replace_sky = ((depth_gt_replace_sky - depth_gt_replace_sky.min()) / (depth_gt_replace_sky.max() - depth_gt_replace_sky.min()))
 
@@ -255,7 +255,7 @@ def train(args):
 
 
     # create projector
-    projector = Projector(device=device)
+    projector = Projector(device=device, mip_levels=args.feature_mip_levels)
 
     # Create criterion
     criterion = Criterion()